@@ -6,4 +6,7 @@ class AccountsConfig(AppConfig):
     name = 'accounts'
 
     def ready(self):
-        import accounts.signals
\ No newline at end of file
+        import accounts.signals
+        from accounts.presence import presence
+        from coreBackend.eventbus import get_bus
+        get_bus().subscribe("presence.online", presence.observe)
\ No newline at end of file
@@ -0,0 +1,84 @@
+import copy
+import os
+
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from coreBackend.versioned_cache import VersionedCache
+
+
+class UserCache(VersionedCache):
+    """
+    Per-process LRU of authenticated users:
+    (user id, token version) -> user, for at most `ttl` seconds.
+
+    The token version is the token's revoke claim (a hash of the password,
+    when SIMPLE_JWT["CHECK_REVOKE_TOKEN"] is on), so tokens issued after a
+    password change never hit an old entry.
+
+    Deactivating a user or changing a password (accounts.signals) bumps the
+    shared version file (coreBackend.versioned_cache), and every process
+    drops its whole cache on its next lookup. Changes that bypass signals
+    (QuerySet.update) show up after `ttl` seconds at the latest.
+    """
+
+
+user_cache = UserCache(
+    version_file=os.path.join(settings.LOCAL_STATE_DIR, "user_cache.version"),
+    max_entries=settings.AUTH_USER_CACHE_MAX_USERS,
+    ttl=settings.AUTH_USER_CACHE_TTL,
+)
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication without a User query on every request: resolved users
+    are kept in user_cache. Only the columns below are loaded; other fields
+    are fetched on first access, as with any deferred field.
+    """
+
+    fields = ("username", "email", "is_active")
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            return super().get_user(validated_token)  # raises InvalidToken
+
+        key = (str(user_id), validated_token.get(api_settings.REVOKE_TOKEN_CLAIM))
+        user = user_cache.get(key, lambda: self.load_user(user_id, validated_token))
+
+        # Each request gets its own instance (relation caches, attributes)
+        return copy.copy(user)
+
+    def load_user(self, user_id, validated_token):
+        """
+        The checks of JWTAuthentication.get_user, on a slimmer query.
+        """
+        fields = [api_settings.USER_ID_FIELD, *self.fields]
+        if api_settings.CHECK_REVOKE_TOKEN:
+            fields.append("password")
+
+        try:
+            user = self.user_model.objects.only(*fields).get(
+                **{api_settings.USER_ID_FIELD: user_id}
+            )
+        except self.user_model.DoesNotExist as e:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found") from e
+
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(
+                user.password
+            ):
+                raise AuthenticationFailed(
+                    _("The user's password has been changed."), code="password_changed"
+                )
+
+        return user
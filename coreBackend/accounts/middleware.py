@@ -1,32 +1,48 @@
-from django.utils import timezone
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
 from django.contrib.auth.models import AnonymousUser
-from django.core.exceptions import ObjectDoesNotExist
+from django.utils.functional import empty
 
-from .models import Profile
+from .presence import presence
 
 
 class LastSeenMiddleware:
     """
-    Update user.profile.last_seen every time an authenticated user hits the API.
-    Safely creates Profile if it doesn't exist.
+    Record a presence heartbeat every time an authenticated user hits the API.
+    Heartbeats are kept in memory and flushed to Profile.last_seen in batches
+    (see accounts.presence), so this no longer writes on every request.
+
+    Works in both sync and async stacks, like InstrumentationMiddleware, so
+    a parked long-poll doesn't hold a thread.
     """
+    sync_capable = True
+    async_capable = True
 
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
         response = self.get_response(request)
+        self.heartbeat(getattr(request, 'user', None))
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
 
         user = getattr(request, 'user', None)
+        if getattr(user, '_wrapped', None) is empty:
+            # Session user nobody looked at (DRF sets the token user on the
+            # request): resolving it queries, so not from the event loop
+            user = await request.auser()
+        # May publish on the event bus (a network call with Redis)
+        await sync_to_async(self.heartbeat)(user)
+        return response
 
+    @staticmethod
+    def heartbeat(user):
         if user and not isinstance(user, AnonymousUser) and user.is_authenticated:
-            try:
-                profile = user.profile
-            except ObjectDoesNotExist:
-                # Create profile if missing (for old users)
-                profile = Profile.objects.create(user=user)
-
-            profile.last_seen = timezone.now()
-            profile.save(update_fields=['last_seen'])
-
-        return response
+            presence.heartbeat(user.id)
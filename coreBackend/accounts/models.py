@@ -1,19 +1,16 @@
 from django.db import models
 from django.contrib.auth.models import User
-from django.utils import timezone
 
 
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
-    last_seen = models.DateTimeField(null=True, blank=True)
+    last_seen = models.DateTimeField(null=True, blank=True, db_index=True)
 
     def __str__(self):
         return f"{self.user.username} Profile"
 
     @property
     def online(self):
-        if not self.last_seen:
-            return False
+        from .presence import presence
 
-        now = timezone.now()
-        return (now - self.last_seen).total_seconds() < 60  # 1 minute online window
+        return presence.is_online(presence.get_last_seen(self.user_id, self.last_seen))
@@ -0,0 +1,215 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import DatabaseError, connection
+from django.db.models import Case, When, Value
+from django.utils import timezone
+
+from coreBackend.eventbus import get_bus
+
+from .models import Profile
+
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceTracker:
+    """
+    Write-behind store for user activity.
+
+    Every authenticated request records a heartbeat in memory. A background
+    thread writes them to Profile.last_seen every `flush_interval` seconds,
+    FLUSH_CHUNK_SIZE users per UPDATE, so read endpoints no longer write a
+    row per request.
+
+    The in-memory value is always at least as fresh as the DB, so presence
+    reads go through get_last_seen() instead of Profile.last_seen directly.
+    """
+
+    # Users per UPDATE: 3 query parameters each, well under SQLite's limit
+    FLUSH_CHUNK_SIZE = 200
+
+    def __init__(self, flush_interval, online_window):
+        self.flush_interval = flush_interval
+        self.online_window = online_window
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_seen = {}  # user_id -> datetime, recently active users
+        self._online_since = {}  # user_id -> datetime the current session began
+        self._pending = {}    # user_id -> datetime, not yet written to the DB
+        self._flusher_pid = None
+
+    def heartbeat(self, user_id, when=None):
+        when = when or timezone.now()
+        self._start_flusher()
+
+        with self._lock:
+            previous = self._last_seen.get(user_id)
+            came_online = previous is None or (when - previous).total_seconds() >= self.online_window
+            if came_online:
+                self._online_since[user_id] = when
+            self._last_seen[user_id] = when
+            self._pending[user_id] = when
+
+        if came_online:
+            # The other workers would only see it at our next flush
+            get_bus().publish(
+                {"type": "presence.online", "user_id": user_id, "when": when.timestamp()}
+            )
+
+    def observe(self, event):
+        """
+        presence.online from the bus: a user came online in some worker.
+        Remembered like a heartbeat, minus the DB write (that worker does it).
+        """
+        user_id = event["user_id"]
+        when = datetime.fromtimestamp(event["when"], tz=dt_timezone.utc)
+
+        with self._lock:
+            previous = self._last_seen.get(user_id)
+            if previous is not None and previous >= when:
+                return
+            if previous is None or (when - previous).total_seconds() >= self.online_window:
+                self._online_since[user_id] = when
+            self._last_seen[user_id] = when
+
+    def get_last_seen(self, user_id, stored=None):
+        """
+        Freshest known last_seen: in-memory heartbeat or the stored DB value.
+        """
+        with self._lock:
+            recent = self._last_seen.get(user_id)
+
+        if recent is None or (stored is not None and stored > recent):
+            return stored
+        return recent
+
+    def active_since(self, when):
+        """
+        Ids of users with an in-memory heartbeat newer than `when`.
+        """
+        with self._lock:
+            return [user_id for user_id, seen in self._last_seen.items() if seen > when]
+
+    def status_changed_at(self, user_id, last_seen, online):
+        """
+        When the user last went online / offline.
+        For a user that came online in another process we only know
+        last_seen, which can only make us report a change too often.
+        """
+        if not online:
+            return last_seen + timedelta(seconds=self.online_window) if last_seen else None
+
+        with self._lock:
+            online_since = self._online_since.get(user_id)
+        return online_since or last_seen
+
+    def is_online(self, last_seen, now=None):
+        if not last_seen:
+            return False
+        now = now or timezone.now()
+        return (now - last_seen).total_seconds() < self.online_window
+
+    def flush(self, quiet=False):
+        """
+        Write all pending heartbeats: one UPDATE (plus one INSERT for users
+        that have no Profile yet) per FLUSH_CHUNK_SIZE users. If the DB
+        fails, what wasn't written is kept for the next flush.
+        """
+        # Only one thread flushes; others just keep recording.
+        if not self._flush_lock.acquire(blocking=False):
+            return
+
+        try:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._forget_idle()
+
+            items = list(pending.items())
+            for start in range(0, len(items), self.FLUSH_CHUNK_SIZE):
+                try:
+                    self._write(dict(items[start:start + self.FLUSH_CHUNK_SIZE]))
+                except DatabaseError:
+                    if not quiet:
+                        logger.exception("Could not flush %d presence heartbeats", len(items) - start)
+                    # Put them back unless a newer heartbeat arrived meanwhile.
+                    with self._lock:
+                        for user_id, when in items[start:]:
+                            self._pending.setdefault(user_id, when)
+                    break
+        finally:
+            self._flush_lock.release()
+
+    def _start_flusher(self):
+        # One thread per process; after a fork the parent's is gone
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_periodically, name="presence-flush", daemon=True).start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Presence flush failed")
+            finally:
+                connection.close()  # this thread's own connection
+
+    def _write(self, pending):
+        updated = Profile.objects.filter(user_id__in=pending).update(
+            last_seen=Case(
+                *[When(user_id=user_id, then=Value(when)) for user_id, when in pending.items()],
+                default="last_seen",
+            )
+        )
+
+        if updated < len(pending):
+            # Profile missing (users created before the signal existed)
+            existing = set(
+                Profile.objects.filter(user_id__in=pending).values_list("user_id", flat=True)
+            )
+            Profile.objects.bulk_create(
+                [
+                    Profile(user_id=user_id, last_seen=when)
+                    for user_id, when in pending.items()
+                    if user_id not in existing
+                ],
+                ignore_conflicts=True,
+            )
+
+    def _forget_idle(self):
+        # Called with self._lock held. Users idle for longer than the online
+        # window are offline anyway; the DB value is enough for them.
+        cutoff = timezone.now().timestamp() - self.online_window
+        for user_id in [
+            user_id for user_id, when in self._last_seen.items()
+            if when.timestamp() < cutoff and user_id not in self._pending
+        ]:
+            del self._last_seen[user_id]
+            self._online_since.pop(user_id, None)
+
+
+presence = PresenceTracker(
+    flush_interval=settings.PRESENCE_FLUSH_INTERVAL,
+    online_window=settings.PRESENCE_ONLINE_WINDOW,
+)
+
+
+@atexit.register
+def _flush_on_exit():
+    # Best effort: the DB may already be gone (e.g. test database teardown).
+    try:
+        presence.flush(quiet=True)
+    except Exception:
+        pass
@@ -1,7 +1,14 @@
-from django.db.models.signals import post_save
+import os
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import DEFERRED
+from django.db.models.signals import post_delete, post_init, post_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
 
+from coreBackend.versioned_cache import bump_version, read_version
+
 from .models import Profile
 
 
@@ -9,3 +16,57 @@ from .models import Profile
 def create_profile(sender, instance, created, **kwargs):
     if created:
         Profile.objects.create(user=instance)
+
+
+# What the cached authentication depends on (accounts.authentication)
+AUTH_FIELDS = ("password", "is_active")
+# What GET /api/users/ shows (its ETag, accounts.views.UserListView)
+LIST_FIELDS = ("username", "email", "is_active")
+TRACKED_FIELDS = tuple(dict.fromkeys(AUTH_FIELDS + LIST_FIELDS))
+
+USER_LIST_VERSION_FILE = os.path.join(settings.LOCAL_STATE_DIR, "user_list.version")
+
+
+def user_list_version():
+    return read_version(USER_LIST_VERSION_FILE)
+
+
+def tracked_fields(user):
+    # From __dict__: reading a deferred field would query
+    return {field: user.__dict__.get(field, DEFERRED) for field in TRACKED_FIELDS}
+
+
+@receiver(post_init, sender=User)
+def remember_tracked_fields(sender, instance, **kwargs):
+    # As loaded, so a save can tell what changed without a query
+    instance._loaded_fields = tracked_fields(instance)
+
+
+@receiver(post_save, sender=User)
+def user_changed(sender, instance, created, update_fields=None, **kwargs):
+    from .authentication import user_cache
+
+    if created:
+        return  # new users already change the list's count and Max(id)
+
+    saved = set(TRACKED_FIELDS if update_fields is None else update_fields)
+    current = tracked_fields(instance)
+    changed = {
+        field for field in saved & set(TRACKED_FIELDS)
+        if current[field] != instance._loaded_fields[field]
+    }
+    for field in changed:
+        instance._loaded_fields[field] = current[field]
+
+    if changed & set(AUTH_FIELDS):
+        transaction.on_commit(user_cache.invalidate)
+    if changed & set(LIST_FIELDS):
+        transaction.on_commit(lambda: bump_version(USER_LIST_VERSION_FILE))
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    from .authentication import user_cache
+
+    transaction.on_commit(user_cache.invalidate)
+    transaction.on_commit(lambda: bump_version(USER_LIST_VERSION_FILE))
@@ -1,3 +1,165 @@
-from django.test import TestCase
+import time
+import unittest.mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.db import DatabaseError
+from django.test import TestCase, TransactionTestCase
+from rest_framework.test import APIClient
+
+from chat.models import Message
+
+from .models import Profile
+from .presence import PresenceTracker
+
+
+class CachedUserInvalidationTests(TestCase):
+    """
+    accounts.signals: a save drops the cached users (or bumps the user list
+    version) only when a field they depend on changed, and never queries
+    for it.
+    """
+
+    def setUp(self):
+        User.objects.create_user("alice", password="x")
+        self.user = User.objects.get(username="alice")
+
+    def save(self, **kwargs):
+        with self.captureOnCommitCallbacks() as callbacks:
+            with self.assertNumQueries(1):  # just the UPDATE
+                self.user.save(**kwargs)
+        return len(callbacks)
+
+    def test_other_fields(self):
+        self.user.first_name = "Alice"
+        self.assertEqual(self.save(), 0)
+
+    def test_password(self):
+        self.user.set_password("y")
+        self.assertEqual(self.save(), 1)
+        self.assertEqual(self.save(), 0)  # already invalidated
+
+    def test_deactivation(self):
+        self.user.is_active = False
+        # The cached users and the user list
+        self.assertEqual(self.save(update_fields=["is_active"]), 2)
+
+    def test_update_fields_without_auth_fields(self):
+        self.user.is_active = False
+        self.assertEqual(self.save(update_fields=["first_name"]), 0)
+
+    def test_deferred_load(self):
+        self.user = User.objects.only("id", "username").get(pk=self.user.pk)
+        self.user.username = "alice2"
+        self.assertEqual(self.save(), 1)  # just the user list
+
+
+class UserListETagTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def get(self, etag=None):
+        headers = {"If-None-Match": etag} if etag else {}
+        return self.client.get("/api/users/", headers=headers)
+
+    def assertChanged(self, etag):
+        response = self.get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        return response["ETag"]
+
+    def test_not_modified(self):
+        etag = self.get()["ETag"]
+        response = self.get(etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+    def test_changes(self):
+        etag = self.get()["ETag"]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.create(sender=self.bob, receiver=self.alice, content="hi")
+        etag = self.assertChanged(etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bob.username = "robert"
+            self.bob.save()
+        etag = self.assertChanged(etag)
+        self.assertIn("robert", [user["username"] for user in self.get().data])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bob.is_active = False
+            self.bob.save(update_fields=["is_active"])
+        etag = self.assertChanged(etag)
+
+        User.objects.create(username="carol")
+        self.assertChanged(etag)
+
+    def test_per_user(self):
+        etag = self.get()["ETag"]
+        self.client.force_authenticate(self.bob)
+        response = self.get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+
+class PresenceFlushTests(TransactionTestCase):
+    """
+    accounts.presence: heartbeats reach Profile.last_seen from a background
+    thread, in bounded chunks, and survive a failed write.
+    """
+
+    def make_tracker(self, flush_interval=3600):
+        tracker = PresenceTracker(flush_interval=flush_interval, online_window=60)
+        tracker.FLUSH_CHUNK_SIZE = 3
+        return tracker
+
+    def setUp(self):
+        self.users = [User.objects.create(username=f"user{i}") for i in range(7)]
+
+    def test_chunks(self):
+        tracker = self.make_tracker()
+        for user in self.users:
+            tracker.heartbeat(user.id)
+
+        written = []
+        write = tracker._write
+        with unittest.mock.patch.object(tracker, "_write", lambda chunk: written.append(len(chunk)) or write(chunk)):
+            tracker.flush()
+
+        self.assertEqual(written, [3, 3, 1])
+        self.assertFalse(Profile.objects.filter(last_seen__isnull=True).exists())
+
+    def test_failed_chunk_is_kept(self):
+        tracker = self.make_tracker()
+        for user in self.users:
+            tracker.heartbeat(user.id)
+
+        calls = []
+        write = tracker._write
+
+        def fail_second(chunk):
+            calls.append(chunk)
+            if len(calls) == 2:
+                raise DatabaseError("locked")
+            write(chunk)
+
+        with unittest.mock.patch.object(tracker, "_write", fail_second):
+            tracker.flush(quiet=True)
+        self.assertEqual(Profile.objects.filter(last_seen__isnull=False).count(), 3)
+
+        tracker.flush()
+        self.assertFalse(Profile.objects.filter(last_seen__isnull=True).exists())
+
+    def test_flushes_without_requests(self):
+        tracker = self.make_tracker(flush_interval=0.1)
+        tracker.heartbeat(self.users[0].id)
+
+        for _ in range(50):
+            if Profile.objects.filter(user=self.users[0], last_seen__isnull=False).exists():
+                break
+            time.sleep(0.05)
+        else:
+            self.fail("heartbeat was never flushed")
@@ -4,13 +4,19 @@ from rest_framework import status
 from rest_framework import permissions
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.db.models import Count, F, FilteredRelation, Max, Q, Value
+from django.db.models.functions import Coalesce
 from django.utils import timezone
-from django.core.cache import cache
+from datetime import datetime, timedelta, timezone as dt_timezone
 
 from .serializers import RegisterSerializer, LoginSerializer, UserSerializer
 from .models import Profile
-from chat.models import Message
+from .presence import presence
+from .signals import user_list_version
 from rest_framework_simplejwt.views import TokenObtainPairView
+from chat.models import Conversation
+from coreBackend.conditional import make_etag, not_modified, with_etag
+from coreBackend.ratelimit import rate_limit
 
 
 class RateLimitedTokenObtainPairView(TokenObtainPairView):
@@ -31,25 +37,6 @@ class RateLimitedTokenObtainPairView(TokenObtainPairView):
         # Call the original SimpleJWT logic
         return super().post(request, *args, **kwargs)
 
-def rate_limit(request, action: str, limit: int, window_seconds: int = 60) -> bool:
-    """
-    Simple per-IP rate limiter using Django cache.
-
-    action: "login", "register", "send_message", etc.
-    limit:  allowed attempts within window_seconds per IP.
-    returns True if blocked, False if allowed.
-    """
-    ip = request.META.get("REMOTE_ADDR", "unknown")
-    key = f"rl:{action}:{ip}"
-
-    attempts = cache.get(key, 0)
-
-    if attempts >= limit:
-        return True  # blocked
-
-    cache.set(key, attempts + 1, timeout=window_seconds)
-    return False
-
 
 class RegisterView(APIView):
     permission_classes = [permissions.AllowAny]  # still public, but protected by secret
@@ -115,73 +102,152 @@ class CurrentUserView(APIView):
 class UserListView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
+    MAX_LIMIT = 100
+
     def get(self, request):
+        """
+        GET /api/users/[?limit=50&offset=0]
+
+        All other users with the last message exchanged with each one,
+        most recent conversation first. Read from chat.Conversation in a
+        single query (joined on the (user_low, user_high) unique index).
+
+        Sends an ETag built from the user's conversations and the set of
+        users (count, newest id, and a version bumped by accounts.signals
+        when a username, email or is_active changes); a matching
+        If-None-Match gets a 304 without the join.
+        """
         current_user = request.user
-        others = User.objects.exclude(id=current_user.id)
-
-        result = []
-
-        for user in others:
-            # Get last message between current_user and this user
-            last_msg = (
-                Message.objects.filter(
-                    sender__in=[current_user, user],
-                    receiver__in=[current_user, user],
-                )
-                .order_by("-timestamp")
-                .first()
-            )
-
-            if last_msg:
-                text = last_msg.content
-                if len(text) > 40:
-                    text = text[:40] + "…"
 
-                last_message = text
-                last_message_time = last_msg.timestamp
-            else:
-                last_message = ""
-                last_message_time = None
-
-            result.append(
-                {
-                    "id": user.id,
-                    "username": user.username,
-                    "email": user.email,
-                    "last_message": last_message,
-                    "last_message_time": last_message_time,
-                }
+        etag = make_etag(
+            request,
+            Conversation.objects.version(current_user.id),
+            tuple(User.objects.aggregate(count=Count("id"), last=Max("id")).values()),
+            user_list_version(),
+        )
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+
+        others = (
+            User.objects.exclude(id=current_user.id)
+            .annotate(
+                conv_low=FilteredRelation(
+                    "conversations_as_low",
+                    condition=Q(conversations_as_low__user_high=current_user),
+                ),
+                conv_high=FilteredRelation(
+                    "conversations_as_high",
+                    condition=Q(conversations_as_high__user_low=current_user),
+                ),
             )
+            .annotate(
+                last_message=Coalesce(
+                    "conv_low__last_message_preview",
+                    "conv_high__last_message_preview",
+                    Value(""),
+                ),
+                last_message_time=Coalesce(
+                    "conv_low__last_message_time",
+                    "conv_high__last_message_time",
+                ),
+            )
+            .order_by(F("last_message_time").desc(nulls_last=True), "id")
+            .values("id", "username", "email", "last_message", "last_message_time")
+        )
+
+        try:
+            offset = max(int(request.query_params.get("offset", 0)), 0)
+            limit = request.query_params.get("limit")
+            if limit is not None:
+                limit = min(max(int(limit), 1), self.MAX_LIMIT)
+        except ValueError:
+            return Response(
+                {"detail": "limit and offset must be integers"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        if limit is not None:
+            others = others[offset:offset + limit]
+        elif offset:
+            others = others[offset:]
 
-        return Response(result, status=200)
+        return with_etag(Response(list(others), status=200), etag)
 
 
 class UserPresenceView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request):
+        """
+        GET /api/presence/[?ids=2,5,9][&since=<cursor>]
+
+        Without `since`: a list of every other user (or only `ids`) with
+        their online status, from one query.
+
+        With `since` (use since=0 for the first call; users never seen
+        online are left out and can be treated as offline):
+        {
+          "cursor": <pass as `since` next time>,
+          "users": [ ...only users whose online status changed... ]
+        }
+        """
         users = User.objects.exclude(id=request.user.id)
-        data = []
+
+        ids = request.query_params.get("ids")
+        since = request.query_params.get("since")
+        try:
+            if ids:
+                users = users.filter(id__in=[int(i) for i in ids.split(",") if i])
+            if since is not None:
+                since = datetime.fromtimestamp(float(since), tz=dt_timezone.utc)
+        except (ValueError, OverflowError, OSError):
+            return Response(
+                {"detail": "ids must be comma separated integers, since a cursor"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
         now = timezone.now()
 
-        for user in users:
-            profile, _ = Profile.objects.get_or_create(user=user)
-            last_seen = profile.last_seen
+        if since is not None:
+            # Only users active since (since - window) can have changed
+            # status after `since`; index on Profile.last_seen.
+            active_after = since - timedelta(seconds=presence.online_window)
+            users = users.filter(
+                Q(profile__last_seen__gt=active_after)
+                | Q(id__in=presence.active_since(active_after))
+            )
+
+        data = []
+        for user in users.values("id", "username", "profile__last_seen"):
+            last_seen = presence.get_last_seen(user["id"], user["profile__last_seen"])
+            online = presence.is_online(last_seen, now)
 
-            if last_seen:
-                seconds = (now - last_seen).total_seconds()
-                online = seconds < 60  # 1 minute window
-            else:
-                online = False
+            if since is not None:
+                changed_at = presence.status_changed_at(user["id"], last_seen, online)
+                if changed_at is None or not since < changed_at <= now:
+                    continue
 
             data.append(
                 {
-                    "id": user.id,
-                    "username": user.username,
+                    "id": user["id"],
+                    "username": user["username"],
                     "online": online,
                     "last_seen": last_seen,
                 }
             )
 
-        return Response(data, status=200)
+        # Presence moves with the clock, so there is no version to check
+        # up front; hashing the result still spares rendering and sending
+        # an unchanged body (the cursor is left out so it can match).
+        etag = make_etag(request, data)
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+
+        if since is None:
+            return with_etag(Response(data, status=200), etag)
+
+        return with_etag(
+            Response({"cursor": now.timestamp(), "users": data}, status=200), etag
+        )
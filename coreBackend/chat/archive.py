@@ -0,0 +1,306 @@
+"""
+Cold storage for old messages.
+
+Each conversation gets a directory under settings.MESSAGE_ARCHIVE_DIR:
+
+    <user_low>-<user_high>/
+        000001.seg      append-only; concatenated zlib blocks of NDJSON rows
+        000002.seg      (a new segment starts once one passes SEGMENT_MAX_BYTES)
+        index.jsonl     one line per block:
+                        {"segment", "offset", "length", "first_id", "last_id", "count"}
+
+The archive of a conversation always holds exactly the messages with
+id <= its last_id (minus those chat.retention removed); the hot table
+holds the rest. A block is fsync'ed before its index line is written, and
+rows are deleted from the hot table only after that, so an interrupted run
+never loses messages (leftover rows that are already archived are deleted
+on the next run).
+"""
+import json
+import os
+import time
+import zlib
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from .models import Message
+
+
+SEGMENT_MAX_BYTES = 16 * 1024 * 1024
+ROW_FIELDS = ("id", "sender_id", "receiver_id", "content", "timestamp")
+
+
+class ConversationArchive:
+    def __init__(self, root, conversation_key):
+        self.conversation_key = conversation_key
+        self.path = os.path.join(str(root), conversation_key.replace(":", "-"))
+        self.index_path = os.path.join(self.path, "index.jsonl")
+        self._entries = None
+        self._index_stamp = None
+
+    # -- reading ---------------------------------------------------------
+
+    def entries(self):
+        """
+        Index entries, oldest block first. Re-read only when the file changed.
+        """
+        try:
+            stat = os.stat(self.index_path)
+        except FileNotFoundError:
+            return []
+
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp != self._index_stamp:
+            entries = []
+            with open(self.index_path) as f:
+                for line in f:
+                    if line.endswith("\n"):  # skip a half-written last line
+                        entries.append(json.loads(line))
+            self._entries, self._index_stamp = entries, stamp
+        return self._entries
+
+    @property
+    def last_id(self):
+        entries = self.entries()
+        return entries[-1]["last_id"] if entries else 0
+
+    def read_block(self, entry):
+        try:
+            with open(os.path.join(self.path, entry["segment"]), "rb") as f:
+                f.seek(entry["offset"])
+                data = zlib.decompress(f.read(entry["length"]))
+        except FileNotFoundError:
+            return []  # purged (chat.retention) since we read the index
+        return [json.loads(line) for line in data.decode().splitlines()]
+
+    def before(self, before_id, limit):
+        """
+        The newest `limit` archived rows with id < before_id, oldest first.
+        """
+        rows = []
+        for entry in reversed(self.entries()):
+            if len(rows) >= limit:
+                break
+            if before_id is not None and entry["first_id"] >= before_id:
+                continue
+            block = [
+                row for row in self.read_block(entry)
+                if before_id is None or row["id"] < before_id
+            ]
+            rows = block + rows
+        return rows[-limit:] if limit else []
+
+    def after(self, after_id, limit):
+        """
+        The oldest `limit` archived rows with id > after_id, oldest first.
+        """
+        rows = []
+        for entry in self.entries():
+            if len(rows) >= limit:
+                break
+            if entry["last_id"] <= after_id:
+                continue
+            rows.extend(row for row in self.read_block(entry) if row["id"] > after_id)
+        return rows[:limit]
+
+    def iter_rows(self):
+        for entry in self.entries():
+            yield from self.read_block(entry)
+
+    # -- writing ---------------------------------------------------------
+
+    @contextmanager
+    def lock(self):
+        import fcntl  # POSIX only; reading the archive works anywhere
+
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, ".lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def append(self, rows):
+        """
+        Write one block of rows (ascending ids, all > last_id).
+        Call with lock() held.
+        """
+        entries = self.entries()
+        entry = self._write_block(rows, entries[-1]["segment"] if entries else "000001.seg")
+
+        with open(self.index_path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write_block(self, rows, segment):
+        """
+        Compress rows into the end of `segment` (or the next one if it is
+        full), fsync'ed. Returns the index entry; writing it is up to the caller.
+        """
+        data = zlib.compress(
+            "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in rows).encode()
+        )
+
+        segment_path = os.path.join(self.path, segment)
+        if os.path.exists(segment_path) and os.path.getsize(segment_path) >= SEGMENT_MAX_BYTES:
+            segment = f"{int(segment.split('.')[0]) + 1:06d}.seg"
+            segment_path = os.path.join(self.path, segment)
+
+        with open(segment_path, "ab") as f:
+            offset = f.tell()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        return {
+            "segment": segment,
+            "offset": offset,
+            "length": len(data),
+            "first_id": rows[0]["id"],
+            "last_id": rows[-1]["id"],
+            "count": len(rows),
+        }
+
+    def count_through(self, max_id):
+        """
+        Number of archived rows with id <= max_id: what drop_through(max_id)
+        would remove. Only a block holding both sides of max_id is read.
+        """
+        count = 0
+        for entry in self.entries():
+            if entry["last_id"] <= max_id:
+                count += entry["count"]
+            elif entry["first_id"] <= max_id:
+                count += sum(1 for row in self.read_block(entry) if row["id"] <= max_id)
+        return count
+
+    def drop_through(self, max_id):
+        """
+        Remove the archived rows with id <= max_id (retention). Whole blocks
+        are dropped from the index; a block holding both sides of max_id is
+        rewritten without the old rows. Segment files nobody references any
+        more are deleted once the new index is in place.
+        Call with lock() held. Returns the number of rows removed.
+        """
+        entries = self.entries()
+        if not entries or entries[0]["first_id"] > max_id:
+            return 0
+
+        kept = [entry for entry in entries if entry["last_id"] > max_id]
+        removed = sum(entry["count"] for entry in entries) - sum(entry["count"] for entry in kept)
+
+        if kept and kept[0]["first_id"] <= max_id:
+            rows = [row for row in self.read_block(kept[0]) if row["id"] > max_id]
+            removed += kept[0]["count"] - len(rows)
+            kept[0] = self._write_block(rows, entries[-1]["segment"])
+
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.writelines(json.dumps(entry) + "\n" for entry in kept)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.index_path)
+
+        unreferenced = {entry["segment"] for entry in entries} - {entry["segment"] for entry in kept}
+        for segment in unreferenced:
+            try:
+                os.unlink(os.path.join(self.path, segment))
+            except FileNotFoundError:
+                pass
+        return removed
+
+
+def get_archive(conversation_key):
+    return ConversationArchive(settings.MESSAGE_ARCHIVE_DIR, conversation_key)
+
+
+def to_row(message):
+    return {
+        "id": message["id"],
+        "sender": message["sender_id"],
+        "receiver": message["receiver_id"],
+        "content": message["content"],
+        "timestamp": message["timestamp"].isoformat(),
+    }
+
+
+def to_message(row, conversation_key, users=None):
+    """
+    Unsaved Message for an archived row, so it serializes like a hot one.
+    `users` ({id: User}) avoids a lookup per row for sender / receiver.
+    """
+    message = Message(
+        id=row["id"],
+        sender_id=row["sender"],
+        receiver_id=row["receiver"],
+        content=row["content"],
+        timestamp=parse_datetime(row["timestamp"]),
+        conversation_key=conversation_key,
+    )
+    if users:
+        message.sender = users[row["sender"]]
+        message.receiver = users[row["receiver"]]
+    return message
+
+
+def to_values(row, users):
+    """
+    An archived row shaped like chat.serializers.message_rows() output.
+    `users` is {id: User} for both sides of the conversation.
+    """
+    return {
+        "id": row["id"],
+        "sender_id": row["sender"],
+        "receiver_id": row["receiver"],
+        "sender__username": users[row["sender"]].username,
+        "receiver__username": users[row["receiver"]].username,
+        "content": row["content"],
+        "timestamp": parse_datetime(row["timestamp"]),
+    }
+
+
+def archive_conversation(conversation_key, cutoff, chunk_size=500, pause=0):
+    """
+    Move messages of one conversation older than `cutoff` (a datetime) into
+    its archive, `chunk_size` rows per block / DELETE transaction.
+    Returns the number of rows archived.
+    """
+    archive = get_archive(conversation_key)
+    hot = Message.objects.filter(conversation_key=conversation_key)
+
+    # Everything up to the newest old message goes, so the archive stays a
+    # contiguous id range below the hot table.
+    boundary = (
+        hot.filter(timestamp__lt=cutoff).order_by("-id").values_list("id", flat=True).first()
+    )
+    if boundary is None:
+        return 0
+
+    archived = 0
+    with archive.lock():
+        # Rows archived by an interrupted run but not deleted yet
+        hot.filter(id__lte=archive.last_id).delete()
+
+        while True:
+            rows = [
+                to_row(message) for message in
+                hot.filter(id__lte=boundary).order_by("id").values(*ROW_FIELDS)[:chunk_size]
+            ]
+            if not rows:
+                break
+
+            archive.append(rows)
+
+            with transaction.atomic():
+                hot.filter(id__gte=rows[0]["id"], id__lte=rows[-1]["id"]).delete()
+
+            archived += len(rows)
+            if pause:
+                time.sleep(pause)
+
+    return archived
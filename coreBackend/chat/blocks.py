@@ -0,0 +1,56 @@
+import os
+
+from django.conf import settings
+from django.db.models import Q
+
+from coreBackend.versioned_cache import VersionedCache
+
+from .models import Block
+
+
+class BlockCache(VersionedCache):
+    """
+    Per-process cache of the block graph:
+    user_id -> (ids this user blocked, ids that blocked this user).
+
+    Blocks change rarely, so every change bumps the shared version file
+    (coreBackend.versioned_cache) and all processes drop their cache.
+    A warm lookup costs no queries and is still correct across workers.
+    """
+
+    def get(self, user_id):
+        """
+        (blocking, blocked_by) sets for user_id.
+        """
+        return super().get(user_id, lambda: self._load(user_id))
+
+    def status(self, user_id, other_user_id):
+        """
+        (user blocked other, other blocked user)
+        """
+        blocking, blocked_by = self.get(int(user_id))
+        other_user_id = int(other_user_id)
+        return other_user_id in blocking, other_user_id in blocked_by
+
+    def is_blocked_either_way(self, user_id, other_user_id):
+        return any(self.status(user_id, other_user_id))
+
+    def _load(self, user_id):
+        blocking, blocked_by = set(), set()
+        rows = Block.objects.filter(
+            Q(blocker_id=user_id) | Q(blocked_id=user_id)
+        ).values_list("blocker_id", "blocked_id")
+
+        for blocker_id, blocked_id in rows:
+            if blocker_id == user_id:
+                blocking.add(blocked_id)
+            if blocked_id == user_id:
+                blocked_by.add(blocker_id)
+
+        return frozenset(blocking), frozenset(blocked_by)
+
+
+block_cache = BlockCache(
+    version_file=os.path.join(settings.LOCAL_STATE_DIR, "block_cache.version"),
+    max_entries=settings.BLOCK_CACHE_MAX_USERS,
+)
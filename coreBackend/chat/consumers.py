@@ -0,0 +1,208 @@
+import asyncio
+import json
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+
+from accounts.authentication import CachedJWTAuthentication
+from coreBackend.eventbus import get_bus
+from coreBackend.ratelimit import rate_limit_client
+
+from .devices import DEVICE_ID_RE, connect_device, disconnect_device
+from .ephemeral import STATE_RATE_LIMIT, signal_state
+from .realtime import notifier
+
+
+WEBSOCKET_PATH = "/ws/chat/"
+
+# Application-level close codes (4000-4999 are free for apps to use)
+CLOSE_NOT_FOUND = 4404
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_BAD_REQUEST = 4400
+
+
+def get_raw_token(scope):
+    """
+    Browsers can't set headers on a WebSocket handshake, so the access token
+    is read from ?token=..., falling back to a normal Authorization header.
+    """
+    query = parse_qs(scope.get("query_string", b"").decode())
+    if query.get("token"):
+        return query["token"][0].encode()
+
+    for name, value in scope.get("headers", []):
+        if name == b"authorization":
+            parts = value.split()
+            if len(parts) == 2 and parts[0] == b"Bearer":
+                return parts[1]
+    return None
+
+
+def sync_in_db(func):
+    """
+    sync_to_async for ORM work from the socket loop; doesn't keep the
+    DB connection open between calls.
+    """
+    def run(*args):
+        close_old_connections()
+        try:
+            return func(*args)
+        finally:
+            close_old_connections()
+    return sync_to_async(run)
+
+
+def parse_state_frame(text):
+    """
+    (receiver id, state, active) from a client "state" frame, or None if
+    the text is anything else.
+    """
+    try:
+        frame = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(frame, dict) or frame.get("type") != "state":
+        return None
+
+    receiver_id, state = frame.get("to"), frame.get("state", "typing")
+    if type(receiver_id) is not int or state not in settings.EPHEMERAL_STATES:
+        return None
+    return receiver_id, state, frame.get("active", True) is not False
+
+
+def set_state(ip, user_id, receiver_id, state, active):
+    """
+    signal_state() for a socket frame, under the same rate limit as
+    POST /api/chat/states/. Frames over the limit are dropped.
+    """
+    if rate_limit_client(ip, user_id, "ephemeral_state", STATE_RATE_LIMIT, 60):
+        return False
+    return signal_state(user_id, receiver_id, state, active)
+
+
+@sync_to_async
+def authenticate(raw_token):
+    """
+    Resolve a SimpleJWT access token to a user, same as the REST API does.
+    Returns None if the token is invalid or the user is gone / inactive.
+    """
+    close_old_connections()
+    try:
+        auth = CachedJWTAuthentication()
+        return auth.get_user(auth.get_validated_token(raw_token))
+    except (InvalidToken, AuthenticationFailed):
+        return None
+    finally:
+        close_old_connections()
+
+
+async def websocket_application(scope, receive, send):
+    """
+    ws://<host>/ws/chat/?token=<access token>
+
+    Server -> client frames are JSON events, e.g.
+    { "type": "message.created", "message": { ...MessageSerializer... } }
+
+    Client -> server: "ping" is answered with "pong";
+    { "type": "state", "to": 3, "state": "typing", "active": true } sets a
+    transient state for user 3 (chat.ephemeral; re-send it every few seconds
+    while it holds, "active": false to clear it), who gets the same event
+    with "sender" / "receiver" / "ttl". Rate limited like POST
+    /api/chat/states/; anything else is ignored.
+
+    With &device=<id> (stable per device, [A-Za-z0-9_-], up to 64 chars) the
+    server remembers what it delivered to that device; on reconnect it
+    first replays what the device missed (chat.devices), then goes live.
+    &after=<message id> overrides the remembered position.
+    """
+    message = await receive()
+    if message["type"] != "websocket.connect":
+        return
+
+    if scope["path"] != WEBSOCKET_PATH:
+        await send({"type": "websocket.close", "code": CLOSE_NOT_FOUND})
+        return
+
+    raw_token = get_raw_token(scope)
+    user = await authenticate(raw_token) if raw_token else None
+    if user is None:
+        await send({"type": "websocket.close", "code": CLOSE_UNAUTHORIZED})
+        return
+
+    query = parse_qs(scope.get("query_string", b"").decode())
+    device_id = query.get("device", [None])[0]
+    after = query.get("after", [None])[0]
+    if (device_id is not None and not DEVICE_ID_RE.match(device_id)) or (
+        after is not None and not after.isdigit()
+    ):
+        await send({"type": "websocket.close", "code": CLOSE_BAD_REQUEST})
+        return
+    after = int(after) if after is not None else None
+
+    client_ip = (scope.get("client") or ("unknown",))[0]
+
+    await send({"type": "websocket.accept"})
+    get_bus().start()  # a worker that only holds sockets must still receive
+
+    # Subscribe before looking up the gap so nothing falls in between;
+    # messages both replayed and queued live are sent once.
+    subscription = notifier.subscribe(user.id)
+    receive_task = event_task = None
+    cursor, replayed = 0, set()
+
+    try:
+        if device_id is not None:
+            cursor, missed = await sync_in_db(connect_device)(user, device_id, after)
+            for event in missed:
+                if event["type"] == "message.created":
+                    replayed.add(event["message"]["id"])
+                    cursor = max(cursor, event["message"]["id"])
+                await send({
+                    "type": "websocket.send",
+                    "text": json.dumps(event, cls=DjangoJSONEncoder),
+                })
+
+        receive_task = asyncio.ensure_future(receive())
+        event_task = asyncio.ensure_future(subscription.get())
+
+        while True:
+            done, _ = await asyncio.wait(
+                {receive_task, event_task},
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+
+            if receive_task in done:
+                message = receive_task.result()
+                if message["type"] == "websocket.disconnect":
+                    break
+                text = message.get("text")
+                if text == "ping":
+                    await send({"type": "websocket.send", "text": "pong"})
+                elif text:
+                    frame = parse_state_frame(text)
+                    if frame is not None and frame[0] != user.id:
+                        await sync_in_db(set_state)(client_ip, user.id, *frame)
+                receive_task = asyncio.ensure_future(receive())
+
+            if event_task in done:
+                event = event_task.result()
+                event_task = asyncio.ensure_future(subscription.get())
+                if event["type"] == "message.created":
+                    if event["message"]["id"] in replayed:
+                        continue
+                    cursor = max(cursor, event["message"]["id"])
+                await send({
+                    "type": "websocket.send",
+                    "text": json.dumps(event, cls=DjangoJSONEncoder),
+                })
+    finally:
+        for task in (receive_task, event_task):
+            if task is not None:
+                task.cancel()
+        subscription.close()
+        if device_id is not None:
+            await sync_in_db(disconnect_device)(user, device_id, cursor)
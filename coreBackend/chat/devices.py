@@ -0,0 +1,115 @@
+"""
+Delivery cursors for the devices of a user (chat.consumers).
+
+A user may have the chat open on several devices at once; every event of
+the user reaches all of their sockets in one fan-out (chat.events ->
+realtime.Notifier). A socket opened with ?device=<id> is also tracked in
+a Device row, so when that device reconnects it is sent just the gap:
+
+- message.created for every message of the user with id > its cursor,
+- messages.read (watermark + unread counter, both sides) for every
+  conversation that changed while it was away.
+"""
+import re
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Max, Q, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .events import messages_read_event
+from .models import Conversation, Device, Message
+from .serializers import message_rows, serialize_message_rows
+
+
+DEVICE_ID_RE = re.compile(r"^[\w-]{1,64}$")
+CLOCK_SKEW = timedelta(seconds=5)
+
+
+def connect_device(user, device_id, after=None):
+    """
+    Record that the device is connected. Returns (cursor, missed events,
+    oldest first); `after` (the newest message id the client has) takes
+    precedence over the stored cursor.
+
+    A device seen for the first time starts at the newest message: its
+    history comes from GET /api/chat/messages/ like before.
+    """
+    device, created = Device.objects.get_or_create(user=user, device_id=device_id)
+    away_since = device.disconnected_at or device.connected_at
+    update = {"connected_at": timezone.now()}
+    if created:
+        update["delivered_up_to"] = latest_message_id(user.id)
+    Device.objects.filter(pk=device.pk).update(**update)
+
+    if after is None:
+        if created:
+            return update["delivered_up_to"], []
+        after = device.delivered_up_to
+
+    events = missed_events(user.id, after, away_since)
+    if events and events[0]["type"] == "sync.reset":
+        after = latest_message_id(user.id)  # the reload covers everything so far
+    return after, events
+
+
+def disconnect_device(user, device_id, delivered_up_to):
+    Device.objects.filter(user=user, device_id=device_id).update(
+        delivered_up_to=Greatest("delivered_up_to", Value(delivered_up_to)),
+        disconnected_at=timezone.now(),
+    )
+
+
+def latest_message_id(user_id):
+    return Conversation.objects.filter(
+        Q(user_low_id=user_id) | Q(user_high_id=user_id)
+    ).aggregate(last=Max("last_message_id"))["last"] or 0
+
+
+def missed_events(user_id, after, since):
+    """
+    What happened to user_id's chats after message `after` / time `since`.
+    A device more than DEVICE_REPLAY_MAX messages behind gets a single
+    {"type": "sync.reset"} instead, and reloads through the REST API.
+    """
+    rows = list(message_rows(
+        Message.objects.filter(Q(sender_id=user_id) | Q(receiver_id=user_id), id__gt=after)
+        .order_by("id")[:settings.DEVICE_REPLAY_MAX + 1]
+    ))
+    if len(rows) > settings.DEVICE_REPLAY_MAX:
+        return [{"type": "sync.reset"}]
+
+    changed = Q(last_message_id__gt=after)
+    if since is not None:
+        # Workers' clocks may differ a little; resending a state is harmless
+        changed |= Q(updated_at__gte=since - CLOCK_SKEW)
+    conversations = list(
+        Conversation.objects.filter(Q(user_low_id=user_id) | Q(user_high_id=user_id))
+        .filter(changed)
+    )
+    watermarks = {conversation.key: conversation.read_watermarks() for conversation in conversations}
+
+    events = []
+    for row in rows:
+        key = Message.make_conversation_key(row["sender_id"], row["receiver_id"])
+        message = serialize_message_rows([row], watermarks.get(key, {}))[0]
+        events.append({"type": "message.created", "message": message})
+
+    for conversation in conversations:
+        for reader_id in {conversation.user_low_id, conversation.user_high_id}:
+            events.append(messages_read_event(conversation, reader_id))
+    return events
+
+
+def device_list(user_id):
+    return [
+        {
+            "device_id": device.device_id,
+            "connected": device.is_connected,
+            "delivered_up_to": device.delivered_up_to,
+            "connected_at": device.connected_at,
+            "disconnected_at": device.disconnected_at,
+        }
+        for device in Device.objects.filter(user_id=user_id).order_by("-connected_at")
+    ]
@@ -0,0 +1,149 @@
+"""
+Ephemeral per-pair states: "user is typing…" and the like.
+
+Nothing is stored in the database. A state lives in memory for
+EPHEMERAL_STATE_TTL seconds unless the sender refreshes it (clients
+re-send it every few seconds while it holds) or clears it. Every worker
+keeps a copy, filled from the event bus, so the receiver sees it pushed
+on their socket or via the poll fallback on whichever worker they hit.
+
+Setting a state is rate limited (STATE_RATE_LIMIT per minute, HTTP and
+socket together), and only users that exist can receive one; expired
+entries are swept out as new states come in, so the store stays bounded
+by what was set in the last TTL.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from coreBackend.eventbus import get_bus
+
+from .blocks import block_cache
+
+# State changes per minute, per user and per IP (rate_limit "ephemeral_state")
+STATE_RATE_LIMIT = 60
+
+
+class EphemeralStore:
+    """
+    receiver_id -> {(sender_id, state): expiry (time.monotonic())}
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._states = {}
+        self._next_sweep = time.monotonic() + ttl
+
+    def remaining(self, sender_id, receiver_id, state):
+        """
+        Seconds the state has left (0 if it isn't set).
+        """
+        with self._lock:
+            expires = self._states.get(receiver_id, {}).get((sender_id, state))
+        return max(expires - time.monotonic(), 0) if expires else 0
+
+    def apply(self, event):
+        """
+        A "state" event from the bus (any worker, this one included).
+        At most once per TTL, also drops every expired entry: receivers
+        that never poll would otherwise keep theirs forever.
+        """
+        key = (event["sender"], event["state"])
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_sweep:
+                self._sweep(now)
+            states = self._states.setdefault(event["receiver"], {})
+            if event["active"]:
+                states[key] = now + event["ttl"]
+            else:
+                states.pop(key, None)
+            if not states:
+                del self._states[event["receiver"]]
+
+    def _sweep(self, now):
+        for receiver_id, states in list(self._states.items()):
+            for key in [key for key, expires in states.items() if expires <= now]:
+                del states[key]
+            if not states:
+                del self._states[receiver_id]
+        self._next_sweep = now + self.ttl
+
+    def discard_sender(self, sender_id, receiver_id):
+        """
+        Drop every state sender_id set for receiver_id (e.g. the message
+        they were typing has arrived).
+        """
+        with self._lock:
+            states = self._states.get(receiver_id)
+            if not states:
+                return
+            for key in [key for key in states if key[0] == sender_id]:
+                del states[key]
+            if not states:
+                del self._states[receiver_id]
+
+    def for_receiver(self, receiver_id):
+        """
+        [(sender_id, state, seconds left), ...] currently set for receiver_id.
+        """
+        now = time.monotonic()
+        with self._lock:
+            states = self._states.get(receiver_id)
+            if not states:
+                return []
+            for key in [key for key, expires in states.items() if expires <= now]:
+                del states[key]
+            if not states:
+                del self._states[receiver_id]
+                return []
+            return [(sender_id, state, expires - now) for (sender_id, state), expires in states.items()]
+
+
+ephemeral_states = EphemeralStore(ttl=settings.EPHEMERAL_STATE_TTL)
+
+
+def signal_state(sender_id, receiver_id, state, active=True):
+    """
+    Set (or clear) `state` from sender_id for receiver_id, on every worker.
+    Returns False, and does nothing, if either user blocked the other or
+    receiver_id isn't an active user.
+
+    A refresh while most of the TTL is left isn't sent again, so a client
+    re-sending "typing" on every keystroke costs no bus traffic.
+    """
+    if block_cache.is_blocked_either_way(sender_id, receiver_id):
+        return False
+
+    remaining = ephemeral_states.remaining(sender_id, receiver_id, state)
+    if (active and remaining > ephemeral_states.ttl / 2) or (not active and not remaining):
+        return True
+    # Checked only when it is published (a set state proves it): made-up
+    # ids would otherwise fill every worker's store
+    if active and not remaining and not User.objects.filter(pk=receiver_id, is_active=True).exists():
+        return False
+
+    get_bus().publish({
+        "type": "state",
+        "sender": sender_id,
+        "receiver": receiver_id,
+        "state": state,
+        "active": active,
+        "ttl": ephemeral_states.ttl,
+    })
+    return True
+
+
+def states_for(receiver_id):
+    """
+    What the poll fallback returns: states set for receiver_id by users
+    not blocked either way (blocks may have changed since they were set).
+    """
+    return [
+        {"user_id": sender_id, "state": state, "expires_in": round(left, 1)}
+        for sender_id, state, left in ephemeral_states.for_receiver(receiver_id)
+        if not block_cache.is_blocked_either_way(receiver_id, sender_id)
+    ]
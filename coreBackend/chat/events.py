@@ -0,0 +1,74 @@
+"""
+What every worker does with the chat events on the bus (coreBackend.eventbus).
+The views and signals only publish; delivery happens here, in each process.
+"""
+from django.core.signals import request_started
+
+from coreBackend.eventbus import get_bus, start_listening
+
+from .blocks import block_cache
+from .ephemeral import ephemeral_states
+from .realtime import notifier
+
+
+def deliver(event):
+    """
+    Hand a message.created / messages.read / block.changed event to the
+    sockets and long-polls of the users it concerns that are open here.
+    """
+    if event["type"] == "message.created":
+        user_ids = {event["message"]["sender"], event["message"]["receiver"]}
+        # The message they were typing has arrived
+        ephemeral_states.discard_sender(event["message"]["sender"], event["message"]["receiver"])
+    else:
+        user_ids = set(event["user_ids"])
+
+    for user_id in user_ids:
+        notifier.publish(user_id, event)
+
+
+def block_changed(event):
+    # The version file covers missed events; this just makes it immediate
+    block_cache.clear()
+    deliver(event)
+
+
+def state_changed(event):
+    # Only the receiver is told; the sender's other devices don't need it
+    ephemeral_states.apply(event)
+    notifier.publish(event["receiver"], event)
+
+
+def connect():
+    bus = get_bus()
+    bus.subscribe("message.created", deliver)
+    bus.subscribe("messages.read", deliver)
+    bus.subscribe("block.changed", block_changed)
+    bus.subscribe("state", state_changed)
+    # Listen from the first request on, not at import (management commands, preforking)
+    request_started.connect(start_listening, dispatch_uid="eventbus.start_listening")
+
+
+def messages_read_event(conversation, reader_id):
+    """
+    reader_id's watermark (✓✓ for the sender) and unread counter in that
+    conversation, for all devices of both sides.
+    """
+    side = "low" if reader_id == conversation.user_low_id else "high"
+    return {
+        "type": "messages.read",
+        "reader": reader_id,
+        "user_ids": [conversation.user_low_id, conversation.user_high_id],
+        "up_to": getattr(conversation, f"last_read_{side}"),
+        "unread": getattr(conversation, f"unread_{side}"),
+    }
+
+
+def publish_block_changed(block, active):
+    get_bus().publish({
+        "type": "block.changed",
+        "blocker": block.blocker_id,
+        "blocked": block.blocked_id,
+        "active": active,
+        "user_ids": [block.blocker_id, block.blocked_id],
+    })
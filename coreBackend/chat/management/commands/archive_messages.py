@@ -0,0 +1,54 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.archive import archive_conversation
+from chat.models import Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Move messages older than MESSAGE_ARCHIVE_AFTER_DAYS into compressed "
+        "per-conversation segment files and delete them from the database in chunks. "
+        "Safe to interrupt and re-run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days", type=int, default=settings.MESSAGE_ARCHIVE_AFTER_DAYS,
+            help="Archive messages older than this many days.",
+        )
+        parser.add_argument(
+            "--chunk-size", type=int, default=500,
+            help="Rows per compressed block and per DELETE transaction.",
+        )
+        parser.add_argument(
+            "--pause", type=float, default=0,
+            help="Seconds to sleep between chunks, to keep the DB responsive.",
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["days"])
+
+        keys = (
+            Message.objects.filter(timestamp__lt=cutoff)
+            .order_by()
+            .values_list("conversation_key", flat=True)
+            .distinct()
+        )
+
+        total = conversations = 0
+        for key in list(keys):
+            archived = archive_conversation(
+                key, cutoff, chunk_size=options["chunk_size"], pause=options["pause"]
+            )
+            if archived:
+                conversations += 1
+                total += archived
+                self.stdout.write(f"{key}: {archived} message(s)")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {total} message(s) from {conversations} conversation(s) older than {cutoff:%Y-%m-%d}."
+        ))
@@ -0,0 +1,375 @@
+import io
+import json
+import random
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from rest_framework_simplejwt.tokens import AccessToken
+
+from accounts.models import Profile
+from accounts.presence import presence
+from chat.models import Message
+
+
+DEFAULT_MIX = "sidebar=15,poll=40,open=10,send=15,unread=10,presence=10"
+
+
+def percentile(sorted_values, p):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return None
+    rank = max(int(round(p / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name not in Workload.OPERATIONS:
+            raise CommandError(
+                f"Unknown operation {name!r}; choose from {', '.join(Workload.OPERATIONS)}"
+            )
+        mix[name] = float(weight or 1)
+    return mix
+
+
+class TestClientTransport:
+    """
+    Requests through Django's test client, in this process. Counts the
+    queries each request runs on this thread's connection.
+    """
+    counts_queries = True
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def request(self, method, path, token, body=None):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = Client()
+
+        queries = []
+
+        def count(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        headers = {"Authorization": f"Bearer {token}"}
+        with connection.execute_wrapper(count):
+            if method == "GET":
+                response = client.get(path, headers=headers)
+            else:
+                response = client.post(
+                    path, json.dumps(body), content_type="application/json", headers=headers
+                )
+        return response.status_code, response.content, len(queries)
+
+    def close(self):
+        connection.close()
+
+
+class HTTPTransport:
+    """
+    Requests to a running server (runserver, uvicorn, gunicorn...).
+    Query counts aren't visible from here.
+    """
+    counts_queries = False
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+
+    def request(self, method, path, token, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(
+            self.base_url + path,
+            data=data,
+            method=method,
+            headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return response.status, response.read(), None
+        except urllib.error.HTTPError as exc:
+            return exc.code, exc.read(), None
+
+    def close(self):
+        pass
+
+
+class Workload:
+    """
+    The seeded users and what each of them does. Every simulated request
+    picks a random user and one operation of the mix.
+    """
+    OPERATIONS = ("sidebar", "poll", "open", "send", "unread", "presence")
+
+    def __init__(self, users, contacts, tokens, seed):
+        self.users = users
+        self.contacts = contacts  # user_id -> [user_id, ...]
+        self.tokens = tokens
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.last_seen_ids = {}  # (user_id, other_id) -> newest message id seen
+
+    def next_request(self, operation):
+        with self.lock:
+            user_id = self.random.choice(self.users)
+            other_id = self.random.choice(self.contacts[user_id])
+            contacts = self.contacts[user_id]
+            after = self.last_seen_ids.get((user_id, other_id), 0)
+            text = f"benchmark {self.random.random():.6f}"
+
+        token = self.tokens[user_id]
+        if operation == "sidebar":
+            return "GET", "/api/users/", token, None, None
+        if operation == "poll":
+            path = f"/api/chat/messages/?user_id={other_id}&after={after}"
+            return "GET", path, token, None, (user_id, other_id)
+        if operation == "open":
+            return "GET", f"/api/chat/messages/?user_id={other_id}", token, None, (user_id, other_id)
+        if operation == "send":
+            body = {"receiver": other_id, "content": text}
+            return "POST", "/api/chat/messages/", token, body, None
+        if operation == "unread":
+            return "GET", "/api/chat/unread_counts/", token, None, None
+        ids = ",".join(str(contact) for contact in contacts)
+        return "GET", f"/api/presence/?ids={ids}", token, None, None
+
+    def remember(self, conversation, body):
+        # Polls continue from the newest message the client has seen
+        try:
+            messages = json.loads(body)
+        except ValueError:
+            return
+        if isinstance(messages, list) and messages:
+            with self.lock:
+                newest = max(self.last_seen_ids.get(conversation, 0), messages[-1]["id"])
+                self.last_seen_ids[conversation] = newest
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed users and messages with bulk inserts, drive a realistic mix of API "
+        "requests and report throughput, p50/p95/p99 latency and queries per "
+        "request for each endpoint as JSON. Runs against a throwaway test database "
+        "through Django's test client, or against a live server with --url "
+        "(seeding that server's database; start it with RATE_LIMIT_ENABLED=0)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=50)
+        parser.add_argument("--messages", type=int, default=10000)
+        parser.add_argument("--contacts", type=int, default=5, help="Conversations per user.")
+        parser.add_argument("--requests", type=int, default=2000)
+        parser.add_argument("--concurrency", type=int, default=4)
+        parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Weights, default {DEFAULT_MIX}")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--url", help="Base URL of a running server, e.g. http://127.0.0.1:8000")
+        parser.add_argument("--keep", action="store_true", help="--url mode: keep the seeded data.")
+        parser.add_argument("--output", help="Write the JSON report to this file (default: stdout).")
+
+    def handle(self, *args, **options):
+        mix = parse_mix(options["mix"])
+
+        if options["url"]:
+            transport = HTTPTransport(options["url"])
+            report = self.run(transport, mix, options)
+        else:
+            setup_test_environment()
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                with override_settings(RATE_LIMIT={**settings.RATE_LIMIT, "ENABLED": False}):
+                    report = self.run(TestClientTransport(), mix, options)
+            finally:
+                # Write pending heartbeats now, not at exit into a deleted DB
+                presence.flush(quiet=True)
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                teardown_test_environment()
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+            self.stderr.write(f"Report written to {options['output']}")
+        else:
+            self.stdout.write(output)
+
+    def run(self, transport, mix, options):
+        prefix = f"bench_{uuid.uuid4().hex[:6]}_"
+        started = time.perf_counter()
+        workload = self.seed(prefix, options)
+        seed_seconds = time.perf_counter() - started
+
+        try:
+            results, elapsed = self.drive(transport, workload, mix, options)
+        finally:
+            if options["url"] and not options["keep"]:
+                User.objects.filter(username__startswith=prefix).delete()
+
+        return {
+            "meta": {
+                "commit": self.git_commit(),
+                "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "target": options["url"] or "test-client",
+                "database": connection.vendor,
+                "users": options["users"],
+                "messages": options["messages"],
+                "requests": options["requests"],
+                "concurrency": options["concurrency"],
+                "mix": mix,
+                "seed": options["seed"],
+                "seed_seconds": round(seed_seconds, 3),
+            },
+            "total": self.summarize(
+                [sample for samples in results.values() for sample in samples],
+                elapsed,
+                transport.counts_queries,
+            ),
+            "endpoints": {
+                name: self.summarize(samples, elapsed, transport.counts_queries)
+                for name, samples in sorted(results.items())
+                if samples
+            },
+        }
+
+    def seed(self, prefix, options):
+        """
+        N users, each with `contacts` conversations, and M messages spread
+        over those conversations. Bulk inserts only.
+        """
+        rng = random.Random(options["seed"])
+        password = make_password("benchmark")  # hashing is slow; one hash for all
+
+        users = User.objects.bulk_create(
+            [User(username=f"{prefix}{i}", password=password) for i in range(options["users"])]
+        )
+        if not all(user.pk for user in users):  # backends without RETURNING
+            users = list(User.objects.filter(username__startswith=prefix).order_by("id"))
+        user_ids = [user.id for user in users]
+        Profile.objects.bulk_create([Profile(user_id=user_id) for user_id in user_ids])
+
+        contacts = defaultdict(set)
+        for user_id in user_ids:
+            others = [other for other in user_ids if other != user_id]
+            for other in rng.sample(others, min(options["contacts"], len(others))):
+                contacts[user_id].add(other)
+                contacts[other].add(user_id)
+        pairs = sorted({tuple(sorted((a, b))) for a in contacts for b in contacts[a]})
+
+        messages = []
+        for i in range(options["messages"]):
+            sender, receiver = rng.choice(pairs)
+            if rng.random() < 0.5:
+                sender, receiver = receiver, sender
+            messages.append(Message(
+                sender_id=sender,
+                receiver_id=receiver,
+                content=f"seed message {i}",
+                conversation_key=Message.make_conversation_key(sender, receiver),
+            ))
+        Message.objects.bulk_create(messages, batch_size=1000)
+
+        # Conversation rows (sidebar, unread counters) for the seeded messages
+        call_command("rebuild_unread_counts", stdout=io.StringIO())
+
+        tokens = {user_id: str(AccessToken.for_user(user)) for user_id, user in zip(user_ids, users)}
+        return Workload(
+            user_ids,
+            {user_id: sorted(others) for user_id, others in contacts.items()},
+            tokens,
+            options["seed"],
+        )
+
+    def drive(self, transport, workload, mix, options):
+        rng = random.Random(options["seed"])
+        operations = rng.choices(list(mix), weights=list(mix.values()), k=options["requests"])
+        queue = iter(operations)
+        queue_lock = threading.Lock()
+        results = {operation: [] for operation in mix}  # -> [(seconds, status, queries)]
+        errors = []
+
+        def worker():
+            try:
+                while True:
+                    with queue_lock:
+                        operation = next(queue, None)
+                    if operation is None:
+                        return
+
+                    method, path, token, body, conversation = workload.next_request(operation)
+                    start = time.perf_counter()
+                    status, content, queries = transport.request(method, path, token, body)
+                    seconds = time.perf_counter() - start
+
+                    results[operation].append((seconds, status, queries))
+                    if conversation and status == 200:
+                        workload.remember(conversation, content)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                transport.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(options["concurrency"])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        if errors:
+            raise CommandError(f"Benchmark worker failed: {errors[0]!r}")
+        return results, elapsed
+
+    @staticmethod
+    def summarize(samples, elapsed, counts_queries):
+        latencies = sorted(seconds * 1000 for seconds, _, _ in samples)
+        summary = {
+            "requests": len(samples),
+            "throughput_rps": round(len(samples) / elapsed, 1) if elapsed else None,
+            "status": dict(Counter(str(status) for _, status, _ in samples)),
+            "latency_ms": {
+                "mean": round(sum(latencies) / len(latencies), 3) if latencies else None,
+                "p50": round(percentile(latencies, 50), 3) if latencies else None,
+                "p95": round(percentile(latencies, 95), 3) if latencies else None,
+                "p99": round(percentile(latencies, 99), 3) if latencies else None,
+                "max": round(latencies[-1], 3) if latencies else None,
+            },
+            "queries_per_request": None,
+        }
+        if counts_queries and samples:
+            queries = [count for _, _, count in samples]
+            summary["queries_per_request"] = {
+                "mean": round(sum(queries) / len(queries), 2),
+                "max": max(queries),
+            }
+        return summary
+
+    @staticmethod
+    def git_commit():
+        try:
+            return subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=settings.BASE_DIR,
+                capture_output=True,
+                text=True,
+                timeout=5,
+            ).stdout.strip() or None
+        except (OSError, subprocess.SubprocessError):
+            return None
@@ -0,0 +1,104 @@
+import json
+import time
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from rest_framework.renderers import JSONRenderer
+
+from chat.models import Conversation, Message
+from chat.serializers import MessageSerializer, message_rows, serialize_message_rows
+from coreBackend.renderers import FastJSONRenderer
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the per-message cost of rendering a conversation with "
+        "MessageSerializer (model instances, per-row user lookups) and with the "
+        "values() fast path used by GET /api/chat/messages/. "
+        "Works on throwaway rows inside a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+        parser.add_argument("--repeat", type=int, default=3, help="Best of N runs.")
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                for size in options["sizes"]:
+                    self.run(size, options["repeat"])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, size, repeat):
+        tag = uuid.uuid4().hex[:8]
+        alice = User.objects.create_user(f"bench-{tag}-a")
+        bob = User.objects.create_user(f"bench-{tag}-b")
+        key = Message.make_conversation_key(alice.id, bob.id)
+
+        Message.objects.bulk_create(
+            [
+                Message(
+                    sender=alice if i % 2 else bob,
+                    receiver=bob if i % 2 else alice,
+                    content=f"benchmark message {i} " + "x" * (i % 80),
+                    conversation_key=key,
+                )
+                for i in range(size)
+            ],
+            batch_size=1000,
+        )
+        ids = list(Message.objects.filter(conversation_key=key).order_by("id").values_list("id", flat=True))
+        conversation = Conversation.objects.create(
+            user_low_id=min(alice.id, bob.id),
+            user_high_id=max(alice.id, bob.id),
+            last_read_low=ids[size // 2],
+            last_read_high=ids[-1],
+        )
+        watermarks = conversation.read_watermarks()
+        qs = Message.objects.filter(conversation_key=key).order_by("id")
+
+        def serializer_path():
+            messages = list(qs.all())
+            data = MessageSerializer(
+                messages, many=True, context={"read_watermarks": {key: watermarks}}
+            ).data
+            return JSONRenderer().render(data)
+
+        def fast_path():
+            return FastJSONRenderer().render(
+                serialize_message_rows(list(message_rows(qs.all())), watermarks)
+            )
+
+        results = {}
+        for name, render in (("serializer", serializer_path), ("fast", fast_path)):
+            best = None
+            for _ in range(repeat):
+                queries = []
+                with connection.execute_wrapper(
+                    lambda execute, sql, *args: queries.append(sql) or execute(sql, *args)
+                ):
+                    start = time.perf_counter()
+                    body = render()
+                    elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            results[name] = (best, len(queries), body)
+
+        if json.loads(results["serializer"][2]) != json.loads(results["fast"][2]):
+            self.stderr.write(self.style.ERROR(f"{size} messages: outputs differ!"))
+
+        for name, (elapsed, query_count, _) in results.items():
+            self.stdout.write(
+                f"{size:>7} messages  {name:<10}  {elapsed * 1e6 / size:8.1f} µs/message"
+                f"  {elapsed * 1000:8.1f} ms total  {query_count:>6} queries"
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f"{size:>7} messages  speed-up x{results['serializer'][0] / results['fast'][0]:.1f}"
+        ))
@@ -0,0 +1,92 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.retention import Checkpoint, run_retention
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete messages past the retention policies (MESSAGE_RETENTION_DAYS, "
+        "MESSAGE_RETENTION_MAX_PER_CONVERSATION) from the database and cold storage, "
+        "in small chunks with a pause in between. An interrupted run resumes where "
+        "it stopped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days", type=int, default=settings.MESSAGE_RETENTION_DAYS,
+            help="Delete messages older than this many days (0 = no age limit).",
+        )
+        parser.add_argument(
+            "--max-per-conversation", type=int,
+            default=settings.MESSAGE_RETENTION_MAX_PER_CONVERSATION,
+            help="Keep only the newest N messages of each conversation (0 = no limit).",
+        )
+        parser.add_argument(
+            "--chunk-size", type=int, default=settings.MESSAGE_PURGE_CHUNK_SIZE,
+            help="Rows per DELETE transaction.",
+        )
+        parser.add_argument(
+            "--pause", type=float, default=settings.MESSAGE_PURGE_PAUSE,
+            help="Seconds to sleep between chunks, to keep the DB responsive.",
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="Only report how many messages would be deleted.",
+        )
+        parser.add_argument(
+            "--restart", action="store_true",
+            help="Ignore the checkpoint of an interrupted run and start over.",
+        )
+        parser.add_argument(
+            "--every", type=float, metavar="SECONDS",
+            help="Keep running, starting a new pass every SECONDS.",
+        )
+
+    def handle(self, *args, **options):
+        if not options["days"] and not options["max_per_conversation"]:
+            raise CommandError(
+                "No retention policy: set MESSAGE_RETENTION_DAYS / "
+                "MESSAGE_RETENTION_MAX_PER_CONVERSATION or pass --days / --max-per-conversation."
+            )
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be at least 1.")
+
+        checkpoint = Checkpoint(os.path.join(settings.LOCAL_STATE_DIR, "purge_messages.json"))
+
+        while True:
+            started = time.monotonic()
+            self.run_pass(checkpoint, options)
+            if not options["every"]:
+                return
+            time.sleep(max(options["every"] - (time.monotonic() - started), 0))
+
+    def run_pass(self, checkpoint, options):
+        state = None if options["dry_run"] or options["restart"] else checkpoint.load()
+        policies = (options["days"], options["max_per_conversation"])
+        if state and (state["max_age_days"], state["max_messages"]) == policies:
+            self.stdout.write(
+                f"Resuming an interrupted run ({state['removed']} message(s) deleted so far)."
+            )
+
+        total = conversations = 0
+        for conversation, removed in run_retention(
+            options["days"],
+            options["max_per_conversation"],
+            checkpoint,
+            chunk_size=options["chunk_size"],
+            pause=options["pause"],
+            dry_run=options["dry_run"],
+            restart=options["restart"],
+        ):
+            conversations += 1
+            total += removed
+            self.stdout.write(f"{conversation.key}: {removed} message(s)")
+
+        verb = "Would delete" if options["dry_run"] else "Deleted"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {total} message(s) from {conversations} conversation(s)."
+        ))
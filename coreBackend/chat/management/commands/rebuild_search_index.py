@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from chat.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the message full-text index from the Message table in one pass. "
+        "Also restores the sync triggers if a table rebuild dropped them."
+    )
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Search index rebuilt ({type(backend).__name__})."))
@@ -0,0 +1,135 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import CharField, Count, IntegerField, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Concat
+from django.utils import timezone
+
+from chat.models import Message, Conversation
+
+
+def unread_subquery(receiver_field, watermark_field):
+    """
+    COUNT of messages in the outer conversation sent to `receiver_field`
+    after that side's read watermark.
+    """
+    return Coalesce(
+        Subquery(
+            Message.objects.filter(
+                conversation_key=OuterRef("key"),
+                receiver_id=OuterRef(receiver_field),
+                id__gt=OuterRef(watermark_field),
+            )
+            .order_by()
+            .values("conversation_key")
+            .annotate(count=Count("id"))
+            .values("count"),
+            output_field=IntegerField(),
+        ),
+        0,
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute Conversation.unread_low / unread_high from the Message table "
+        "and the read watermarks, and fix rows that drifted. Use --verify to only report."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--verify",
+            action="store_true",
+            help="Only report mismatches; exit with an error if any are found.",
+        )
+
+    def handle(self, *args, **options):
+        verify = options["verify"]
+
+        conversations = (
+            Conversation.objects.annotate(
+                key=Concat("user_low_id", Value(":"), "user_high_id", output_field=CharField()),
+            )
+            .annotate(
+                expected_low=unread_subquery("user_low_id", "last_read_low"),
+                expected_high=unread_subquery("user_high_id", "last_read_high"),
+            )
+            .values_list(
+                "id", "key", "unread_low", "unread_high", "expected_low", "expected_high"
+            )
+        )
+
+        mismatched = []
+        seen = set()
+        for pk, key, unread_low, unread_high, expected_low, expected_high in conversations.iterator():
+            seen.add(key)
+            if (unread_low, unread_high) != (expected_low, expected_high):
+                mismatched.append((pk, key, (unread_low, unread_high), (expected_low, expected_high)))
+
+        # Pairs that have messages but no Conversation row at all
+        missing = sorted(
+            set(Message.objects.order_by().values_list("conversation_key", flat=True).distinct())
+            - seen
+        )
+
+        for pk, key, have, want in mismatched:
+            self.stdout.write(f"{key} has {have}, expected {want}")
+        for key in missing:
+            self.stdout.write(f"{key} has no Conversation row")
+
+        problems = len(mismatched) + len(missing)
+
+        if verify:
+            if problems:
+                raise CommandError(f"{problems} conversation(s) out of sync.")
+            self.stdout.write(self.style.SUCCESS("Unread counters are in sync."))
+            return
+
+        with transaction.atomic():
+            for pk, key, have, want in mismatched:
+                Conversation.objects.filter(pk=pk).update(
+                    unread_low=want[0],
+                    unread_high=want[1],
+                    updated_at=timezone.now(),
+                )
+
+            if missing:
+                self.create_missing(missing)
+
+        self.stdout.write(self.style.SUCCESS(f"Fixed {problems} conversation(s)."))
+
+    def create_missing(self, keys):
+        """
+        New rows start with nothing read, so every message counts as unread.
+        """
+        last_ids = (
+            Message.objects.filter(conversation_key__in=keys)
+            .values("conversation_key")
+            .annotate(last_id=Max("id"))
+            .values_list("last_id", flat=True)
+        )
+        last_messages = {
+            message.conversation_key: message
+            for message in Message.objects.filter(id__in=list(last_ids))
+        }
+
+        received = {
+            (row["conversation_key"], row["receiver_id"]): row["count"]
+            for row in Message.objects.filter(conversation_key__in=keys)
+            .values("conversation_key", "receiver_id")
+            .annotate(count=Count("id"))
+        }
+
+        conversations = []
+        for key in keys:
+            user_low, user_high = (int(user_id) for user_id in key.split(":"))
+            last_message = last_messages[key]
+            conversations.append(Conversation(
+                user_low_id=user_low,
+                user_high_id=user_high,
+                last_message=last_message,
+                last_message_preview=Conversation.make_preview(last_message.content),
+                last_message_time=last_message.timestamp,
+                unread_low=received.get((key, user_low), 0),
+                unread_high=received.get((key, user_high), 0) if user_high != user_low else 0,
+            ))
+        Conversation.objects.bulk_create(conversations, ignore_conflicts=True)
@@ -0,0 +1,69 @@
+# Generated by Django 5.2.8 on 2026-10-17 01:56
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+PREVIEW_LENGTH = 40
+
+
+def backfill_conversations(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    Conversation = apps.get_model('chat', 'Conversation')
+
+    conversations = {}
+    rows = Message.objects.order_by('id').values_list(
+        'id', 'sender_id', 'receiver_id', 'content', 'timestamp', 'is_read'
+    )
+    for msg_id, sender_id, receiver_id, content, timestamp, is_read in rows.iterator():
+        user_low, user_high = sorted((sender_id, receiver_id))
+        conversation = conversations.get((user_low, user_high))
+        if conversation is None:
+            conversation = conversations[(user_low, user_high)] = Conversation(
+                user_low_id=user_low,
+                user_high_id=user_high,
+            )
+
+        if len(content) > PREVIEW_LENGTH:
+            content = content[:PREVIEW_LENGTH] + "…"
+
+        conversation.last_message_id = msg_id
+        conversation.last_message_preview = content
+        conversation.last_message_time = timestamp
+
+        if not is_read:
+            if receiver_id == user_low:
+                conversation.unread_low += 1
+            else:
+                conversation.unread_high += 1
+
+    Conversation.objects.bulk_create(conversations.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_block'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_message_preview', models.CharField(blank=True, max_length=41)),
+                ('last_message_time', models.DateTimeField(blank=True, null=True)),
+                ('unread_low', models.PositiveIntegerField(default=0)),
+                ('unread_high', models.PositiveIntegerField(default=0)),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message')),
+                ('user_high', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversations_as_high', to=settings.AUTH_USER_MODEL)),
+                ('user_low', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversations_as_low', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user_low', 'user_high')},
+            },
+        ),
+        migrations.RunPython(backfill_conversations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+from django.db import migrations, models
+
+
+def backfill_conversation_key(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+
+    pairs = Message.objects.values_list('sender_id', 'receiver_id').distinct()
+    for sender_id, receiver_id in pairs.iterator():
+        user_low, user_high = sorted((sender_id, receiver_id))
+        Message.objects.filter(sender_id=sender_id, receiver_id=receiver_id).update(
+            conversation_key=f"{user_low}:{user_high}"
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_conversation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='conversation_key',
+            field=models.CharField(default='', editable=False, max_length=41),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_conversation_key, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation_key', 'id'], name='chat_msg_conversation_idx'),
+        ),
+    ]
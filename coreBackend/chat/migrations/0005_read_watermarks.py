@@ -0,0 +1,48 @@
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def set_watermarks(apps, schema_editor):
+    """
+    Messages were marked read all at once when a chat was opened, so the
+    newest read message of each receiver is their watermark.
+    """
+    Message = apps.get_model('chat', 'Message')
+    Conversation = apps.get_model('chat', 'Conversation')
+
+    last_read = (
+        Message.objects.filter(is_read=True)
+        .values('conversation_key', 'receiver_id')
+        .annotate(last_id=Max('id'))
+    )
+    for row in last_read.iterator():
+        user_low, user_high = (int(user_id) for user_id in row['conversation_key'].split(':'))
+        field = 'last_read_low' if row['receiver_id'] == user_low else 'last_read_high'
+        Conversation.objects.filter(user_low_id=user_low, user_high_id=user_high).update(
+            **{field: row['last_id']}
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_message_conversation_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_read_low',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_read_high',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(set_watermarks, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
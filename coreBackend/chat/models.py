@@ -1,4 +1,5 @@
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from django.contrib.auth.models import User
 
 
@@ -11,14 +12,28 @@ class Message(models.Model):
     )
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
-    is_read = models.BooleanField(default=False)
+    # "<low user id>:<high user id>", same for both directions of a chat
+    conversation_key = models.CharField(max_length=41, editable=False)
 
     class Meta:
         ordering = ['timestamp']  # oldest → newest
+        indexes = [
+            models.Index(fields=['conversation_key', 'id'], name='chat_msg_conversation_idx'),
+        ]
 
     def __str__(self):
         return f"{self.sender.username} -> {self.receiver.username}: {self.content[:20]}"
 
+    def save(self, *args, **kwargs):
+        if not self.conversation_key:
+            self.conversation_key = self.make_conversation_key(self.sender_id, self.receiver_id)
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def make_conversation_key(user_id, other_user_id):
+        user_low, user_high = sorted((int(user_id), int(other_user_id)))
+        return f"{user_low}:{user_high}"
+
 
 class Block(models.Model):
     blocker = models.ForeignKey(
@@ -33,4 +48,240 @@ class Block(models.Model):
         unique_together = ('blocker', 'blocked')
 
     def __str__(self):
-        return f"{self.blocker.username} blocked {self.blocked.username}"
\ No newline at end of file
+        return f"{self.blocker.username} blocked {self.blocked.username}"
+
+
+class ConversationManager(models.Manager):
+    def for_pair(self, user_id, other_user_id):
+        user_low, user_high = sorted((int(user_id), int(other_user_id)))
+        return self.filter(user_low_id=user_low, user_high_id=user_high)
+
+    def record_message(self, message):
+        """
+        Update the conversation row for a freshly saved message.
+        Best called inside the same transaction that created the message.
+        """
+        self.record_messages([message])
+
+    def record_messages(self, messages):
+        """
+        Same as record_message() for a batch (e.g. after bulk_create):
+        one locked get_or_create + one UPDATE per conversation.
+
+        Runs in its own atomic block (a savepoint when already in one): the
+        post_save signal calls it in autocommit too, and select_for_update()
+        needs a transaction (PostgreSQL).
+        """
+        by_pair = {}
+        for message in sorted(messages, key=lambda m: m.id):
+            pair = tuple(sorted((message.sender_id, message.receiver_id)))
+            by_pair.setdefault(pair, []).append(message)
+
+        with transaction.atomic():
+            for (user_low, user_high), pair_messages in by_pair.items():
+                conversation, _ = self.select_for_update().get_or_create(
+                    user_low_id=user_low,
+                    user_high_id=user_high,
+                )
+
+                unread = {"unread_low": 0, "unread_high": 0}
+                for message in pair_messages:
+                    unread["unread_low" if message.receiver_id == user_low else "unread_high"] += 1
+
+                update = {
+                    field: models.F(field) + count
+                    for field, count in unread.items() if count
+                }
+                # Concurrent sends may get the lock in another order than their
+                # ids (PostgreSQL): never move the preview back to an older one
+                last = pair_messages[-1]
+                if conversation.last_message_id is None or last.id > conversation.last_message_id:
+                    update.update(
+                        last_message=last,
+                        last_message_preview=Conversation.make_preview(last.content),
+                        last_message_time=last.timestamp,
+                    )
+                self.filter(pk=conversation.pk).update(updated_at=timezone.now(), **update)
+
+    def mark_read(self, reader_id, other_user_id, up_to=None):
+        """
+        Move the reader's read watermark forward to message id `up_to`
+        (default: the last message) and recompute their unread counter.
+
+        Only the conversation row is written (no per-message flags). It is
+        checked with a plain read first: a poll that doesn't move the
+        watermark takes no lock (on SQLite, no write transaction). Otherwise
+        the row is locked so a concurrent record_message() can't be lost.
+        Returns (conversation, changed); conversation is None if the two
+        users never exchanged a message.
+        """
+        reader_id, other_user_id = int(reader_id), int(other_user_id)
+        side = "low" if reader_id <= other_user_id else "high"
+
+        conversation = self.for_pair(reader_id, other_user_id).first()
+        if conversation is None:
+            return None, False
+        if conversation.read_target(up_to) <= getattr(conversation, f"last_read_{side}"):
+            return conversation, False
+
+        with transaction.atomic():
+            conversation = self.for_pair(reader_id, other_user_id).select_for_update().first()
+
+            last_id = conversation.read_target()
+            up_to = last_id if up_to is None else min(up_to, last_id)
+            if up_to <= getattr(conversation, f"last_read_{side}"):
+                return conversation, False
+
+            if up_to == last_id:
+                unread = 0
+            else:
+                unread = Message.objects.filter(
+                    conversation_key=conversation.key,
+                    receiver_id=reader_id,
+                    id__gt=up_to,
+                ).count()
+
+            setattr(conversation, f"last_read_{side}", up_to)
+            setattr(conversation, f"unread_{side}", unread)
+            conversation.save(update_fields=[f"last_read_{side}", f"unread_{side}", "updated_at"])
+
+        return conversation, True
+
+    def unread_counts(self, user_id):
+        """
+        [(other_user_id, count), ...] for every conversation where user_id
+        has unread messages.
+        """
+        rows = self.filter(
+            models.Q(user_low_id=user_id, unread_low__gt=0)
+            | models.Q(user_high_id=user_id, unread_high__gt=0)
+        ).values_list("user_low_id", "user_high_id", "unread_low", "unread_high")
+
+        return [
+            (user_high, unread_low) if user_low == user_id else (user_low, unread_high)
+            for user_low, user_high, unread_low, unread_high in rows
+        ]
+
+    def version(self, user_id):
+        """
+        A value that changes whenever anything in user_id's conversations
+        does: a new conversation, a new message, a read or a counter
+        update. One aggregate query; used for ETags (coreBackend.conditional).
+        """
+        return tuple(
+            self.filter(models.Q(user_low_id=user_id) | models.Q(user_high_id=user_id))
+            .aggregate(
+                count=models.Count("id"),
+                last_message=models.Max("last_message_id"),
+                read_low=models.Sum("last_read_low"),
+                read_high=models.Sum("last_read_high"),
+                unread_low=models.Sum("unread_low"),
+                unread_high=models.Sum("unread_high"),
+            )
+            .values()
+        )
+
+
+class Conversation(models.Model):
+    """
+    One row per pair of users who have exchanged messages, kept up to date
+    when a Message is created. Serves the sidebar without touching Message.
+
+    The pair is stored ordered: user_low.id < user_high.id.
+    last_read_low / last_read_high = id of the last message that side has
+    read (a message is read iff its id <= its receiver's watermark).
+    unread_low / unread_high = messages not yet read by that side.
+    updated_at = last time any of that changed (device resync, chat.devices).
+    """
+    PREVIEW_LENGTH = 40
+
+    user_low = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="conversations_as_low"
+    )
+    user_high = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="conversations_as_high"
+    )
+    last_message = models.ForeignKey(
+        Message, on_delete=models.SET_NULL, null=True, blank=True, related_name="+"
+    )
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH + 1, blank=True)
+    last_message_time = models.DateTimeField(null=True, blank=True)
+    unread_low = models.PositiveIntegerField(default=0)
+    unread_high = models.PositiveIntegerField(default=0)
+    last_read_low = models.BigIntegerField(default=0)
+    last_read_high = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ConversationManager()
+
+    class Meta:
+        unique_together = ('user_low', 'user_high')
+
+    def __str__(self):
+        return f"{self.user_low_id} <-> {self.user_high_id}"
+
+    @property
+    def key(self):
+        return f"{self.user_low_id}:{self.user_high_id}"
+
+    def read_watermarks(self):
+        """
+        {user_id: id of the last message that user has read}
+        """
+        return {
+            self.user_low_id: self.last_read_low,
+            self.user_high_id: self.last_read_high,
+        }
+
+    def read_target(self, up_to=None):
+        """
+        Where mark_read() moves a watermark to: `up_to`, at most the last message.
+        """
+        last_id = self.last_message_id or self.latest_message_id()
+        if up_to is None or up_to > last_id:
+            return last_id
+        return up_to
+
+    def latest_message_id(self):
+        from .archive import get_archive
+
+        # The last message may have been moved to cold storage
+        return (
+            Message.objects.filter(conversation_key=self.key)
+            .order_by("-id")
+            .values_list("id", flat=True)
+            .first()
+        ) or get_archive(self.key).last_id
+
+    @classmethod
+    def make_preview(cls, text):
+        if len(text) > cls.PREVIEW_LENGTH:
+            return text[:cls.PREVIEW_LENGTH] + "…"
+        return text
+
+
+class Device(models.Model):
+    """
+    A client of a user (phone, laptop...) that connects to the WebSocket
+    with ?device=<id>. One row per device, across all workers.
+
+    delivered_up_to = id of the newest message pushed to it, so when it
+    reconnects only what it missed is replayed (chat.devices).
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="devices")
+    device_id = models.CharField(max_length=64)
+    delivered_up_to = models.BigIntegerField(default=0)
+    connected_at = models.DateTimeField(null=True, blank=True)
+    disconnected_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ('user', 'device_id')
+
+    def __str__(self):
+        return f"{self.user_id}/{self.device_id}"
+
+    @property
+    def is_connected(self):
+        return self.connected_at is not None and (
+            self.disconnected_at is None or self.disconnected_at < self.connected_at
+        )
@@ -0,0 +1,94 @@
+import asyncio
+import threading
+from collections import defaultdict
+
+
+class Subscription:
+    """
+    One open client (a WebSocket connection or a parked long-poll request)
+    waiting for events of a user.
+    Must be created from inside the event loop that will consume it.
+    """
+
+    def __init__(self, notifier, user_id):
+        self.notifier = notifier
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+
+    def push(self, event):
+        # publish() may run in a worker thread (sync views), so hand the
+        # event over to the subscriber's own loop.
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+        except RuntimeError:
+            # Loop already closed -> the client is gone.
+            self.close()
+
+    async def get(self):
+        return await self.queue.get()
+
+    async def wait_for(self, predicate, timeout):
+        """
+        Wait up to `timeout` seconds for an event matching `predicate`.
+        Returns the event, or None on timeout.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            try:
+                event = await asyncio.wait_for(self.queue.get(), remaining)
+            except asyncio.TimeoutError:
+                return None
+            if predicate(event):
+                return event
+
+    def close(self):
+        self.notifier.unsubscribe(self)
+
+
+class Notifier:
+    """
+    In-process registry of open subscriptions, keyed by user id.
+    Used by the WebSocket endpoint and the long-poll mode of the message list.
+
+    Views call publish() after a write; every subscription of that user
+    receives the event. Safe to call from sync and async code.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+
+    def subscribe(self, user_id):
+        subscription = Subscription(self, user_id)
+        with self._lock:
+            self._subscribers[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subs = self._subscribers.get(subscription.user_id)
+            if subs is None:
+                return
+            subs.discard(subscription)
+            if not subs:
+                del self._subscribers[subscription.user_id]
+
+    def is_connected(self, user_id):
+        with self._lock:
+            return bool(self._subscribers.get(user_id))
+
+    def publish(self, user_id, event):
+        with self._lock:
+            subs = list(self._subscribers.get(user_id, ()))
+
+        for subscription in subs:
+            subscription.push(event)
+
+
+notifier = Notifier()
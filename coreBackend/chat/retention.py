@@ -0,0 +1,240 @@
+"""
+Message retention.
+
+Two policies, both optional (settings, 0 = no limit):
+
+- MESSAGE_RETENTION_DAYS: messages older than this are deleted.
+- MESSAGE_RETENTION_MAX_PER_CONVERSATION: only the newest N messages of a
+  conversation are kept.
+
+Conversations are purged one at a time, oldest messages first, both from
+cold storage (chat.archive, block by block) and from the Message table.
+Table rows go in id-ordered chunks, each in its own short transaction that
+also takes the deleted unread messages off the Conversation counters, with
+a pause between chunks so foreground requests keep getting the database.
+
+A run records how far it got in a checkpoint file; an interrupted run
+picks up at the next conversation (with the same cutoff) when started again.
+"""
+import json
+import os
+import time
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F, Q, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .archive import get_archive
+from .models import Conversation, Message
+
+
+CONVERSATION_PAGE_SIZE = 500
+
+
+def purge_boundary(conversation_key, archive, cutoff=None, max_messages=0):
+    """
+    Id of the newest message of the conversation the policies remove
+    (everything up to it goes), or 0 if nothing has to go.
+    """
+    hot = Message.objects.filter(conversation_key=conversation_key)
+    boundary = 0
+
+    if cutoff is not None:
+        boundary = (
+            hot.filter(timestamp__lt=cutoff).order_by("-id").values_list("id", flat=True).first()
+            or archived_before(archive, cutoff)
+        )
+
+    if max_messages:
+        archived = sum(entry["count"] for entry in archive.entries())
+        excess = archived + hot.count() - max_messages
+        if excess > archived:
+            boundary = max(
+                boundary,
+                hot.order_by("id").values_list("id", flat=True)[excess - archived - 1],
+            )
+        elif excess > 0:
+            boundary = max(boundary, nth_archived_id(archive, excess))
+
+    return boundary
+
+
+def archived_before(archive, cutoff):
+    """
+    Id of the newest archived row older than `cutoff` (0 if none).
+    Reads blocks from the oldest one until it reaches newer rows.
+    """
+    found = 0
+    for entry in archive.entries():
+        for row in archive.read_block(entry):
+            if parse_datetime(row["timestamp"]) >= cutoff:
+                return found
+            found = row["id"]
+    return found
+
+
+def nth_archived_id(archive, n):
+    for entry in archive.entries():
+        if n <= entry["count"]:
+            return archive.read_block(entry)[n - 1]["id"]
+        n -= entry["count"]
+    return archive.last_id
+
+
+def purge_conversation(conversation, cutoff=None, max_messages=0, chunk_size=500, pause=0, dry_run=False):
+    """
+    Apply the policies to one conversation. Returns the number of messages
+    removed (or, with dry_run, that would be).
+    """
+    key = conversation.key
+    archive = get_archive(key)
+    boundary = purge_boundary(key, archive, cutoff, max_messages)
+    if not boundary:
+        return 0
+
+    hot = Message.objects.filter(conversation_key=key, id__lte=boundary)
+    if dry_run:
+        return hot.count() + archive.count_through(boundary)
+
+    removed = 0
+    if archive.entries():
+        with archive.lock():
+            # Only rows above a read watermark can be unread; read just those blocks
+            read_up_to = min(conversation.last_read_low, conversation.last_read_high)
+            rows = [
+                (row["id"], row["receiver"])
+                for entry in archive.entries()
+                if entry["first_id"] <= boundary and entry["last_id"] > read_up_to
+                for row in archive.read_block(entry)
+                if read_up_to < row["id"] <= boundary
+            ]
+            removed += archive.drop_through(boundary)
+            with transaction.atomic():
+                forget_messages(conversation.pk, rows)
+
+    while True:
+        rows = list(hot.order_by("id").values_list("id", "receiver_id")[:chunk_size])
+        if not rows:
+            break
+
+        with transaction.atomic():
+            forget_messages(conversation.pk, rows)
+            Message.objects.filter(id__in=[message_id for message_id, _ in rows]).delete()
+        removed += len(rows)
+
+        if pause:
+            time.sleep(pause)
+
+    return removed
+
+
+def forget_messages(conversation_pk, rows):
+    """
+    Fix the Conversation row for deleted (id, receiver_id) rows: unread
+    counters lose the deleted unread messages, and if the last message
+    went, so does the sidebar preview. Call inside a transaction.
+    """
+    # Locked first, like record_message() / mark_read(), so no update is lost
+    conversation = Conversation.objects.select_for_update().filter(pk=conversation_pk).first()
+    ids = [message_id for message_id, _ in rows]
+
+    if conversation is not None and rows:
+        unread = {"low": 0, "high": 0}
+        for message_id, receiver_id in rows:
+            side = "low" if receiver_id == conversation.user_low_id else "high"
+            if message_id > getattr(conversation, f"last_read_{side}"):
+                unread[side] += 1
+
+        update = {
+            f"unread_{side}": Greatest(F(f"unread_{side}") - count, Value(0))
+            for side, count in unread.items() if count
+        }
+        if conversation.last_message_id in ids:
+            update.update(last_message=None, last_message_preview="", last_message_time=None)
+        if update:
+            Conversation.objects.filter(pk=conversation.pk).update(updated_at=timezone.now(), **update)
+
+
+class Checkpoint:
+    """
+    Progress of a run in a small JSON file: the policies and cutoff it
+    started with and the last conversation it finished.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, state):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def run_retention(max_age_days, max_messages, checkpoint, chunk_size=500, pause=0,
+                  dry_run=False, restart=False):
+    """
+    Purge every conversation, resuming from `checkpoint` unless `restart`
+    (or the policies changed). Yields (conversation, removed) for each
+    conversation that lost messages.
+    """
+    state = None if restart or dry_run else checkpoint.load()
+    if state is None or (state["max_age_days"], state["max_messages"]) != (max_age_days, max_messages):
+        state = {
+            "max_age_days": max_age_days,
+            "max_messages": max_messages,
+            "cutoff": (timezone.now() - timedelta(days=max_age_days)).isoformat() if max_age_days else None,
+            "position": None,
+            "removed": 0,
+        }
+    cutoff = parse_datetime(state["cutoff"]) if state["cutoff"] else None
+
+    saved_at = time.monotonic()
+    position = state["position"]
+    while True:
+        # Keyset pages rather than one open cursor: we write to this table
+        conversations = Conversation.objects.order_by("user_low_id", "user_high_id")
+        if position:
+            user_low, user_high = position
+            conversations = conversations.filter(
+                Q(user_low_id__gt=user_low) | Q(user_low_id=user_low, user_high_id__gt=user_high)
+            )
+        page = list(conversations[:CONVERSATION_PAGE_SIZE])
+        if not page:
+            break
+
+        for conversation in page:
+            removed = purge_conversation(
+                conversation, cutoff, max_messages,
+                chunk_size=chunk_size, pause=pause, dry_run=dry_run,
+            )
+            position = [conversation.user_low_id, conversation.user_high_id]
+            if not dry_run:
+                state["position"] = position
+                state["removed"] += removed
+                if removed or time.monotonic() - saved_at >= 1:
+                    checkpoint.save(state)
+                    saved_at = time.monotonic()
+
+            if removed:
+                yield conversation, removed
+
+    if not dry_run:
+        checkpoint.clear()
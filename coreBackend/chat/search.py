@@ -0,0 +1,166 @@
+"""
+Full-text search over Message.content.
+
+On SQLite an FTS5 index (chat_message_fts) is kept in sync with chat_message
+by triggers, so inserts from bulk_create and deletes from cascades are
+covered too. Other databases fall back to a plain icontains scan.
+
+SQLite drops the triggers when a migration rebuilds chat_message (e.g.
+altering a column); run `manage.py rebuild_search_index` after such a
+migration to restore them.
+"""
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+from .models import Message
+
+
+SNIPPET_START = "«"
+SNIPPET_END = "»"
+SNIPPET_TOKENS = 12
+
+FTS_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts USING fts5(
+        content,
+        content='chat_message',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_fts_insert AFTER INSERT ON chat_message BEGIN
+        INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_fts_delete AFTER DELETE ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_fts_update AFTER UPDATE OF content ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+        INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+]
+
+
+class BaseSearchBackend:
+    def search(self, user_id, query, exclude_user_ids=(), other_user_id=None, limit=20, offset=0):
+        """
+        Messages of user_id's conversations matching `query`, best first.
+        Returns [(message_id, snippet), ...].
+        """
+        raise NotImplementedError
+
+    def rebuild(self):
+        """
+        (Re)create whatever index the backend uses from the Message table.
+        """
+
+
+class SQLiteFTSBackend(BaseSearchBackend):
+    def search(self, user_id, query, exclude_user_ids=(), other_user_id=None, limit=20, offset=0):
+        match = self.to_match_expression(query)
+        if not match:
+            return []
+
+        sql = [
+            f"""
+            SELECT m.id,
+                   snippet(chat_message_fts, 0, %s, %s, '…', {SNIPPET_TOKENS})
+            FROM chat_message_fts
+            JOIN chat_message m ON m.id = chat_message_fts.rowid
+            WHERE chat_message_fts MATCH %s
+              AND (m.sender_id = %s OR m.receiver_id = %s)
+            """
+        ]
+        params = [SNIPPET_START, SNIPPET_END, match, user_id, user_id]
+
+        if other_user_id is not None:
+            sql.append("AND m.conversation_key = %s")
+            params.append(Message.make_conversation_key(user_id, other_user_id))
+
+        if exclude_user_ids:
+            placeholders = ", ".join(["%s"] * len(exclude_user_ids))
+            sql.append(
+                f"AND m.sender_id NOT IN ({placeholders}) AND m.receiver_id NOT IN ({placeholders})"
+            )
+            params.extend(exclude_user_ids)
+            params.extend(exclude_user_ids)
+
+        sql.append("ORDER BY bm25(chat_message_fts), m.id DESC LIMIT %s OFFSET %s")
+        params.extend([limit, offset])
+
+        with connection.cursor() as cursor:
+            cursor.execute("\n".join(sql), params)
+            return cursor.fetchall()
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            for statement in FTS_SCHEMA:
+                cursor.execute(statement)
+            cursor.execute("INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')")
+
+    @staticmethod
+    def to_match_expression(query):
+        """
+        Turn user input into a safe FTS5 query: every word quoted (so no
+        operators / syntax errors) and prefix-matched, all words required.
+        """
+        words = re.findall(r"\w+", query)
+        return " ".join(f'"{word}"*' for word in words)
+
+
+class SimpleSearchBackend(BaseSearchBackend):
+    """
+    No index: icontains scan. Fine for small databases and for tests on
+    backends without FTS5.
+    """
+
+    def search(self, user_id, query, exclude_user_ids=(), other_user_id=None, limit=20, offset=0):
+        query = query.strip()
+        if not query:
+            return []
+
+        qs = Message.objects.filter(content__icontains=query)
+        if other_user_id is not None:
+            qs = qs.filter(conversation_key=Message.make_conversation_key(user_id, other_user_id))
+        else:
+            qs = qs.filter(Q(sender_id=user_id) | Q(receiver_id=user_id))
+
+        if exclude_user_ids:
+            qs = qs.exclude(sender_id__in=exclude_user_ids).exclude(receiver_id__in=exclude_user_ids)
+
+        rows = qs.order_by("-id").values_list("id", "content")[offset:offset + limit]
+        return [(message_id, self.make_snippet(content, query)) for message_id, content in rows]
+
+    @staticmethod
+    def make_snippet(content, query, width=60):
+        start = content.lower().find(query.lower())
+        if start < 0:
+            return content[:width]
+        end = start + len(query)
+        left = max(start - width // 2, 0)
+        return (
+            ("…" if left else "")
+            + content[left:start]
+            + SNIPPET_START + content[start:end] + SNIPPET_END
+            + content[end:end + width // 2]
+        )
+
+
+def get_search_backend():
+    if settings.MESSAGE_SEARCH_BACKEND:
+        return import_string(settings.MESSAGE_SEARCH_BACKEND)()
+    if connection.vendor == "sqlite":
+        return SQLiteFTSBackend()
+    return SimpleSearchBackend()
@@ -1,5 +1,7 @@
+from django.conf import settings
+from django.utils import timezone
 from rest_framework import serializers
-from .models import Message
+from .models import Message, Conversation
 
 
 class MessageSerializer(serializers.ModelSerializer):
@@ -9,6 +11,7 @@ class MessageSerializer(serializers.ModelSerializer):
     receiver_username = serializers.CharField(
         source='receiver.username', read_only=True
     )
+    is_read = serializers.SerializerMethodField()
 
     class Meta:
         model = Message
@@ -22,7 +25,24 @@ class MessageSerializer(serializers.ModelSerializer):
             'timestamp',
             'is_read',
         ]
-        read_only_fields = ['sender', 'timestamp', 'is_read']
+        read_only_fields = ['sender', 'timestamp']
+        extra_kwargs = {'content': {'max_length': settings.MESSAGE_MAX_LENGTH}}
+
+    def get_is_read(self, obj):
+        """
+        Derived from the receiver's read watermark on the Conversation.
+        Views pass context["read_watermarks"] = {conversation_key: {user_id: id}};
+        otherwise it is looked up once per conversation.
+        """
+        watermarks = self.context.setdefault("read_watermarks", {})
+
+        if obj.conversation_key not in watermarks:
+            conversation = Conversation.objects.for_pair(obj.sender_id, obj.receiver_id).first()
+            watermarks[obj.conversation_key] = (
+                conversation.read_watermarks() if conversation else {}
+            )
+
+        return obj.id <= watermarks[obj.conversation_key].get(obj.receiver_id, 0)
 
     def create(self, validated_data):
         """
@@ -36,3 +56,86 @@ class MessageSerializer(serializers.ModelSerializer):
 
         validated_data['sender'] = user
         return super().create(validated_data)
+
+
+# Read-optimized path for message lists: values() rows (users joined in, one
+# query) turned into plain dicts with MessageSerializer's exact schema.
+MESSAGE_LIST_FIELDS = (
+    "id",
+    "sender_id",
+    "receiver_id",
+    "sender__username",
+    "receiver__username",
+    "content",
+    "timestamp",
+)
+
+
+def format_timestamp(value, tz):
+    """
+    What DRF's DateTimeField renders (ISO 8601, "Z" for UTC), with the
+    current timezone looked up once per list instead of once per value.
+    """
+    if tz is not None:
+        value = value.astimezone(tz)
+    value = value.isoformat()
+    if value.endswith("+00:00"):
+        value = value[:-6] + "Z"
+    return value
+
+
+def message_rows(queryset):
+    return queryset.values(*MESSAGE_LIST_FIELDS)
+
+
+def serialize_message_rows(rows, watermarks):
+    """
+    rows:       dicts with MESSAGE_LIST_FIELDS (see message_rows())
+    watermarks: {user_id: last read message id} of their conversation
+    """
+    tz = timezone.get_current_timezone() if settings.USE_TZ else None
+    return [
+        {
+            "id": row["id"],
+            "sender": row["sender_id"],
+            "receiver": row["receiver_id"],
+            "sender_username": row["sender__username"],
+            "receiver_username": row["receiver__username"],
+            "content": row["content"],
+            "timestamp": format_timestamp(row["timestamp"], tz),
+            "is_read": row["id"] <= watermarks.get(row["receiver_id"], 0),
+        }
+        for row in rows
+    ]
+
+
+def compact_message_rows(rows, watermarks, users):
+    """
+    The messages of one conversation, column-oriented, for clients that ask
+    for a compact format (coreBackend.renderers.COMPACT_RENDERERS):
+
+    {
+      "users":      {"2": "bob", "5": "alice"},   # both sides, sent once
+      "read_up_to": {"2": 810, "5": 812},         # read watermarks
+      "messages": {
+        "id":        [811, 812],
+        "sender":    [5, 2],
+        "content":   ["hi", "hey"],
+        "timestamp": [1700000000123, 1700000004567]   # epoch milliseconds
+      }
+    }
+
+    receiver is the other user of "users" (the sender, in a chat with
+    oneself) and is_read is id <= read_up_to[receiver].
+    users: {user_id: username} of both sides.
+    """
+    return {
+        "users": {str(user_id): username for user_id, username in users.items()},
+        "read_up_to": {str(user_id): watermarks.get(user_id, 0) for user_id in users},
+        "messages": {
+            "id": [row["id"] for row in rows],
+            "sender": [row["sender_id"] for row in rows],
+            "content": [row["content"] for row in rows],
+            "timestamp": [int(row["timestamp"].timestamp() * 1000) for row in rows],
+        },
+    }
@@ -0,0 +1,25 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Message, Conversation, Block
+from .blocks import block_cache
+from .events import publish_block_changed
+
+
+@receiver(post_save, sender=Message)
+def update_conversation(sender, instance, created, **kwargs):
+    if created:
+        Conversation.objects.record_message(instance)
+
+
+@receiver(post_save, sender=Block)
+@receiver(post_delete, sender=Block)
+def invalidate_block_cache(sender, instance, **kwargs):
+    active = kwargs["signal"] is post_save
+
+    def changed():
+        block_cache.invalidate()
+        publish_block_changed(instance, active)
+
+    transaction.on_commit(changed)
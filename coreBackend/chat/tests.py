@@ -1,3 +1,959 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+import unittest.mock
+from datetime import datetime, timezone
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import QuerySet
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from coreBackend import ratelimit
+from coreBackend.eventbus import UnixSocketBackend, get_bus
+from coreBackend.renderers import msgpack
+
+from . import consumers, ephemeral, retention
+from .archive import archive_conversation, get_archive
+from .blocks import block_cache
+from .devices import connect_device, disconnect_device
+from .models import Block, Conversation, Device, Message
+from .views import MessageExportView
+
+
+class ParallelWritersTests(TransactionTestCase):
+    """
+    Several threads (each with its own DB connection, like separate
+    workers) send messages into one conversation while others read it.
+    With the SQLite profile from settings no writer may fail with
+    "database is locked", and no unread-counter increment may be lost.
+    """
+
+    WRITERS = 8
+    READERS = 4
+    MESSAGES_PER_WRITER = 25
+
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="x")
+        self.bob = User.objects.create_user("bob", password="x")
+
+    @unittest.skipUnless(connection.vendor == "sqlite", "SQLite journaling check")
+    def test_sqlite_profile_is_applied(self):
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode")
+            self.assertEqual(cursor.fetchone()[0].lower(), "wal")
+            cursor.execute("PRAGMA synchronous")
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+
+    def test_parallel_writers(self):
+        errors = []
+        done = threading.Event()
+        start = threading.Barrier(self.WRITERS + self.READERS)
+        key = Message.make_conversation_key(self.alice.id, self.bob.id)
+
+        def write(n):
+            try:
+                start.wait()
+                for i in range(self.MESSAGES_PER_WRITER):
+                    with transaction.atomic():
+                        Message.objects.create(
+                            sender=self.alice, receiver=self.bob, content=f"{n}-{i}"
+                        )
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        def read():
+            try:
+                start.wait()
+                while not done.is_set():
+                    list(Message.objects.filter(conversation_key=key).order_by("-id")[:50])
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        writers = [threading.Thread(target=write, args=(n,)) for n in range(self.WRITERS)]
+        readers = [threading.Thread(target=read) for _ in range(self.READERS)]
+        for thread in writers + readers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        done.set()
+        for thread in readers:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+        total = self.WRITERS * self.MESSAGES_PER_WRITER
+        self.assertEqual(Message.objects.filter(conversation_key=key).count(), total)
+
+        unread = dict(Conversation.objects.unread_counts(self.bob.id))
+        self.assertEqual(unread[self.alice.id], total)
+
+
+class ArchivedConversationTestCase(TestCase):
+    """
+    alice -> bob, m0..m29; m0..m19 moved to cold storage (chat.archive),
+    m20..m29 still in the Message table.
+    """
+
+    MESSAGES = 30
+    ARCHIVED = 20
+
+    def setUp(self):
+        archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_dir, ignore_errors=True)
+        settings_override = override_settings(MESSAGE_ARCHIVE_DIR=archive_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.alice = User.objects.create_user("alice", password="x")
+        self.bob = User.objects.create_user("bob", password="x")
+        self.ids = [
+            Message.objects.create(sender=self.alice, receiver=self.bob, content=f"m{i}").id
+            for i in range(self.MESSAGES)
+        ]
+        key = Message.make_conversation_key(self.alice.id, self.bob.id)
+        Message.objects.filter(id__lte=self.ids[self.ARCHIVED - 1]).update(
+            timestamp=datetime(2000, 1, 1, tzinfo=timezone.utc)
+        )
+        archive_conversation(key, cutoff=datetime(2001, 1, 1, tzinfo=timezone.utc), chunk_size=7)
+        self.assertEqual(get_archive(key).last_id, self.ids[self.ARCHIVED - 1])
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.bob)
+
+
+class MessageExportTests(ArchivedConversationTestCase):
+    def export(self, **headers):
+        response = self.client.get(
+            "/api/chat/messages/export/", {"user_id": self.alice.id}, headers=headers
+        )
+        self.assertEqual(response.status_code, 200)
+        return response, b"".join(response.streaming_content)
+
+    def assertWholeConversation(self, body):
+        lines = [json.loads(line) for line in body.decode().splitlines()]
+        self.assertEqual([line["id"] for line in lines], self.ids)
+        self.assertEqual([line["content"] for line in lines], [f"m{i}" for i in range(self.MESSAGES)])
+
+    def test_plain(self):
+        response, body = self.export()
+        self.assertNotIn("Content-Encoding", response)
+        self.assertWholeConversation(body)
+
+    def test_gzip(self):
+        response, body = self.export(accept_encoding="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertWholeConversation(gzip.decompress(body))
+
+    def test_chunk_bytes(self):
+        with unittest.mock.patch.object(MessageExportView, "CHUNK_BYTES", 1000):
+            response = self.client.get("/api/chat/messages/export/", {"user_id": self.alice.id})
+            chunks = list(response.streaming_content)
+        self.assertGreater(len(chunks), 1)
+        self.assertWholeConversation(b"".join(chunks))
+
+    async def test_async_stream(self):
+        token = await sync_to_async(AccessToken.for_user)(self.bob)
+        response = await self.async_client.get(
+            "/api/chat/messages/export/", {"user_id": self.alice.id},
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        self.assertWholeConversation(b"".join([chunk async for chunk in response.streaming_content]))
+
+
+class MessageListArchiveTests(ArchivedConversationTestCase):
+    """
+    Cursors on either side of the archive / Message table boundary.
+    """
+
+    def page(self, **params):
+        response = self.client.get("/api/chat/messages/", {"user_id": self.alice.id, **params})
+        self.assertEqual(response.status_code, 200)
+        return [message["content"] for message in response.json()]
+
+    def test_after_inside_archive(self):
+        self.assertEqual(self.page(after=self.ids[17], limit=5), ["m18", "m19", "m20", "m21", "m22"])
+
+    def test_after_archive_only(self):
+        self.assertEqual(self.page(after=self.ids[2], limit=3), ["m3", "m4", "m5"])
+
+    def test_after_in_hot_table(self):
+        self.assertEqual(self.page(after=self.ids[25], limit=5), ["m26", "m27", "m28", "m29"])
+
+    def test_before_across_boundary(self):
+        self.assertEqual(self.page(before=self.ids[22], limit=5), ["m17", "m18", "m19", "m20", "m21"])
+
+    def test_before_inside_archive(self):
+        self.assertEqual(self.page(before=self.ids[5], limit=3), ["m2", "m3", "m4"])
+
+
+class RetentionTests(ArchivedConversationTestCase):
+    """
+    chat.retention on a conversation split between the archive (m0..m19,
+    in blocks of 7) and the Message table (m20..m29).
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.key = Message.make_conversation_key(self.alice.id, self.bob.id)
+        self.old = datetime(2000, 6, 1, tzinfo=timezone.utc)
+
+    def conversation(self):
+        return Conversation.objects.for_pair(self.alice.id, self.bob.id).get()
+
+    def purge(self, **policies):
+        return retention.purge_conversation(self.conversation(), chunk_size=3, **policies)
+
+    def remaining(self):
+        archived = [row["content"] for row in get_archive(self.key).iter_rows()]
+        hot = Message.objects.filter(conversation_key=self.key).order_by("id")
+        return archived + list(hot.values_list("content", flat=True))
+
+    def test_max_messages_inside_archive(self):
+        # The boundary falls inside the third block (m14..m19)
+        self.assertEqual(self.purge(max_messages=15, dry_run=True), 15)
+        self.assertEqual(self.remaining(), [f"m{i}" for i in range(30)])
+
+        self.assertEqual(self.purge(max_messages=15), 15)
+        self.assertEqual(self.remaining(), [f"m{i}" for i in range(15, 30)])
+        self.assertEqual(dict(Conversation.objects.unread_counts(self.bob.id)), {self.alice.id: 15})
+
+    def test_max_messages_in_hot_table(self):
+        self.assertEqual(self.purge(max_messages=5, dry_run=True), 25)
+        self.assertEqual(self.purge(max_messages=5), 25)
+        self.assertEqual(self.remaining(), [f"m{i}" for i in range(25, 30)])
+        self.assertEqual(get_archive(self.key).entries(), [])
+
+    def test_age(self):
+        Message.objects.filter(id__lte=self.ids[22]).update(timestamp=self.old)
+        cutoff = datetime(2001, 1, 1, tzinfo=timezone.utc)
+
+        self.assertEqual(self.purge(cutoff=cutoff, dry_run=True), 23)
+        self.assertEqual(self.purge(cutoff=cutoff), 23)
+        self.assertEqual(self.remaining(), [f"m{i}" for i in range(23, 30)])
+
+    def test_age_archive_only(self):
+        cutoff = datetime(2001, 1, 1, tzinfo=timezone.utc)
+        self.assertEqual(self.purge(cutoff=cutoff), 20)
+        self.assertEqual(self.remaining(), [f"m{i}" for i in range(20, 30)])
+
+    def test_counters_and_preview(self):
+        # bob read up to m24: only m25..m29 count as unread
+        Conversation.objects.mark_read(self.bob.id, self.alice.id, up_to=self.ids[24])
+        Message.objects.filter(id__lte=self.ids[26]).update(timestamp=self.old)
+        self.purge(cutoff=datetime(2001, 1, 1, tzinfo=timezone.utc))
+        self.assertEqual(dict(Conversation.objects.unread_counts(self.bob.id)), {self.alice.id: 3})
+        self.assertEqual(self.conversation().last_message_preview, "m29")
+
+        Message.objects.update(timestamp=self.old)
+        self.purge(cutoff=datetime(2001, 1, 1, tzinfo=timezone.utc))
+        conversation = self.conversation()
+        self.assertIsNone(conversation.last_message_id)
+        self.assertEqual(conversation.last_message_preview, "")
+        self.assertEqual(dict(Conversation.objects.unread_counts(self.bob.id)), {})
+
+    def test_checkpoint_resume(self):
+        carol = User.objects.create(username="carol")
+        for i in range(4):
+            Message.objects.create(sender=self.alice, receiver=carol, content=f"c{i}")
+        checkpoint_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, checkpoint_dir, ignore_errors=True)
+        checkpoint = retention.Checkpoint(os.path.join(checkpoint_dir, "purge.json"))
+
+        run = retention.run_retention(0, 2, checkpoint)
+        conversation, removed = next(run)
+        self.assertEqual((conversation.key, removed), (self.key, 28))
+        run.close()  # interrupted
+        self.assertEqual(checkpoint.load()["removed"], 28)
+
+        resumed = retention.run_retention(0, 2, checkpoint)
+        self.assertEqual(
+            [(conversation.key, removed) for conversation, removed in resumed],
+            [(Message.make_conversation_key(self.alice.id, carol.id), 2)],
+        )
+        self.assertIsNone(checkpoint.load())
+
+    def test_dry_run_command(self):
+        out = io.StringIO()
+        call_command("purge_messages", "--dry-run", "--max-per-conversation", "15", stdout=out)
+        self.assertIn("Would delete 15 message(s) from 1 conversation(s).", out.getvalue())
+        self.assertEqual(len(self.remaining()), 30)
+
+
+class LongPollTests(TransactionTestCase):
+    """
+    GET /api/chat/messages/?wait=... through coreBackend.asgi: while parked,
+    no thread may be blocked on the request (no sync-only middleware
+    forcing the async view through async_to_sync).
+    """
+
+    PARKED = 5
+
+    def request(self, query_string):
+        from coreBackend.asgi import application
+
+        return ApplicationCommunicator(application, {
+            "type": "http",
+            "method": "GET",
+            "path": "/api/chat/messages/",
+            "query_string": query_string.encode(),
+            "headers": [
+                (b"host", b"testserver"),
+                (b"authorization", f"Bearer {self.token}".encode()),
+            ],
+            "http_version": "1.1",
+            "scheme": "http",
+            "server": ("testserver", 80),
+            "client": ("127.0.0.1", 0),
+        })
+
+    async def get(self, query_string):
+        communicator = self.request(query_string)
+        await communicator.send_input({"type": "http.request", "body": b""})
+        start = await communicator.receive_output(10)
+        await communicator.receive_output(10)  # body
+        await communicator.wait(1)
+        return start["status"]
+
+    @staticmethod
+    def threads_in_async_to_sync():
+        # The main thread is in one too: it runs this async test
+        blocked = []
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == threading.main_thread().ident:
+                continue
+            while frame is not None:
+                if frame.f_code.co_qualname == "AsyncToSync.__call__":
+                    blocked.append(thread_id)
+                    break
+                frame = frame.f_back
+        return blocked
+
+    async def test_parked_request_holds_no_thread(self):
+        alice = await sync_to_async(User.objects.create_user)("alice", password="x")
+        bob = await sync_to_async(User.objects.create_user)("bob", password="x")
+        self.token = str(AccessToken.for_user(bob))
+        query_string = f"user_id={alice.id}&after=999999&wait=2"
+
+        parked = [asyncio.ensure_future(self.get(query_string)) for _ in range(self.PARKED)]
+        await asyncio.sleep(0.5)
+        self.assertEqual(self.threads_in_async_to_sync(), [])
+        self.assertEqual(await asyncio.gather(*parked), [200] * self.PARKED)
+
+    async def test_non_finite_wait(self):
+        alice = await sync_to_async(User.objects.create_user)("alice", password="x")
+        bob = await sync_to_async(User.objects.create_user)("bob", password="x")
+        self.token = str(AccessToken.for_user(bob))
+
+        # Answered at once, like any other unusable ?wait=
+        for wait in ("nan", "inf", "-inf"):
+            query_string = f"user_id={alice.id}&after=999999&wait={wait}"
+            self.assertEqual(await asyncio.wait_for(self.get(query_string), 2), 200, wait)
+
+
+class BatchRateLimitTests(TestCase):
+    """
+    Batched messages count against the single-send limit (20 a minute).
+    """
+
+    def setUp(self):
+        backend = ratelimit.LocMemBackend()
+        patcher = unittest.mock.patch.object(ratelimit, "_backend", backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.alice = User.objects.create_user("alice", password="x")
+        self.bob = User.objects.create_user("bob", password="x")
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def batch(self, count, prefix):
+        return self.client.post("/api/chat/messages/batch/", {"messages": [
+            {"client_id": f"{prefix}{i}", "receiver": self.bob.id, "content": "hi"}
+            for i in range(count)
+        ]}, format="json")
+
+    def send(self):
+        return self.client.post("/api/chat/messages/", {"receiver": self.bob.id, "content": "hi"})
+
+    def test_batch_uses_the_send_limit(self):
+        self.assertEqual(self.batch(15, "a").status_code, 200)
+        self.assertEqual(self.batch(10, "b").status_code, 429)
+        for _ in range(5):
+            self.assertEqual(self.send().status_code, 201)
+        self.assertEqual(self.send().status_code, 429)
+        self.assertEqual(Message.objects.count(), 20)
+
+    def test_oversized_batch_is_refused(self):
+        self.assertEqual(self.batch(21, "a").status_code, 429)
+        self.assertEqual(Message.objects.count(), 0)
+
+
+class RecordMessagesTests(TestCase):
+    def test_older_message_recorded_last(self):
+        alice = User.objects.create_user("alice", password="x")
+        bob = User.objects.create_user("bob", password="x")
+        # No signals: record them by hand, newest first, like two sends
+        # whose transactions took the conversation lock out of id order
+        older, newer = Message.objects.bulk_create([
+            Message(sender=alice, receiver=bob, content="older",
+                    conversation_key=Message.make_conversation_key(alice.id, bob.id)),
+            Message(sender=alice, receiver=bob, content="newer",
+                    conversation_key=Message.make_conversation_key(alice.id, bob.id)),
+        ])
+        Conversation.objects.record_message(newer)
+        Conversation.objects.record_message(older)
+
+        conversation = Conversation.objects.for_pair(alice.id, bob.id).get()
+        self.assertEqual(conversation.last_message_id, newer.id)
+        self.assertEqual(conversation.last_message_preview, "newer")
+        self.assertEqual(dict(Conversation.objects.unread_counts(bob.id)), {alice.id: 2})
+
+
+class RecordMessagesAutocommitTests(TransactionTestCase):
+    def test_locks_inside_a_transaction(self):
+        # select_for_update() in autocommit raises on PostgreSQL
+        alice = User.objects.create(username="alice")
+        bob = User.objects.create(username="bob")
+        in_transaction = []
+        get_or_create = QuerySet.get_or_create
+
+        def spy(queryset, **kwargs):
+            if queryset.model is Conversation:
+                in_transaction.append(not connection.get_autocommit())
+            return get_or_create(queryset, **kwargs)
+
+        with unittest.mock.patch.object(QuerySet, "get_or_create", spy):
+            Message.objects.create(sender=alice, receiver=bob, content="hi")
+        self.assertEqual(in_transaction, [True])
+
+
+class MarkReadTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="x")
+        self.bob = User.objects.create_user("bob", password="x")
+        self.ids = [
+            Message.objects.create(sender=self.alice, receiver=self.bob, content=f"m{i}").id
+            for i in range(5)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.bob)
+
+    def unread(self):
+        return dict(Conversation.objects.unread_counts(self.bob.id)).get(self.alice.id, 0)
+
+    def test_watermark_and_counter(self):
+        self.assertEqual(self.unread(), 5)
+
+        conversation, changed = Conversation.objects.mark_read(self.bob.id, self.alice.id, up_to=self.ids[1])
+        self.assertTrue(changed)
+        self.assertEqual(conversation.read_watermarks()[self.bob.id], self.ids[1])
+        self.assertEqual(self.unread(), 3)
+
+        # Never backwards, never past the last message
+        _, changed = Conversation.objects.mark_read(self.bob.id, self.alice.id, up_to=self.ids[0])
+        self.assertFalse(changed)
+        conversation, changed = Conversation.objects.mark_read(self.bob.id, self.alice.id, up_to=10 ** 9)
+        self.assertTrue(changed)
+        self.assertEqual(conversation.read_watermarks()[self.bob.id], self.ids[-1])
+        self.assertEqual(self.unread(), 0)
+
+        # The sender's side is untouched
+        self.assertEqual(conversation.read_watermarks()[self.alice.id], 0)
+        self.assertEqual(dict(Conversation.objects.unread_counts(self.alice.id)), {})
+
+    def test_poll_without_news_takes_no_lock(self):
+        Conversation.objects.mark_read(self.bob.id, self.alice.id)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                "/api/chat/messages/", {"user_id": self.alice.id, "after": self.ids[-1]}
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [])
+
+        statements = [query["sql"].upper() for query in queries.captured_queries]
+        self.assertFalse([sql for sql in statements if sql.startswith(("BEGIN", "SAVEPOINT"))])
+        self.assertFalse([sql for sql in statements if "FOR UPDATE" in sql])
+
+
+class EphemeralStateTests(TestCase):
+    """
+    chat.ephemeral: states expire after their TTL, never reach blocked
+    users, and are cleared by the message they announced.
+    """
+
+    def setUp(self):
+        self.now = time.monotonic()
+        clock = types.SimpleNamespace(monotonic=lambda: self.now)
+        patcher = unittest.mock.patch.object(ephemeral, "time", clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = unittest.mock.patch.object(ratelimit, "_backend", ratelimit.LocMemBackend())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(ephemeral.ephemeral_states._states.clear)
+        self.addCleanup(block_cache.clear)  # the rollback drops blocks unseen
+
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+        self.ttl = ephemeral.ephemeral_states.ttl
+
+    def states(self, user):
+        return [(state["user_id"], state["state"]) for state in ephemeral.states_for(user.id)]
+
+    def test_ttl(self):
+        self.assertTrue(ephemeral.signal_state(self.alice.id, self.bob.id, "typing"))
+        self.assertEqual(self.states(self.bob), [(self.alice.id, "typing")])
+        self.assertEqual(self.states(self.alice), [])
+
+        self.now += self.ttl
+        self.assertEqual(self.states(self.bob), [])
+
+    def test_expired_entries_are_swept(self):
+        ephemeral.signal_state(self.alice.id, self.bob.id, "typing")
+        self.now += self.ttl
+        # bob never polls; the next state set anywhere sweeps his entry out
+        ephemeral.signal_state(self.bob.id, self.alice.id, "typing")
+        self.assertEqual(list(ephemeral.ephemeral_states._states), [self.alice.id])
+
+    def test_unknown_receiver(self):
+        self.assertFalse(ephemeral.signal_state(self.alice.id, 10 ** 9, "typing"))
+        self.assertEqual(ephemeral.ephemeral_states._states, {})
+
+    def test_blocks(self):
+        ephemeral.signal_state(self.alice.id, self.bob.id, "typing")
+        with self.captureOnCommitCallbacks(execute=True):
+            Block.objects.create(blocker=self.bob, blocked=self.alice)
+
+        self.assertEqual(self.states(self.bob), [])  # set before the block
+        self.assertFalse(ephemeral.signal_state(self.alice.id, self.bob.id, "recording"))
+
+    def test_discarded_by_message(self):
+        ephemeral.signal_state(self.alice.id, self.bob.id, "typing")
+        ephemeral.signal_state(self.bob.id, self.alice.id, "typing")
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post("/api/chat/messages/", {"receiver": self.bob.id, "content": "hi"})
+        self.assertEqual(response.status_code, 201)
+
+        self.assertEqual(self.states(self.bob), [])
+        self.assertEqual(self.states(self.alice), [(self.bob.id, "typing")])
+
+    def test_socket_frames_are_rate_limited(self):
+        with unittest.mock.patch.object(consumers, "STATE_RATE_LIMIT", 2):
+            sent = [
+                consumers.set_state("10.0.0.1", self.alice.id, self.bob.id, "typing", active)
+                for active in (True, False, True)
+            ]
+        self.assertEqual(sent, [True, True, False])
+
+
+class CompactFormatTests(TestCase):
+    """
+    GET /api/chat/messages/ in the compact formats (coreBackend.renderers).
+    """
+
+    def setUp(self):
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+        self.ids = [
+            Message.objects.create(sender=sender, receiver=receiver, content=f"m{i}").id
+            for i, (sender, receiver) in enumerate(
+                [(self.alice, self.bob), (self.bob, self.alice), (self.alice, self.bob)]
+            )
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.bob)
+
+    def get(self, accept, **headers):
+        return self.client.get(
+            "/api/chat/messages/", {"user_id": self.alice.id}, HTTP_ACCEPT=accept, headers=headers
+        )
+
+    def test_layout(self):
+        plain = self.get("application/json").json()
+        compact = self.get("application/vnd.chat.compact+json").json()
+
+        self.assertEqual(compact["users"], {str(self.alice.id): "alice", str(self.bob.id): "bob"})
+        self.assertEqual(compact["messages"]["id"], self.ids)
+        self.assertEqual(compact["messages"]["sender"], [self.alice.id, self.bob.id, self.alice.id])
+        self.assertEqual(compact["messages"]["content"], ["m0", "m1", "m2"])
+
+        # What the client derives gives back the JSON fields
+        columns = compact["messages"]
+        derived = []
+        for message_id, sender in zip(columns["id"], columns["sender"]):
+            receiver = next(int(user) for user in compact["users"] if int(user) != sender)
+            derived.append({
+                "id": message_id,
+                "receiver": receiver,
+                "is_read": message_id <= compact["read_up_to"][str(receiver)],
+            })
+        self.assertEqual(
+            derived, [{key: message[key] for key in ("id", "receiver", "is_read")} for message in plain]
+        )
+        self.assertEqual([message["is_read"] for message in plain], [True, False, True])
+
+    def test_etag_per_media_type(self):
+        plain = self.get("application/json")
+        compact = self.get("application/vnd.chat.compact+json")
+        self.assertNotEqual(plain["ETag"], compact["ETag"])
+        self.assertIn("Accept", compact["Vary"])
+
+        response = self.get("application/vnd.chat.compact+json", if_none_match=plain["ETag"])
+        self.assertEqual(response.status_code, 200)
+        response = self.get("application/vnd.chat.compact+json", if_none_match=compact["ETag"])
+        self.assertEqual(response.status_code, 304)
+        self.assertIn("Accept", response["Vary"])
+
+    @unittest.skipIf(msgpack is None, "msgpack not installed")
+    def test_msgpack(self):
+        compact = self.get("application/vnd.chat.compact+json")
+        packed = self.get("application/vnd.msgpack")
+        self.assertEqual(msgpack.unpackb(packed.content), compact.json())
+        self.assertNotEqual(packed["ETag"], compact["ETag"])
+
+
+class MessageLengthTests(TestCase):
+    """
+    Content is capped (MESSAGE_MAX_LENGTH) so that a message.created event
+    always fits in one event bus datagram.
+    """
+
+    def setUp(self):
+        patcher = unittest.mock.patch.object(ratelimit, "_backend", ratelimit.LocMemBackend())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def test_longest_message_fits_in_an_event(self):
+        payloads = []
+        with unittest.mock.patch.object(type(get_bus()), "send", lambda bus, payload: payloads.append(payload)):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post("/api/chat/messages/", {
+                    "receiver": self.bob.id, "content": "\U0001F600" * settings.MESSAGE_MAX_LENGTH,
+                })
+        self.assertEqual(response.status_code, 201)
+        created = [payload for payload in payloads if b'"message.created"' in payload]
+        self.assertEqual(len(created), 1)
+        self.assertLessEqual(len(created[0]), UnixSocketBackend.MAX_EVENT_BYTES)
+
+    def test_too_long(self):
+        content = "x" * (settings.MESSAGE_MAX_LENGTH + 1)
+        response = self.client.post("/api/chat/messages/", {"receiver": self.bob.id, "content": content})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post("/api/chat/messages/batch/", {"messages": [
+            {"client_id": "a", "receiver": self.bob.id, "content": content},
+            {"client_id": "b", "receiver": self.bob.id, "content": content[1:]},
+        ]}, format="json")
+        results = response.json()["results"]
+        self.assertEqual((results["a"]["status"], results["b"]["status"]), (400, 201))
+
+
+class MessageSearchTests(TestCase):
+    """
+    GET /api/chat/search/ with the default backend (the FTS5 index on
+    SQLite, kept up to date by triggers).
+    """
+
+    def setUp(self):
+        archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_dir, ignore_errors=True)
+        settings_override = override_settings(MESSAGE_ARCHIVE_DIR=archive_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(block_cache.clear)  # the rollback drops blocks unseen
+
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+        self.carol = User.objects.create(username="carol")
+        self.client = APIClient()
+        self.client.force_authenticate(self.bob)
+
+    def send(self, sender, receiver, content):
+        return Message.objects.create(sender=sender, receiver=receiver, content=content)
+
+    def search(self, q, **params):
+        response = self.client.get("/api/chat/search/", {"q": q, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def found(self, q, **params):
+        return [result["message"]["content"] for result in self.search(q, **params)["results"]]
+
+    @unittest.skipUnless(connection.vendor == "sqlite", "FTS5 index")
+    def test_insert_and_snippet(self):
+        self.send(self.alice, self.bob, "Lunch at the café tomorrow?")
+        self.send(self.alice, self.carol, "lunch without bob")  # not bob's
+
+        results = self.search("lunch")["results"]
+        self.assertEqual([result["message"]["content"] for result in results], ["Lunch at the café tomorrow?"])
+        self.assertIn("«Lunch»", results[0]["snippet"])
+        self.assertEqual(self.found("cafe"), ["Lunch at the café tomorrow?"])  # diacritics
+        self.assertEqual(self.found("tomor"), ["Lunch at the café tomorrow?"])  # prefix
+
+    def test_edit(self):
+        message = self.send(self.alice, self.bob, "see you at noon")
+        Message.objects.filter(pk=message.pk).update(content="see you at midnight")
+
+        self.assertEqual(self.found("noon"), [])
+        self.assertEqual(self.found("midnight"), ["see you at midnight"])
+
+        message.content = "see you at dawn"
+        message.save()
+        self.assertEqual(self.found("midnight"), [])
+        self.assertEqual(self.found("dawn"), ["see you at dawn"])
+
+    def test_delete(self):
+        message = self.send(self.alice, self.bob, "delete me")
+        message.delete()
+        self.assertEqual(self.found("delete"), [])
+
+        self.send(self.carol, self.bob, "gone with carol")
+        self.carol.delete()  # cascades
+        self.assertEqual(self.found("gone"), [])
+
+    def test_retention(self):
+        for i in range(3):
+            self.send(self.alice, self.bob, f"budget draft {i}")
+        conversation = Conversation.objects.for_pair(self.alice.id, self.bob.id).get()
+        retention.purge_conversation(conversation, max_messages=1)
+        self.assertEqual(self.found("budget"), ["budget draft 2"])
+
+    def test_blocks(self):
+        self.send(self.alice, self.bob, "hello from alice")
+        self.send(self.bob, self.carol, "hello to carol")
+        with self.captureOnCommitCallbacks(execute=True):
+            Block.objects.create(blocker=self.carol, blocked=self.bob)
+
+        self.assertEqual(self.found("hello"), ["hello from alice"])
+        self.assertEqual(self.found("hello", user_id=self.carol.id), [])
+
+    def test_conversation_filter(self):
+        self.send(self.alice, self.bob, "plans with alice")
+        self.send(self.carol, self.bob, "plans with carol")
+        self.assertEqual(self.found("plans", user_id=self.carol.id), ["plans with carol"])
+
+    def test_paging(self):
+        for i in range(5):
+            self.send(self.alice, self.bob, f"report {i}")
+
+        pages, offset = [], 0
+        while offset is not None:
+            page = self.search("report", limit=2, offset=offset)
+            pages.append([result["message"]["content"] for result in page["results"]])
+            offset = page["next_offset"]
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual(sorted(sum(pages, [])), [f"report {i}" for i in range(5)])
+
+    def test_bad_params(self):
+        self.assertEqual(self.client.get("/api/chat/search/", {"q": " "}).status_code, 400)
+        self.assertEqual(self.client.get("/api/chat/search/", {"q": "x", "limit": "a"}).status_code, 400)
+        self.assertEqual(self.search('"unbalanced AND (')["results"], [])
+
+
+@override_settings(MESSAGE_SEARCH_BACKEND="chat.search.SimpleSearchBackend")
+class SimpleMessageSearchTests(MessageSearchTests):
+    """
+    The same with the icontains fallback (no index, no diacritics folding).
+    """
+
+    def test_insert_and_snippet(self):
+        self.send(self.alice, self.bob, "Lunch at the café tomorrow?")
+        self.send(self.alice, self.carol, "lunch without bob")
+
+        results = self.search("lunch")["results"]
+        self.assertEqual([result["message"]["content"] for result in results], ["Lunch at the café tomorrow?"])
+        self.assertIn("«Lunch»", results[0]["snippet"])
+
+
+class DeviceReplayTests(TestCase):
+    """
+    chat.devices: what a device is sent when it reconnects.
+    """
+
+    def setUp(self):
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+        self.first = self.send("before the device")
+
+    def send(self, content):
+        return Message.objects.create(sender=self.alice, receiver=self.bob, content=content).id
+
+    def test_first_connection_starts_at_newest(self):
+        self.assertEqual(connect_device(self.bob, "phone"), (self.first, []))
+
+    def test_replay_after_reconnect(self):
+        cursor, _ = connect_device(self.bob, "phone")
+        disconnect_device(self.bob, "phone", cursor)
+        missed = [self.send("one"), self.send("two")]
+        Conversation.objects.mark_read(self.alice.id, self.bob.id)  # no effect on bob's side
+
+        cursor, events = connect_device(self.bob, "phone")
+        self.assertEqual(cursor, self.first)  # the consumer moves it on as it sends
+        created = [event for event in events if event["type"] == "message.created"]
+        self.assertEqual([event["message"]["id"] for event in created], missed)
+        self.assertEqual([event["message"]["is_read"] for event in created], [False, False])
+
+        read = {event["reader"]: event for event in events if event["type"] == "messages.read"}
+        self.assertEqual(read[self.bob.id]["unread"], 3)
+        self.assertEqual(read[self.alice.id]["unread"], 0)
+
+        # Caught up: nothing new to send
+        disconnect_device(self.bob, "phone", missed[-1])
+        cursor, events = connect_device(self.bob, "phone")
+        self.assertEqual(cursor, missed[-1])
+        self.assertEqual([event for event in events if event["type"] == "message.created"], [])
+
+    def test_after_param(self):
+        connect_device(self.bob, "phone")
+        later = self.send("later")
+        _, events = connect_device(self.bob, "phone", after=0)
+        created = [event["message"]["id"] for event in events if event["type"] == "message.created"]
+        self.assertEqual(created, [self.first, later])
+
+    def test_cursor_never_goes_back(self):
+        connect_device(self.bob, "phone")
+        later = self.send("later")
+        disconnect_device(self.bob, "phone", later)
+        disconnect_device(self.bob, "phone", self.first)  # a slower worker's socket
+        self.assertEqual(Device.objects.get(user=self.bob).delivered_up_to, later)
+
+    @override_settings(DEVICE_REPLAY_MAX=3)
+    def test_reload_when_too_far_behind(self):
+        cursor, _ = connect_device(self.bob, "phone")
+        disconnect_device(self.bob, "phone", cursor)
+        newest = [self.send(f"m{i}") for i in range(4)][-1]
+
+        cursor, events = connect_device(self.bob, "phone")
+        self.assertEqual(events, [{"type": "sync.reset"}])
+        self.assertEqual(cursor, newest)
+
+    def test_device_list(self):
+        connect_device(self.bob, "phone")
+        connect_device(self.bob, "laptop")
+        disconnect_device(self.bob, "laptop", self.first)
+
+        client = APIClient()
+        client.force_authenticate(self.bob)
+        devices = {device["device_id"]: device for device in client.get("/api/chat/devices/").json()}
+        self.assertEqual({name: device["connected"] for name, device in devices.items()},
+                         {"phone": True, "laptop": False})
+        self.assertEqual(devices["laptop"]["delivered_up_to"], self.first)
+
+
+class WebSocketTests(TransactionTestCase):
+    """
+    /ws/chat/ through coreBackend.asgi.
+    """
+
+    def setUp(self):
+        patcher = unittest.mock.patch.object(ratelimit, "_backend", ratelimit.LocMemBackend())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(ephemeral.ephemeral_states._states.clear)
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+
+    def connect(self, query_string="", path="/ws/chat/"):
+        from coreBackend.asgi import application
+
+        return ApplicationCommunicator(application, {
+            "type": "websocket",
+            "path": path,
+            "query_string": query_string.encode(),
+            "headers": [],
+            "client": ("127.0.0.1", 0),
+        })
+
+    async def open(self, user):
+        token = await sync_to_async(AccessToken.for_user)(user)
+        communicator = self.connect(f"token={token}")
+        await communicator.send_input({"type": "websocket.connect"})
+        self.assertEqual(await communicator.receive_output(5), {"type": "websocket.accept"})
+        return communicator
+
+    async def close(self, communicator):
+        await communicator.send_input({"type": "websocket.disconnect", "code": 1000})
+        await communicator.wait(5)
+
+    async def receive_event(self, communicator):
+        frame = await communicator.receive_output(5)
+        self.assertEqual(frame["type"], "websocket.send")
+        return json.loads(frame["text"])
+
+    async def test_refused(self):
+        token = await sync_to_async(AccessToken.for_user)(self.bob)
+        for query_string, path, code in [
+            ("", "/ws/chat/", consumers.CLOSE_UNAUTHORIZED),
+            ("token=not-a-token", "/ws/chat/", consumers.CLOSE_UNAUTHORIZED),
+            (f"token={token}", "/ws/other/", consumers.CLOSE_NOT_FOUND),
+            (f"token={token}&device=no spaces", "/ws/chat/", consumers.CLOSE_BAD_REQUEST),
+        ]:
+            communicator = self.connect(query_string, path)
+            await communicator.send_input({"type": "websocket.connect"})
+            self.assertEqual(
+                await communicator.receive_output(5), {"type": "websocket.close", "code": code}, path
+            )
+            await communicator.wait(5)
+
+    async def test_ping(self):
+        communicator = await self.open(self.bob)
+        await communicator.send_input({"type": "websocket.receive", "text": "ping"})
+        self.assertEqual(await communicator.receive_output(5), {"type": "websocket.send", "text": "pong"})
+        await self.close(communicator)
+
+    async def test_message_push(self):
+        communicator = await self.open(self.bob)
+
+        def send():
+            client = APIClient()
+            client.force_authenticate(self.alice)
+            return client.post("/api/chat/messages/", {"receiver": self.bob.id, "content": "hi bob"})
+
+        response = await sync_to_async(send)()
+        self.assertEqual(response.status_code, 201)
+        event = await self.receive_event(communicator)
+        self.assertEqual(event["type"], "message.created")
+        self.assertEqual(event["message"]["content"], "hi bob")
+        self.assertEqual(event["message"]["sender"], self.alice.id)
+        await self.close(communicator)
+
+    async def test_state_frame(self):
+        alice = await self.open(self.alice)
+        bob = await self.open(self.bob)
+        await alice.send_input({"type": "websocket.receive", "text": json.dumps(
+            {"type": "state", "to": self.bob.id, "state": "typing"}
+        )})
+        event = await self.receive_event(bob)
+        self.assertEqual((event["type"], event["sender"], event["state"]), ("state", self.alice.id, "typing"))
+        await self.close(alice)
+        await self.close(bob)
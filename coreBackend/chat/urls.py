@@ -1,9 +1,26 @@
 from django.urls import path
-from .views import MessageListCreateView, BlockView, BlockStatusView, UnreadCountView
+from .views import (
+    message_list_create_view,
+    MarkReadView,
+    MessageBatchCreateView,
+    MessageSearchView,
+    MessageExportView,
+    BlockView,
+    BlockStatusView,
+    DeviceListView,
+    EphemeralStateView,
+    UnreadCountView,
+)
 
 urlpatterns = [
-    path('messages/', MessageListCreateView.as_view(), name='messages'),
+    path('messages/', message_list_create_view, name='messages'),
+    path('messages/batch/', MessageBatchCreateView.as_view(), name='messages-batch'),
+    path('messages/export/', MessageExportView.as_view(), name='messages-export'),
+    path('messages/read/', MarkReadView.as_view(), name='messages-read'),
+    path('search/', MessageSearchView.as_view(), name='messages-search'),
     path('block/', BlockView.as_view(), name='block'),
     path('block/status/', BlockStatusView.as_view(), name='block-status'),
     path('unread_counts/', UnreadCountView.as_view()),
+    path('devices/', DeviceListView.as_view(), name='devices'),
+    path('states/', EphemeralStateView.as_view(), name='states'),
 ]
@@ -1,43 +1,61 @@
+import itertools
+import json
+import math
+import zlib
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
-from django.core.cache import cache
+from django.db import connection, transaction
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status, permissions
-
-from .models import Message, Block
-from .serializers import MessageSerializer
-
-
-def rate_limit(request, action: str, limit: int, window_seconds: int = 60) -> bool:
-    """
-    Simple per-IP rate limiter using Django cache.
-
-    action: "login", "register", "send_message", etc.
-    limit:  allowed attempts within window_seconds per IP.
-    returns True if blocked, False if allowed.
-    """
-    ip = request.META.get("REMOTE_ADDR", "unknown")
-    key = f"rl:{action}:{ip}"
-
-    attempts = cache.get(key, 0)
-
-    if attempts >= limit:
-        return True  # blocked
-
-    cache.set(key, attempts + 1, timeout=window_seconds)
-    return False
+from rest_framework.settings import api_settings
+
+from .models import Message, Block, Conversation
+from .serializers import (
+    MessageSerializer,
+    compact_message_rows,
+    message_rows,
+    serialize_message_rows,
+)
+from .realtime import notifier
+from .blocks import block_cache
+from .consumers import authenticate
+from .search import get_search_backend
+from .archive import get_archive, to_message, to_values
+from .events import messages_read_event
+from .devices import device_list
+from .ephemeral import STATE_RATE_LIMIT, signal_state, states_for
+from coreBackend.ratelimit import rate_limit
+from coreBackend.metrics import measure_serialization
+from coreBackend.conditional import make_etag, not_modified, with_etag
+from coreBackend.eventbus import get_bus
+from coreBackend.renderers import COMPACT_FORMATS, COMPACT_RENDERERS
 
 
 class MessageListCreateView(APIView):
     permission_classes = [permissions.IsAuthenticated]
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + COMPACT_RENDERERS
 
     def get(self, request):
         """
-        GET /api/chat/messages/?user_id=2[&after=10]
-        Returns messages between logged-in user and user_id.
-        If 'after' is passed, only return messages with id > after.
+        GET /api/chat/messages/?user_id=2[&before=80 | &after=10][&limit=50][&wait=25]
+        Returns messages between logged-in user and user_id, oldest → newest.
+
+        No cursor: the newest `limit` messages (first open of a chat).
+        'before': the `limit` messages right before that id (scrolling back).
+        'after':  up to `limit` messages with id > after (new messages).
+        'wait' is handled by message_list_create_view before we get here.
+        Sends an ETag; a matching If-None-Match gets a 304.
+
+        Accept: application/vnd.chat.compact+json (or application/vnd.msgpack,
+        or ?format=compact / msgpack) gets the page column-oriented, with
+        the usernames once (chat.serializers.compact_message_rows).
         """
         other_user_id = request.query_params.get("user_id")
         if not other_user_id:
@@ -46,7 +64,29 @@ class MessageListCreateView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        after_id = request.query_params.get("after")
+        try:
+            other_user_id = int(other_user_id)
+            after_id = self.get_int_param(request, "after")
+            before_id = self.get_int_param(request, "before")
+            limit = self.get_int_param(request, "limit") or settings.MESSAGE_PAGE_SIZE
+        except ValueError:
+            return Response(
+                {"detail": "user_id, after, before and limit must be integers"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        limit = min(max(limit, 1), settings.MESSAGE_PAGE_SIZE_MAX)
+
+        user = request.user
+
+        # The page only changes with a new message or a moved read
+        # watermark, all on the Conversation row: an unchanged poll is
+        # answered with a 304 after this one primary-key lookup.
+        version = Conversation.objects.for_pair(user.id, other_user_id).values_list(
+            "id", "last_message_id", "last_read_low", "last_read_high"
+        ).first()
+        response = not_modified(request, make_etag(request, version))
+        if response is not None:
+            return response
 
         try:
             other_user = User.objects.get(id=other_user_id)
@@ -56,25 +96,77 @@ class MessageListCreateView(APIView):
                 status=status.HTTP_404_NOT_FOUND,
             )
 
-        user = request.user
-
-        qs = Message.objects.filter(
-            sender__in=[user, other_user],
-            receiver__in=[user, other_user],
-        ).order_by("id")
-
-        # Mark all messages FROM otherUser TO currentUser as read
-        Message.objects.filter(
-            sender=other_user,
-            receiver=request.user,
-            is_read=False,
-        ).update(is_read=True)
-
-        if after_id:
-            qs = qs.filter(id__gt=after_id)
+        conversation_key = Message.make_conversation_key(user.id, other_user.id)
+
+        # (conversation_key, id) index: every page is one index range scan
+        qs = Message.objects.filter(conversation_key=conversation_key)
+
+        # Older messages may live in cold storage; the archive holds exactly
+        # the ids below the hot table.
+        archive = get_archive(conversation_key)
+        users = {user.id: user, other_user.id: other_user}
+
+        # values() with both usernames joined in: one query for the page and
+        # no model instances (serialize_message_rows keeps the schema)
+        if after_id is not None:
+            # A cursor inside the archive: the page starts there, and the
+            # hot table fills the rest
+            messages = []
+            if after_id < archive.last_id:
+                messages = [to_values(row, users) for row in archive.after(after_id, limit)]
+            if len(messages) < limit:
+                hot_after = messages[-1]["id"] if messages else after_id
+                messages += message_rows(
+                    qs.filter(id__gt=hot_after).order_by("id")[:limit - len(messages)]
+                )
+        else:
+            if before_id is not None:
+                qs = qs.filter(id__lt=before_id)
+            messages = list(message_rows(qs.order_by("-id")[:limit]))
+            messages.reverse()
+
+            # Hot rows are the newest, so only a short page reaches back
+            if len(messages) < limit and archive.last_id:
+                boundary = messages[0]["id"] if messages else before_id
+                rows = archive.before(boundary, limit - len(messages))
+                messages = [to_values(row, users) for row in rows] + messages
+
+        # Everything up to the newest message we hand out counts as read.
+        # Moves the watermark on the Conversation row (no write if it
+        # is already there); the messages themselves aren't touched.
+        conversation, changed = Conversation.objects.mark_read(
+            user.id, other_user.id, up_to=messages[-1]["id"] if messages else 0
+        )
+        if changed:
+            publish_read(conversation, user.id)
+
+        watermarks = conversation.read_watermarks() if conversation else {}
+        with measure_serialization():
+            if request.accepted_renderer.format in COMPACT_FORMATS:
+                users = {user.id: user.username, other_user.id: other_user.username}
+                data = compact_message_rows(messages, watermarks, users)
+            else:
+                data = serialize_message_rows(messages, watermarks)
+
+        # Newest message as of the check above (the page holds at least
+        # that much) and the watermarks is_read was computed from
+        if conversation is not None:
+            version = (
+                conversation.id,
+                version[1] if version else None,
+                conversation.last_read_low,
+                conversation.last_read_high,
+            )
+        return with_etag(
+            Response(data, status=status.HTTP_200_OK), make_etag(request, version)
+        )
 
-        serializer = MessageSerializer(qs, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+    @staticmethod
+    def get_int_param(request, name):
+        value = request.query_params.get(name)
+        if value in (None, ""):
+            return None
+        return int(value)
 
     def post(self, request):
         """
@@ -83,7 +175,7 @@ class MessageListCreateView(APIView):
         sender = request.user
         """
 
-        # 🔹 Rate limit: max 20 sent messages per minute per IP
+        # 🔹 Rate limit: max 20 sent messages per minute per IP and per user
         if rate_limit(request, action="send_message", limit=20, window_seconds=60):
             return Response(
                 {"detail": "Too many messages sent. Try again later."},
@@ -105,15 +197,17 @@ class MessageListCreateView(APIView):
                 status=status.HTTP_404_NOT_FOUND,
             )
 
+        blocked_by_me, blocked_me = block_cache.status(request.user.id, receiver.id)
+
         # 1) You blocked them → you can't send
-        if Block.objects.filter(blocker=request.user, blocked=receiver).exists():
+        if blocked_by_me:
             return Response(
                 {"detail": "You blocked this user."},
                 status=status.HTTP_403_FORBIDDEN,
             )
 
         # 2) They blocked you → you can't send
-        if Block.objects.filter(blocker=receiver, blocked=request.user).exists():
+        if blocked_me:
             return Response(
                 {"detail": "This user has blocked you."},
                 status=status.HTTP_403_FORBIDDEN,
@@ -124,12 +218,460 @@ class MessageListCreateView(APIView):
             context={"request": request},
         )
         if serializer.is_valid():
-            serializer.save()
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+            # Message + its Conversation row (chat.signals) in one transaction
+            with transaction.atomic():
+                message = serializer.save()
+
+            # Nobody has read it yet; saves a watermark lookup in is_read
+            serializer.context["read_watermarks"] = {message.conversation_key: {}}
+            data = serializer.data
+
+            publish_created(data)
+            return Response(data, status=status.HTTP_201_CREATED)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class MarkReadView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request):
+        """
+        POST /api/chat/messages/read/
+        body: { "user_id": 2, "up_to": 120 }
+        -> everything user_id sent me up to message 120 is read
+           (no "up_to" = the whole conversation)
+
+        Returns { "last_read": 120, "unread": 0 }
+        """
+        user_id = request.data.get("user_id")
+        up_to = request.data.get("up_to")
+        try:
+            user_id = int(user_id)
+            up_to = int(up_to) if up_to is not None else None
+        except (TypeError, ValueError):
+            return Response(
+                {"detail": "user_id (and up_to, if given) must be integers"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        conversation, changed = Conversation.objects.mark_read(
+            request.user.id, user_id, up_to=up_to
+        )
+        if conversation is None:
+            return Response(
+                {"detail": "No conversation with this user."},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        if changed:
+            publish_read(conversation, request.user.id)
+
+        side = "low" if request.user.id == conversation.user_low_id else "high"
+        return Response(
+            {
+                "last_read": getattr(conversation, f"last_read_{side}"),
+                "unread": getattr(conversation, f"unread_{side}"),
+            },
+            status=status.HTTP_200_OK,
+        )
+
+
+class MessageBatchCreateView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request):
+        """
+        POST /api/chat/messages/batch/
+        body: { "messages": [ { "client_id": "a1", "receiver": 2, "content": "hi" }, ... ] }
+
+        Sends queued messages in one request (e.g. after a reconnect).
+        Receivers and blocks are checked for the whole batch at once, and
+        all accepted messages are written with one bulk INSERT.
+        They count against the same limit as POST /api/chat/messages/
+        (20 a minute): a batch that would go over it is refused as a whole.
+
+        Returns per client_id:
+        { "results": {
+            "a1": { "status": 201, "message": { ...MessageSerializer... } },
+            "a2": { "status": 403, "detail": "This user has blocked you." }
+        } }
+        """
+        if rate_limit(request, action="send_message_batch", limit=10, window_seconds=60):
+            return Response(
+                {"detail": "Too many messages sent. Try again later."},
+                status=status.HTTP_429_TOO_MANY_REQUESTS,
+            )
+
+        items = request.data.get("messages") if isinstance(request.data, dict) else None
+        if not isinstance(items, list) or not items:
+            return Response(
+                {"detail": "messages must be a non-empty list"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if len(items) > settings.MESSAGE_BATCH_MAX:
+            return Response(
+                {"detail": f"At most {settings.MESSAGE_BATCH_MAX} messages per batch."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        client_ids = [str(item.get("client_id", "")) if isinstance(item, dict) else "" for item in items]
+        if "" in client_ids or len(set(client_ids)) != len(client_ids):
+            return Response(
+                {"detail": "Every message needs a unique client_id."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        results = dict.fromkeys(client_ids)  # keeps the request order
+        valid = []  # (client_id, receiver_id, content)
+        for client_id, item in zip(client_ids, items):
+            receiver_id = item.get("receiver")
+            content = item.get("content")
+            try:
+                receiver_id = int(receiver_id)
+            except (TypeError, ValueError):
+                results[client_id] = {"status": 400, "detail": "receiver is required"}
+                continue
+            if not isinstance(content, str) or not content.strip():
+                results[client_id] = {"status": 400, "detail": "content is required"}
+                continue
+            # Same trimming and limit as MessageSerializer's content field
+            content = content.strip()
+            if len(content) > settings.MESSAGE_MAX_LENGTH:
+                results[client_id] = {
+                    "status": 400,
+                    "detail": f"content is longer than {settings.MESSAGE_MAX_LENGTH} characters",
+                }
+                continue
+            valid.append((client_id, receiver_id, content))
+
+        receivers = User.objects.only("id", "username").in_bulk(
+            {receiver_id for _, receiver_id, _ in valid}
+        )
+        blocking, blocked_by = block_cache.get(request.user.id)
+
+        to_create = []  # (client_id, Message)
+        for client_id, receiver_id, content in valid:
+            if receiver_id not in receivers:
+                results[client_id] = {"status": 404, "detail": "Receiver not found"}
+            elif receiver_id in blocking:
+                results[client_id] = {"status": 403, "detail": "You blocked this user."}
+            elif receiver_id in blocked_by:
+                results[client_id] = {"status": 403, "detail": "This user has blocked you."}
+            else:
+                to_create.append((client_id, Message(
+                    sender=request.user,
+                    receiver=receivers[receiver_id],
+                    content=content,
+                    conversation_key=Message.make_conversation_key(request.user.id, receiver_id),
+                )))
+
+        if to_create and rate_limit(
+            request, action="send_message", limit=20, window_seconds=60, cost=len(to_create)
+        ):
+            return Response(
+                {"detail": "Too many messages sent. Try again later."},
+                status=status.HTTP_429_TOO_MANY_REQUESTS,
+            )
+
+        if to_create:
+            messages = [message for _, message in to_create]
+            with transaction.atomic():
+                Message.objects.bulk_create(messages)
+                Conversation.objects.record_messages(messages)
+
+            serializer = MessageSerializer(
+                messages,
+                many=True,
+                context={"read_watermarks": {m.conversation_key: {} for m in messages}},
+            )
+            for (client_id, _), data in zip(to_create, serializer.data):
+                results[client_id] = {"status": 201, "message": data}
+                publish_created(data)
+
+        return Response({"results": results}, status=status.HTTP_200_OK)
+
+
+class MessageSearchView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    MAX_LIMIT = 50
+
+    def get(self, request):
+        """
+        GET /api/chat/search/?q=hello[&user_id=2][&limit=20&offset=0]
+
+        Searches the messages of the current user's conversations (or only
+        the one with user_id), best match first. Conversations with users
+        blocked either way are left out.
+
+        Returns:
+        {
+          "results": [ { "message": { ...MessageSerializer... }, "snippet": "…say «hello» to…" } ],
+          "next_offset": 20   (null on the last page)
+        }
+        """
+        query = request.query_params.get("q", "")
+        if not query.strip():
+            return Response(
+                {"detail": "q query param is required"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            other_user_id = request.query_params.get("user_id")
+            other_user_id = int(other_user_id) if other_user_id else None
+            limit = min(max(int(request.query_params.get("limit", 20)), 1), self.MAX_LIMIT)
+            offset = max(int(request.query_params.get("offset", 0)), 0)
+        except ValueError:
+            return Response(
+                {"detail": "user_id, limit and offset must be integers"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        blocking, blocked_by = block_cache.get(request.user.id)
+
+        hits = get_search_backend().search(
+            request.user.id,
+            query,
+            exclude_user_ids=sorted(blocking | blocked_by),
+            other_user_id=other_user_id,
+            limit=limit,
+            offset=offset,
+        )
+
+        messages = Message.objects.select_related("sender", "receiver").in_bulk(
+            [message_id for message_id, _ in hits]
+        )
+        context = {}  # one read-watermark lookup per conversation, not per hit
+        results = [
+            {
+                "message": MessageSerializer(messages[message_id], context=context).data,
+                "snippet": snippet,
+            }
+            for message_id, snippet in hits
+            if message_id in messages
+        ]
+
+        return Response(
+            {
+                "results": results,
+                "next_offset": offset + limit if len(hits) == limit else None,
+            },
+            status=status.HTTP_200_OK,
+        )
+
+
+class MessageExportView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    CHUNK_SIZE = 500
+    CHUNK_BYTES = 64 * 1024
+
+    def get(self, request):
+        """
+        GET /api/chat/messages/export/?user_id=2
+        The whole conversation (archived messages included) as NDJSON, one
+        MessageSerializer object per line, oldest first. Streamed: rows are
+        read CHUNK_SIZE at a time, and a chunk goes out every CHUNK_SIZE
+        rows or CHUNK_BYTES, so memory use doesn't grow with the
+        conversation. Gzip'ed on the fly if the client sends
+        Accept-Encoding: gzip.
+
+        Under ASGI the body is an async iterator pulling one chunk at a time
+        from a thread; Django would buffer a sync one whole.
+        """
+        other_user_id = request.query_params.get("user_id")
+        if not other_user_id:
+            return Response(
+                {"detail": "user_id query param is required"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            other_user = User.objects.get(id=other_user_id)
+        except (User.DoesNotExist, ValueError):
+            return Response(
+                {"detail": "User not found"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        user = request.user
+        conversation_key = Message.make_conversation_key(user.id, other_user.id)
+        gzipped = "gzip" in request.headers.get("Accept-Encoding", "")
+
+        chunks = self.iter_lines(user, other_user, conversation_key)
+        if gzipped:
+            chunks = self.gzip(chunks)
+        if isinstance(request._request, ASGIRequest):
+            chunks = self.iterate_async(chunks)
+        response = StreamingHttpResponse(chunks, content_type="application/x-ndjson")
+        response["Content-Disposition"] = (
+            f'attachment; filename="conversation-{conversation_key.replace(":", "-")}.ndjson"'
+        )
+        response["Vary"] = "Accept-Encoding"
+        if gzipped:
+            response["Content-Encoding"] = "gzip"
+        return response
+
+    def iter_lines(self, user, other_user, conversation_key):
+        """
+        Yields one bytes chunk per CHUNK_SIZE messages (or fewer, once
+        CHUNK_BYTES are pending).
+        """
+        users = {user.id: user, other_user.id: other_user}
+        conversation = Conversation.objects.for_pair(user.id, other_user.id).first()
+        context = {
+            "read_watermarks": {
+                conversation_key: conversation.read_watermarks() if conversation else {},
+            },
+        }
+
+        archive = get_archive(conversation_key)
+        archived_up_to = archive.last_id
+        messages = (
+            to_message(row, conversation_key, users) for row in archive.iter_rows()
+        )
+        lines = []
+        pending = 0
+
+        def dump(message):
+            if message.sender_id in users:  # no per-row user lookups
+                message.sender = users[message.sender_id]
+                message.receiver = users[message.receiver_id]
+            data = MessageSerializer(message, context=context).data
+            return json.dumps(data, ensure_ascii=False)
+
+        hot = (
+            Message.objects.filter(conversation_key=conversation_key, id__gt=archived_up_to)
+            .order_by("id")
+            .iterator(chunk_size=self.CHUNK_SIZE)
+        )
+        for message in itertools.chain(messages, hot):
+            lines.append(dump(message))
+            pending += len(lines[-1])
+            if len(lines) >= self.CHUNK_SIZE or pending >= self.CHUNK_BYTES:
+                yield ("\n".join(lines) + "\n").encode()
+                lines = []
+                pending = 0
+
+        if lines:
+            yield ("\n".join(lines) + "\n").encode()
+
+    @staticmethod
+    def gzip(chunks):
+        compressor = zlib.compressobj(wbits=31)  # gzip container
+        for chunk in chunks:
+            # Sync flush so every chunk reaches the client right away
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+    @staticmethod
+    async def iterate_async(chunks):
+        # Thread-sensitive: every step runs in the same thread, which owns
+        # the DB connection the row iterator reads from
+        next_chunk = sync_to_async(next)
+        chunks = iter(chunks)
+        while (chunk := await next_chunk(chunks, None)) is not None:
+            yield chunk
+
+
+def publish_created(message_data):
+    """
+    Push a new message to both sides once the row is committed: the
+    receiver's sockets, and any long-poll the sender has open on this chat,
+    in whichever worker they are (chat.events delivers it).
+    """
+    event = {"type": "message.created", "message": message_data}
+    transaction.on_commit(lambda: get_bus().publish(event))
+
+
+def publish_read(conversation, reader_id):
+    """
+    Tell both sides the reader's watermark moved (✓✓ for the sender, and
+    the reader's other devices clear their unread badge).
+    """
+    event = messages_read_event(conversation, reader_id)
+    transaction.on_commit(lambda: get_bus().publish(event))
+
+
+message_list_create = MessageListCreateView.as_view()
+
+
+def has_messages_after(user_id, other_user_id, after_id):
+    try:
+        return Message.objects.filter(
+            conversation_key=Message.make_conversation_key(user_id, other_user_id),
+            id__gt=after_id,
+        ).exists()
+    finally:
+        # Don't keep a DB connection open while the request is parked.
+        connection.close()
+
+
+async def wait_for_messages(request):
+    """
+    Park a GET ...?user_id=2&after=10&wait=25 until a message with id > after
+    shows up in that conversation, or `wait` seconds pass.
+    Auth / validation errors are left to MessageListCreateView.
+    """
+    try:
+        wait = float(request.GET["wait"])
+        other_user_id = int(request.GET["user_id"])
+        after_id = int(request.GET["after"])
+    except (KeyError, ValueError):
+        return
+
+    # float() takes "nan" and "inf" too
+    if not math.isfinite(wait) or wait <= 0:
+        return
+    wait = min(wait, settings.LONG_POLL_MAX_WAIT)
+
+    header = request.META.get("HTTP_AUTHORIZATION", "").split()
+    if len(header) != 2 or header[0] != "Bearer":
+        return
+
+    user = await authenticate(header[1].encode())
+    if user is None:
+        return
+
+    def is_new_message(event):
+        message = event.get("message") or {}
+        return (
+            event["type"] == "message.created"
+            and message["id"] > after_id
+            and other_user_id in (message["sender"], message["receiver"])
+        )
+
+    # Subscribe before checking the DB so nothing slips in between.
+    subscription = notifier.subscribe(user.id)
+    try:
+        if await sync_to_async(has_messages_after)(user.id, other_user_id, after_id):
+            return
+        await subscription.wait_for(is_new_message, wait)
+    finally:
+        subscription.close()
+
+
+@csrf_exempt
+async def message_list_create_view(request, *args, **kwargs):
+    """
+    Async entry point for /api/chat/messages/.
+
+    Adds the long-poll mode (?wait=<seconds>) in front of the normal view:
+    while parked, the request holds neither a worker thread nor a DB
+    connection (when served by coreBackend.asgi).
+    """
+    if request.method == "GET" and "wait" in request.GET:
+        await wait_for_messages(request)
+
+    return await sync_to_async(message_list_create)(request, *args, **kwargs)
+
+
+# Report it under the class name (coreBackend.middleware)
+message_list_create_view.view_class = MessageListCreateView
+
+
 class BlockView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
@@ -187,6 +729,82 @@ class BlockView(APIView):
         return Response({"blocked": False}, status=status.HTTP_200_OK)
 
 
+class DeviceListView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        """
+        GET /api/chat/devices/
+        The current user's devices (WebSocket ?device=<id>), connected first.
+        [
+          { "device_id": "phone-3f9a", "connected": true, "delivered_up_to": 812,
+            "connected_at": "...", "disconnected_at": "..." }
+        ]
+        """
+        return Response(device_list(request.user.id), status=status.HTTP_200_OK)
+
+
+class EphemeralStateView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        """
+        GET /api/chat/states/
+        Poll fallback for clients without a WebSocket: the transient states
+        ("typing"...) other users currently show the current user. Read from
+        memory only (chat.ephemeral), so it is cheap to poll every few seconds.
+        [
+          { "user_id": 2, "state": "typing", "expires_in": 4.2 }
+        ]
+        """
+        return Response(states_for(request.user.id), status=status.HTTP_200_OK)
+
+    def post(self, request):
+        """
+        POST /api/chat/states/
+        { "user_id": 3, "state": "typing", "active": true }
+        Shows user 3 the state for EPHEMERAL_STATE_TTL seconds: re-send it
+        while it holds, or "active": false to clear it. Nothing is saved.
+        """
+        if rate_limit(request, action="ephemeral_state", limit=STATE_RATE_LIMIT, window_seconds=60):
+            return Response(
+                {"detail": "Too many requests. Try again later."},
+                status=status.HTTP_429_TOO_MANY_REQUESTS,
+            )
+
+        state = request.data.get("state", "typing")
+        try:
+            receiver_id = int(request.data.get("user_id"))
+        except (TypeError, ValueError):
+            return Response(
+                {"detail": "user_id must be an integer"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if state not in settings.EPHEMERAL_STATES:
+            return Response(
+                {"detail": f"state must be one of: {', '.join(settings.EPHEMERAL_STATES)}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if receiver_id == request.user.id:
+            return Response(
+                {"detail": "You cannot send a state to yourself."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        active = request.data.get("active", True) not in (False, "false", "0", 0)
+        if not signal_state(request.user.id, receiver_id, state, active):
+            return Response(
+                {"detail": "You cannot send a state to this user."},
+                status=status.HTTP_403_FORBIDDEN,
+            )
+
+        return Response(
+            {"user_id": receiver_id, "state": state, "active": active,
+             "ttl": settings.EPHEMERAL_STATE_TTL},
+            status=status.HTTP_200_OK,
+        )
+
+
 class BlockStatusView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
@@ -215,15 +833,7 @@ class BlockStatusView(APIView):
                 status=status.HTTP_404_NOT_FOUND,
             )
 
-        blocked_by_me = Block.objects.filter(
-            blocker=request.user,
-            blocked=other_user,
-        ).exists()
-
-        blocked_me = Block.objects.filter(
-            blocker=other_user,
-            blocked=request.user,
-        ).exists()
+        blocked_by_me, blocked_me = block_cache.status(request.user.id, other_user.id)
 
         return Response(
             {
@@ -240,20 +850,22 @@ class UnreadCountView(APIView):
     def get(self, request):
         """
         Returns unread messages count grouped by sender.
+        Read from the per-conversation counters (chat.Conversation),
+        kept up to date on send / read. Sends an ETag (If-None-Match → 304).
         Example:
         [
            { "user_id": 2, "count": 5 },
            { "user_id": 4, "count": 1 }
         ]
         """
-        unread = Message.objects.filter(
-            receiver=request.user,
-            is_read=False,
-        ).values("sender").annotate(count=models.Count("id"))
+        etag = make_etag(request, Conversation.objects.version(request.user.id))
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
 
         data = [
-            {"user_id": item["sender"], "count": item["count"]}
-            for item in unread
+            {"user_id": user_id, "count": count}
+            for user_id, count in Conversation.objects.unread_counts(request.user.id)
         ]
 
-        return Response(data, status=200)
+        return with_etag(Response(data, status=200), etag)
@@ -0,0 +1,46 @@
+"""
+Conditional GET for the polled endpoints.
+
+Views compute a cheap version token for what they are about to return
+(e.g. the newest message id and read watermarks of a conversation), turn
+it into an ETag with make_etag() and return not_modified() before doing
+the expensive part. The ETag also covers the user and the full URL, so
+different pages / parameters never share one.
+"""
+import hashlib
+
+from django.utils.cache import parse_etags, patch_vary_headers
+from rest_framework import status
+from rest_framework.response import Response
+
+
+def make_etag(request, *version):
+    # The negotiated media type too: one URL, several representations
+    media_type = getattr(request, "accepted_media_type", None)
+    digest = hashlib.blake2b(
+        repr((request.user.id, request.get_full_path(), media_type, version)).encode(),
+        digest_size=12,
+    )
+    return f'"{digest.hexdigest()}"'
+
+
+def not_modified(request, etag):
+    """
+    A 304 response if the client's If-None-Match has `etag`, else None.
+    """
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return None
+
+    etags = parse_etags(header)
+    if "*" in etags or etag in etags:
+        return with_etag(Response(status=status.HTTP_304_NOT_MODIFIED), etag)
+    return None
+
+
+def with_etag(response, etag):
+    response["ETag"] = etag
+    # Same URL, different users or media types (every DRF view negotiates,
+    # some offer compact formats): shared caches must not mix them up
+    patch_vary_headers(response, ["Accept", "Authorization"])
+    return response
@@ -0,0 +1,281 @@
+"""
+Publish / subscribe between the worker processes.
+
+Writes happen in whichever worker handled the request, but the effects
+must reach all of them: a message has to be pushed to the receiver's
+WebSocket wherever it is connected, a block has to drop every worker's
+block cache, a user coming online has to show up in every worker.
+
+    bus = get_bus()
+    bus.subscribe("message.created", handler)   # at startup, in every worker
+    bus.publish({"type": "message.created", ...})
+
+publish() runs this process' handlers right away (in the calling thread)
+and sends the event to the other processes, whose handlers run in a
+background thread there. A process only receives once it has called
+start(); that happens on the first request or WebSocket a worker serves
+(start_listening), so management commands (migrate, shell, ...) and the
+master of a preloading server (gunicorn --preload) never bind anything,
+and every forked worker binds its own listener. Events are JSON; delivery is best effort (a
+worker that is restarting misses what was sent meanwhile), so state that
+must be exact keeps its own fallback (e.g. chat.blocks' version file).
+
+Configured with settings.EVENT_BUS = {"BACKEND": ..., "LOCATION": ...}:
+
+- LocalBackend:      this process only, no LOCATION.
+- UnixSocketBackend: one host, any number of workers; LOCATION is a
+                     directory where every process binds a datagram socket.
+- RedisBackend:      several hosts; LOCATION is a redis:// URL (any server
+                     speaking the Redis protocol and PUBLISH/SUBSCRIBE).
+"""
+import atexit
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+
+class BaseBackend:
+    def __init__(self, **options):
+        self.origin = uuid.uuid4().hex  # tells our own events apart
+        self._lock = threading.Lock()
+        self._handlers = defaultdict(list)
+
+    def subscribe(self, event_type, handler):
+        """
+        Call handler(event) for every event of that type, from any process.
+        """
+        with self._lock:
+            if handler not in self._handlers[event_type]:
+                self._handlers[event_type].append(handler)
+
+    def publish(self, event):
+        self.dispatch(event)
+
+        payload = json.dumps(
+            {"origin": self.origin, "event": event}, cls=DjangoJSONEncoder
+        ).encode()
+        try:
+            self.send(payload)
+        except Exception:
+            # The write that triggered the event already happened; never
+            # fail the request over it.
+            logger.exception("Could not publish %s event", event.get("type"))
+
+    def dispatch(self, event):
+        with self._lock:
+            handlers = list(self._handlers.get(event.get("type"), ()))
+
+        for handler in handlers:
+            try:
+                handler(event)
+            except Exception:
+                logger.exception("Event handler %r failed", handler)
+
+    def receive(self, payload):
+        """
+        An event sent by a publish() somewhere (maybe this process).
+        """
+        try:
+            envelope = json.loads(payload)
+        except ValueError:
+            logger.warning("Dropped a malformed event (%d bytes)", len(payload))
+            return
+        if envelope.get("origin") != self.origin:
+            self.dispatch(envelope["event"])
+
+    def start(self):
+        """
+        Start receiving events from other processes (idempotent, and
+        cheap once started: called for every request).
+        """
+
+    def send(self, payload):
+        """
+        Deliver the encoded event to the other processes.
+        """
+        raise NotImplementedError
+
+
+class LocalBackend(BaseBackend):
+    """
+    Handlers of this process only: enough for a single worker.
+    """
+
+    def send(self, payload):
+        pass
+
+
+class UnixSocketBackend(BaseBackend):
+    """
+    Every process binds a Unix datagram socket "<pid>.sock" in LOCATION and
+    publish() sends one datagram to each socket found there; the kernel
+    copies it straight into the other worker's receive queue, so events
+    arrive in well under a millisecond. Sockets left behind by dead
+    processes are removed by the first publish() that finds them. POSIX only.
+
+    An event has to fit in one datagram (MAX_EVENT_BYTES); a worker whose
+    receive queue is full (stuck, or not reading) misses the event.
+    """
+    MAX_EVENT_BYTES = 64 * 1024
+
+    def __init__(self, LOCATION=None, **options):
+        super().__init__(**options)
+        if not LOCATION:
+            raise ImproperlyConfigured("UnixSocketBackend needs EVENT_BUS['LOCATION'] (a directory).")
+        self.location = str(LOCATION)
+        self._socket = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    @property
+    def path(self):
+        return os.path.join(self.location, f"{os.getpid()}.sock")
+
+    def start(self):
+        # Re-bind after a fork: the socket inherited from the parent
+        # belongs to the parent (and its thread didn't survive the fork).
+        if self._pid == os.getpid():
+            return
+
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+
+            os.makedirs(self.location, exist_ok=True)
+            path = self.path
+            try:
+                os.unlink(path)  # left by a dead process with our pid
+            except FileNotFoundError:
+                pass
+
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+            sock.bind(path)
+            self._socket = sock
+            self._pid = os.getpid()
+
+            threading.Thread(
+                target=self._listen, args=(sock,), name="eventbus", daemon=True
+            ).start()
+            atexit.register(self._remove, path)
+
+    def send(self, payload):
+        if len(payload) > self.MAX_EVENT_BYTES:
+            logger.warning("Event of %d bytes is too large to publish", len(payload))
+            return
+
+        own_path = self.path
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.setblocking(False)
+        try:
+            for entry in os.scandir(self.location):
+                if not entry.name.endswith(".sock") or entry.path == own_path:
+                    continue
+                try:
+                    sender.sendto(payload, entry.path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    self._remove(entry.path)  # its process is gone
+                except BlockingIOError:
+                    logger.warning("Event bus: %s is not keeping up, event dropped", entry.name)
+        except FileNotFoundError:
+            pass  # nobody has subscribed on this host yet
+        finally:
+            sender.close()
+
+    def _listen(self, sock):
+        while True:
+            try:
+                payload = sock.recv(self.MAX_EVENT_BYTES)
+            except OSError:
+                return  # closed
+            self.receive(payload)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+class RedisBackend(BaseBackend):
+    """
+    One PUBLISH per event on OPTIONS["CHANNEL"]; every process keeps a
+    SUBSCRIBE connection open in a background thread, and reconnects if it
+    drops (events sent while it was down are lost).
+    Needs the `redis` package.
+    """
+    RECONNECT_DELAY = 1.0
+
+    def __init__(self, LOCATION=None, OPTIONS=None, **options):
+        super().__init__(**options)
+        try:
+            import redis
+        except ImportError as exc:
+            raise ImproperlyConfigured("RedisBackend requires the 'redis' package.") from exc
+
+        self.client = redis.Redis.from_url(LOCATION or "redis://localhost:6379/0")
+        self.channel = (OPTIONS or {}).get("CHANNEL", "coreBackend.events")
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._listen, name="eventbus", daemon=True).start()
+
+    def send(self, payload):
+        self.client.publish(self.channel, payload)
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self.receive(message["data"])
+            except Exception:
+                logger.exception("Event bus subscription lost, reconnecting")
+                time.sleep(self.RECONNECT_DELAY)
+
+
+_bus = None
+_bus_lock = threading.Lock()
+
+
+def get_bus():
+    global _bus
+    if _bus is None:
+        with _bus_lock:
+            if _bus is None:
+                config = dict(settings.EVENT_BUS)
+                backend_class = import_string(config.pop("BACKEND"))
+                _bus = backend_class(**config)
+    return _bus
+
+
+def start_listening(**kwargs):
+    """
+    request_started receiver (see chat.events.connect): this worker serves
+    requests, so it should receive events too.
+    """
+    get_bus().start()
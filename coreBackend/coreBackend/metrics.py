@@ -0,0 +1,233 @@
+"""
+Request instrumentation: per-request timings (coreBackend.middleware adds
+them as a Server-Timing header) and per-view histograms served in the
+Prometheus text format at /metrics.
+
+Every DB connection gets an execute wrapper when it is created; it adds
+each query to the stats of the request being handled (a contextvar, so it
+follows the request into sync_to_async threads) and notes queries slower
+than settings.SLOW_QUERY_THRESHOLD_MS. Those are logged to the
+"coreBackend.slow_queries" logger when the request ends, once its view is
+known (middleware may query before the view is resolved); queries
+outside any request are logged right away, under view "-" (plus the
+thread name, in the log line only).
+
+Metrics live in the memory of each worker process; a scrape only sees
+the process that answered it.
+"""
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseForbidden
+
+
+slow_query_logger = logging.getLogger("coreBackend.slow_queries")
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class RequestStats:
+    __slots__ = ("view", "db_queries", "db_time", "serialization_time", "slow_queries")
+
+    def __init__(self):
+        self.view = None
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.serialization_time = 0.0
+        self.slow_queries = []  # (ms, sql)
+
+
+current_stats = ContextVar("request_stats", default=None)
+
+
+@contextmanager
+def measure_serialization():
+    """
+    Count the time spent in the block as serialization of this request.
+    """
+    stats = current_stats.get()
+    if stats is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.serialization_time += time.perf_counter() - start
+
+
+def record_query(execute, sql, params, many, context):
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+        stats = current_stats.get()
+        if stats is not None:
+            stats.db_queries += 1
+            stats.db_time += elapsed
+
+        threshold = settings.SLOW_QUERY_THRESHOLD_MS
+        if threshold and elapsed * 1000 >= threshold:
+            if stats is not None:
+                stats.slow_queries.append((elapsed * 1000, sql))
+            else:
+                log_slow_query("-", elapsed * 1000, sql)
+
+
+def log_slow_query(view, ms, sql):
+    slow_queries.inc(view)
+    if view == "-" and threading.current_thread() is not threading.main_thread():
+        view = f"-:{threading.current_thread().name}"  # e.g. the presence flusher
+    slow_query_logger.warning("%.1f ms [%s] %s", ms, view, sql)
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def install():
+    """
+    Instrument new connections, and those already open in this thread
+    (e.g. opened by startup checks before the middleware was loaded).
+    """
+    connection_created.connect(install_query_recorder, dispatch_uid="coreBackend.metrics")
+    for connection in connections.all(initialized_only=True):
+        install_query_recorder(None, connection)
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}  # label values -> [bucket counts..., count, sum]
+
+    def observe(self, label_values, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted(self._series.items())
+        for label_values, values in series:
+            labels = format_labels(self.labels, label_values)
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {values[-2]}')
+            lines.append(f"{self.name}_count{{{labels}}} {values[-2]}")
+            lines.append(f"{self.name}_sum{{{labels}}} {values[-1]:.6f}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, documentation, labels):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def inc(self, *label_values):
+        with self._lock:
+            self._series[label_values] = self._series.get(label_values, 0) + 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            series = sorted(self._series.items())
+        for label_values, value in series:
+            lines.append(f"{self.name}{{{format_labels(self.labels, label_values)}}} {value}")
+        return lines
+
+
+def format_labels(names, values):
+    return ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values))
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+request_duration = Histogram(
+    "http_request_duration_seconds", "Wall time per request.", ("view", "method"), TIME_BUCKETS
+)
+request_db_duration = Histogram(
+    "http_request_db_duration_seconds", "Time spent in DB queries per request.",
+    ("view", "method"), TIME_BUCKETS,
+)
+request_db_queries = Histogram(
+    "http_request_db_queries", "DB queries per request.", ("view", "method"), QUERY_BUCKETS
+)
+request_serialization = Histogram(
+    "http_request_serialization_seconds", "Time spent serializing / rendering per request.",
+    ("view", "method"), TIME_BUCKETS,
+)
+requests_total = Counter(
+    "http_requests_total", "Requests by view, method and status.", ("view", "method", "status")
+)
+slow_queries = Counter(
+    "db_slow_queries_total", "Queries slower than SLOW_QUERY_THRESHOLD_MS.", ("view",)
+)
+
+METRICS = (
+    request_duration,
+    request_db_duration,
+    request_db_queries,
+    request_serialization,
+    requests_total,
+    slow_queries,
+)
+
+
+def observe_request(stats, method, status, duration):
+    labels = (stats.view, method)
+    request_duration.observe(labels, duration)
+    request_db_duration.observe(labels, stats.db_time)
+    request_db_queries.observe(labels, stats.db_queries)
+    request_serialization.observe(labels, stats.serialization_time)
+    requests_total.inc(stats.view, method, status)
+    for ms, sql in stats.slow_queries:
+        log_slow_query(stats.view, ms, sql)
+
+
+def metrics_view(request):
+    """
+    GET /metrics  (Prometheus text format)
+    Requires "Authorization: Bearer <settings.METRICS_TOKEN>"; without a
+    token configured it is only served with DEBUG on.
+    """
+    if settings.METRICS_TOKEN:
+        if request.headers.get("Authorization") != f"Bearer {settings.METRICS_TOKEN}":
+            return HttpResponseForbidden()
+    elif not settings.DEBUG:
+        return HttpResponseForbidden()
+
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.expose())
+    return HttpResponse(
+        "\n".join(lines) + "\n", content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
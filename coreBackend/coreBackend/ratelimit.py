@@ -0,0 +1,254 @@
+"""
+Sliding-window rate limiting shared by the accounts and chat views.
+
+Counts are kept per fixed window; a request is allowed while
+
+    previous_window_count * (share of the previous window still in range)
+    + current_window_count  <  limit
+
+which approximates a true sliding window with two counters per key.
+Every backend checks and increments atomically, for several keys at once
+(per user and per IP): either all of them count the attempt or none does.
+
+Configured with settings.RATE_LIMIT = {"BACKEND": ..., "LOCATION": ...}:
+
+- LocMemBackend: per process, no LOCATION.
+- FileBackend:   one host, any number of workers; LOCATION is a directory.
+- RedisBackend:  several hosts; LOCATION is a redis:// URL (any server
+                 speaking the Redis protocol will do).
+
+"ENABLED": False lets every request through (load tests).
+"""
+import json
+import os
+import threading
+import time
+import zlib
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+
+def slide(entry, window, now):
+    """
+    Move a [window_index, previous_count, current_count] entry forward to
+    the window `now` falls in.
+    """
+    index = int(now // window)
+    if entry is None or entry[0] < index - 1:
+        return [index, 0, 0]
+    if entry[0] == index - 1:
+        return [index, entry[2], 0]
+    return entry
+
+
+def weighted_count(previous, current, window, now):
+    elapsed = (now % window) / window
+    return previous * (1 - elapsed) + current
+
+
+def allows(entry, limit, window, now, cost):
+    return weighted_count(entry[1], entry[2], window, now) + cost - 1 < limit
+
+
+class BaseBackend:
+    def hit(self, keys, limit, window, cost=1):
+        """
+        Count `cost` attempts for every key in `keys`. Returns False (and
+        counts nothing) if that would make more than `limit` in the last
+        `window` seconds for any of them.
+        """
+        raise NotImplementedError
+
+
+class LocMemBackend(BaseBackend):
+    def __init__(self, **options):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._last_prune = time.monotonic()
+
+    def hit(self, keys, limit, window, cost=1):
+        now = time.time()
+
+        with self._lock:
+            entries = [slide(self._entries.get(key), window, now) for key in keys]
+            allowed = all(allows(entry, limit, window, now, cost) for entry in entries)
+            for key, entry in zip(keys, entries):
+                if allowed:
+                    entry[2] += cost
+                self._entries[key] = entry
+
+            if time.monotonic() - self._last_prune > window:
+                self._prune(now, window)
+
+        return allowed
+
+    def _prune(self, now, window):
+        index = int(now // window)
+        self._entries = {
+            key: entry for key, entry in self._entries.items()
+            if entry[0] >= index - 1
+        }
+        self._last_prune = time.monotonic()
+
+
+class FileBackend(BaseBackend):
+    """
+    Counters in a few small JSON files, updated under an exclusive flock(),
+    so all worker processes on the host share them. When the keys of one
+    hit live in several files, they are locked in path order. POSIX only.
+    """
+    SHARDS = 16
+
+    def __init__(self, LOCATION=None, **options):
+        if not LOCATION:
+            raise ImproperlyConfigured("FileBackend needs RATE_LIMIT['LOCATION'] (a directory).")
+        self.location = str(LOCATION)
+        os.makedirs(self.location, exist_ok=True)
+
+    def hit(self, keys, limit, window, cost=1):
+        import fcntl
+
+        paths = sorted({self.path(key) for key in keys})  # same lock order everywhere
+
+        with ExitStack() as stack:
+            files = {}
+            for path in paths:
+                f = stack.enter_context(open(path, "a+"))
+                fcntl.flock(f, fcntl.LOCK_EX)
+                stack.callback(fcntl.flock, f, fcntl.LOCK_UN)
+                files[path] = f
+
+            shards = {path: self.read(f) for path, f in files.items()}
+            now = time.time()
+            entries = [slide(shards[self.path(key)].get(key), window, now) for key in keys]
+            allowed = all(allows(entry, limit, window, now, cost) for entry in entries)
+
+            for key, entry in zip(keys, entries):
+                if allowed:
+                    entry[2] += cost
+                # Remember the window size so stale keys can be dropped
+                shards[self.path(key)][key] = entry[:3] + [window]
+
+            for path, f in files.items():
+                self.write(f, {
+                    k: e for k, e in shards[path].items()
+                    if e[0] >= int(now // e[3]) - 1
+                })
+
+        return allowed
+
+    def path(self, key):
+        shard = zlib.crc32(key.encode()) % self.SHARDS
+        return os.path.join(self.location, f"shard-{shard}.json")
+
+    @staticmethod
+    def read(f):
+        f.seek(0)
+        raw = f.read()
+        try:
+            return json.loads(raw) if raw else {}
+        except ValueError:
+            return {}
+
+    @staticmethod
+    def write(f, entries):
+        f.seek(0)
+        f.truncate()
+        json.dump(entries, f)
+        f.flush()  # before the lock is released
+
+
+class RedisBackend(BaseBackend):
+    """
+    One counter key per window; INCRBY + GET for all keys run in a single
+    MULTI/EXEC, and an attempt over the limit is rolled back with DECRBY on
+    every key. Only plain commands are used (no Lua), so simple Redis
+    stand-ins work too.
+    Needs the `redis` package.
+    """
+
+    def __init__(self, LOCATION=None, **options):
+        try:
+            import redis
+        except ImportError as exc:
+            raise ImproperlyConfigured("RedisBackend requires the 'redis' package.") from exc
+
+        self.client = redis.Redis.from_url(LOCATION or "redis://localhost:6379/0")
+
+    def hit(self, keys, limit, window, cost=1):
+        now = time.time()
+        index = int(now // window)
+
+        pipe = self.client.pipeline(transaction=True)
+        for key in keys:
+            pipe.incrby(f"{key}:{index}", cost)
+            pipe.expire(f"{key}:{index}", window * 2)
+            pipe.get(f"{key}:{index - 1}")
+        results = pipe.execute()
+
+        if all(
+            weighted_count(int(previous or 0), current - cost, window, now) + cost - 1 < limit
+            for current, _, previous in zip(results[0::3], results[1::3], results[2::3])
+        ):
+            return True
+
+        pipe = self.client.pipeline(transaction=True)
+        for key in keys:
+            pipe.decrby(f"{key}:{index}", cost)
+        pipe.execute()
+        return False
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                config = dict(settings.RATE_LIMIT)
+                config.pop("ENABLED", None)
+                backend_class = import_string(config.pop("BACKEND"))
+                _backend = backend_class(**config)
+    return _backend
+
+
+def get_client_ip(request):
+    return request.META.get("REMOTE_ADDR", "unknown")
+
+
+def rate_limit(request, action: str, limit: int, window_seconds: int = 60, cost: int = 1) -> bool:
+    """
+    Per-IP, and for logged-in users also per-user, rate limiter.
+
+    action: "login", "register", "send_message", etc.
+    limit:  allowed attempts within window_seconds per IP (and per user).
+    cost:   attempts this request counts as (e.g. messages in a batch).
+    returns True if blocked, False if allowed.
+    Always allows when settings.RATE_LIMIT["ENABLED"] is off (e.g. load tests).
+    """
+    user = getattr(request, "user", None)
+    user_id = user.id if user is not None and user.is_authenticated else None
+    return rate_limit_client(get_client_ip(request), user_id, action, limit, window_seconds, cost)
+
+
+def rate_limit_client(ip, user_id, action: str, limit: int, window_seconds: int = 60, cost: int = 1) -> bool:
+    """
+    rate_limit() for callers without a request (e.g. WebSocket frames),
+    sharing its counters: the same action is limited across both.
+    """
+    if not settings.RATE_LIMIT.get("ENABLED", True):
+        return False
+
+    keys = [f"rl:{action}:ip:{ip}"]
+    if user_id is not None:
+        keys.append(f"rl:{action}:user:{user_id}")
+
+    # Both limits are checked before either counts: an attempt refused
+    # for the IP doesn't use up the user's quota, and vice versa
+    return not get_backend().hit(keys, limit, window_seconds, cost)
@@ -0,0 +1,71 @@
+"""
+JSON renderer backed by orjson when it is installed (several times faster
+than the stdlib encoder on large lists). Output is the same compact UTF-8
+JSON as DRF's JSONRenderer (UTC datetimes end in "Z" too), which is still
+used for anything orjson can't encode and for indented output
+(?format=json; indent=4 etc.).
+
+Plus the compact wire formats a view can offer next to it (see
+COMPACT_RENDERERS): the same JSON under its own media type, and MessagePack
+when the `msgpack` package is installed.
+"""
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+from .metrics import measure_serialization
+
+try:
+    import orjson
+except ImportError:  # optional
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # optional
+    msgpack = None
+
+
+class FastJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with measure_serialization():
+            return self._render(data, accepted_media_type, renderer_context)
+
+    def _render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None:
+            return super().render(data, accepted_media_type, renderer_context)
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        try:
+            return orjson.dumps(data, option=orjson.OPT_UTC_Z)
+        except TypeError:
+            return super().render(data, accepted_media_type, renderer_context)
+
+
+class CompactJSONRenderer(FastJSONRenderer):
+    """
+    Accept: application/vnd.chat.compact+json (or ?format=compact).
+    Views that offer it return a compact layout of their data for it.
+    """
+    media_type = "application/vnd.chat.compact+json"
+    format = "compact"
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    Accept: application/vnd.msgpack (or ?format=msgpack); same data as
+    CompactJSONRenderer, binary.
+    """
+    media_type = "application/vnd.msgpack"
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        with measure_serialization():
+            return msgpack.packb(data, use_bin_type=True, default=str)
+
+
+COMPACT_FORMATS = ("compact", "msgpack")
+COMPACT_RENDERERS = [CompactJSONRenderer] + ([MessagePackRenderer] if msgpack else [])
@@ -5,7 +5,11 @@ Generated by 'django-admin startproject' using Django 5.2.8.
 """
 
 from pathlib import Path
+import atexit
 import os
+import shutil
+import sys
+import tempfile
 from datetime import timedelta
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,6 +47,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "coreBackend.middleware.InstrumentationMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -81,14 +86,78 @@ TEMPLATES = [
 
 WSGI_APPLICATION = "coreBackend.wsgi.application"
 
-# Database
+# Small local files shared by the worker processes of one host (event bus
+# sockets, rate-limit counters, cache version stamps). The default is for
+# development: in deployment set LOCAL_STATE_DIR outside the source tree
+# (e.g. /run/coreBackend), the same for every worker and management command.
+LOCAL_STATE_DIR = Path(os.environ.get("LOCAL_STATE_DIR", BASE_DIR / "var"))
+
+# `manage.py test` gets a fresh directory of its own (sockets, version
+# files, the test database), outside the tree and away from a dev server's
+TESTING = sys.argv[1:2] == ["test"]
+if TESTING and "LOCAL_STATE_DIR" not in os.environ:
+    LOCAL_STATE_DIR = Path(tempfile.mkdtemp(prefix="coreBackend-test-"))
+    atexit.register(shutil.rmtree, LOCAL_STATE_DIR, ignore_errors=True)
+elif TESTING:
+    os.makedirs(LOCAL_STATE_DIR, exist_ok=True)
 
-DATABASES = {
-    "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+# Database
+#
+# DB_PROFILE=sqlite (default): one file, tuned for several worker processes:
+#   WAL (readers don't wait for writers), synchronous=NORMAL (safe with WAL),
+#   write transactions take the lock up front (BEGIN IMMEDIATE) and wait up
+#   to SQLITE_BUSY_TIMEOUT ms for it instead of failing with "database is locked".
+# DB_PROFILE=postgresql: persistent connections (DB_CONN_MAX_AGE seconds,
+#   health-checked), or a psycopg connection pool per process with DB_POOL=1
+#   (needs psycopg[pool]; Django then closes nothing, so CONN_MAX_AGE is 0).
+
+DB_PROFILE = os.environ.get("DB_PROFILE", "sqlite")
+
+if DB_PROFILE == "postgresql":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": os.environ.get("DB_NAME", "chat"),
+            "USER": os.environ.get("DB_USER", ""),
+            "PASSWORD": os.environ.get("DB_PASSWORD", ""),
+            "HOST": os.environ.get("DB_HOST", ""),
+            "PORT": os.environ.get("DB_PORT", ""),
+            "CONN_MAX_AGE": int(os.environ.get("DB_CONN_MAX_AGE", "60")),
+            "CONN_HEALTH_CHECKS": True,
+            "OPTIONS": {},
+        }
+    }
+    if os.environ.get("DB_POOL") == "1":
+        DATABASES["default"]["CONN_MAX_AGE"] = 0
+        DATABASES["default"]["OPTIONS"]["pool"] = {
+            "min_size": int(os.environ.get("DB_POOL_MIN_SIZE", "2")),
+            "max_size": int(os.environ.get("DB_POOL_MAX_SIZE", "10")),
+            "timeout": int(os.environ.get("DB_POOL_TIMEOUT", "10")),
+        }
+else:
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get("SQLITE_BUSY_TIMEOUT", "5000"))  # ms
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.environ.get("SQLITE_PATH", BASE_DIR / "db.sqlite3"),
+            "CONN_MAX_AGE": int(os.environ.get("DB_CONN_MAX_AGE", "0")),
+            "OPTIONS": {
+                "timeout": SQLITE_BUSY_TIMEOUT / 1000,
+                "transaction_mode": "IMMEDIATE",
+                "init_command": ";".join([
+                    f"PRAGMA journal_mode={os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')}",
+                    f"PRAGMA synchronous={os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')}",
+                    f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}",
+                    f"PRAGMA mmap_size={os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))}",
+                    # negative = KiB
+                    f"PRAGMA cache_size=-{os.environ.get('SQLITE_CACHE_SIZE_KB', '65536')}",
+                ]),
+            },
+            # A file, not the default in-memory DB, so tests see the same
+            # journaling and locking as production.
+            "TEST": {"NAME": (LOCAL_STATE_DIR if TESTING else BASE_DIR) / "test_db.sqlite3"},
+        }
     }
-}
 
 # Password validation
 
@@ -134,15 +203,117 @@ SIMPLE_JWT = {
 
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
-    )
+        "accounts.authentication.CachedJWTAuthentication",
+    ),
+    "DEFAULT_RENDERER_CLASSES": (
+        "coreBackend.renderers.FastJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ),
 }
 
+# Users resolved from access tokens are cached per process
+# (accounts.authentication); entries live at most AUTH_USER_CACHE_TTL seconds.
+AUTH_USER_CACHE_MAX_USERS = 10000
+AUTH_USER_CACHE_TTL = int(os.environ.get("AUTH_USER_CACHE_TTL", "60"))
+
 REGISTRATION_SECRET = os.environ.get(
     "REGISTRATION_SECRET",
     "dev-registration-secret-change-this-locally"
 )
 
+# Presence: heartbeats are kept in memory and written to Profile.last_seen
+# in batches by a background thread every PRESENCE_FLUSH_INTERVAL seconds.
+PRESENCE_FLUSH_INTERVAL = int(os.environ.get("PRESENCE_FLUSH_INTERVAL", "30"))
+PRESENCE_ONLINE_WINDOW = 60  # seconds since last activity to count as online
+
+# Page size for GET /api/chat/messages/ (?limit=, capped at the max)
+MESSAGE_PAGE_SIZE = int(os.environ.get("MESSAGE_PAGE_SIZE", "50"))
+MESSAGE_PAGE_SIZE_MAX = 200
+
+# Message search backend (chat.search); empty = SQLite FTS5 when the
+# database is SQLite, a plain icontains scan otherwise.
+MESSAGE_SEARCH_BACKEND = os.environ.get("MESSAGE_SEARCH_BACKEND", "")
+
+# Max messages per POST /api/chat/messages/batch/
+MESSAGE_BATCH_MAX = 100
+
+# Cold storage (chat.archive): `manage.py archive_messages` moves messages
+# older than MESSAGE_ARCHIVE_AFTER_DAYS into compressed per-conversation
+# segment files under MESSAGE_ARCHIVE_DIR. Keep that directory in backups.
+MESSAGE_ARCHIVE_DIR = Path(os.environ.get("MESSAGE_ARCHIVE_DIR", BASE_DIR / "archive"))
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.environ.get("MESSAGE_ARCHIVE_AFTER_DAYS", "365"))
+
+# Retention (chat.retention, `manage.py purge_messages`): messages older than
+# MESSAGE_RETENTION_DAYS, and all but the newest
+# MESSAGE_RETENTION_MAX_PER_CONVERSATION of each conversation, are deleted,
+# from the database and from cold storage. 0 = no limit.
+MESSAGE_RETENTION_DAYS = int(os.environ.get("MESSAGE_RETENTION_DAYS", "0"))
+MESSAGE_RETENTION_MAX_PER_CONVERSATION = int(
+    os.environ.get("MESSAGE_RETENTION_MAX_PER_CONVERSATION", "0")
+)
+MESSAGE_PURGE_CHUNK_SIZE = 500
+MESSAGE_PURGE_PAUSE = float(os.environ.get("MESSAGE_PURGE_PAUSE", "0.05"))  # seconds
+
+# Users whose block lists are kept in memory per process (chat.blocks)
+BLOCK_CACHE_MAX_USERS = 10000
+
+# Upper bound for GET /api/chat/messages/?wait=<seconds> (long-poll mode)
+LONG_POLL_MAX_WAIT = int(os.environ.get("LONG_POLL_MAX_WAIT", "30"))
+
+# A device reconnecting to the WebSocket gets the messages it missed
+# replayed (chat.devices); further behind than this, it reloads instead.
+DEVICE_REPLAY_MAX = 500
+
+# Transient per-pair states ("typing"...), memory only (chat.ephemeral):
+# the names clients may send, and how long one lasts unless refreshed.
+EPHEMERAL_STATES = ("typing", "recording")
+EPHEMERAL_STATE_TTL = int(os.environ.get("EPHEMERAL_STATE_TTL", "6"))  # seconds
+
+# Rate limiting (coreBackend.ratelimit): sliding window, per IP and per user.
+# FileBackend shares counters between the workers of one host;
+# use RedisBackend with a redis:// LOCATION when running on several hosts.
+RATE_LIMIT = {
+    "BACKEND": os.environ.get(
+        "RATE_LIMIT_BACKEND",
+        "coreBackend.ratelimit.FileBackend" if os.name == "posix"
+        else "coreBackend.ratelimit.LocMemBackend",
+    ),
+    "LOCATION": os.environ.get("RATE_LIMIT_LOCATION", str(LOCAL_STATE_DIR / "ratelimit")),
+    # Off only for load tests (manage.py benchmark_api against a live server)
+    "ENABLED": os.environ.get("RATE_LIMIT_ENABLED", "1") == "1",
+}
+
+# Event bus between the workers (coreBackend.eventbus): new messages, reads,
+# blocks and presence reach every process. UnixSocketBackend connects the
+# workers of one host; use RedisBackend with a redis:// LOCATION when
+# running on several hosts, LocalBackend for a single process.
+EVENT_BUS = {
+    "BACKEND": os.environ.get(
+        "EVENT_BUS_BACKEND",
+        "coreBackend.eventbus.UnixSocketBackend" if os.name == "posix"
+        else "coreBackend.eventbus.LocalBackend",
+    ),
+    "LOCATION": os.environ.get("EVENT_BUS_LOCATION", str(LOCAL_STATE_DIR / "eventbus")),
+}
+
+# Longest message content, in characters. A message.created event must fit
+# in one UnixSocketBackend datagram (64 KB) even with every character
+# escaped (\ud83d\ude00: 12 bytes).
+MESSAGE_MAX_LENGTH = int(os.environ.get("MESSAGE_MAX_LENGTH", "4000"))
+
+# Instrumentation (coreBackend.metrics): queries slower than this are logged
+# to "coreBackend.slow_queries" (0 = off; off by default under `manage.py
+# test`, where lock waits are expected). /metrics requires
+# "Authorization: Bearer <METRICS_TOKEN>"; with no token set it is only
+# served when DEBUG is on. SERVER_TIMING=1 adds a Server-Timing header
+# (total / DB / serialization time) to every response; it tells clients
+# how long the DB took, so it defaults to DEBUG.
+SLOW_QUERY_THRESHOLD_MS = float(
+    os.environ.get("SLOW_QUERY_THRESHOLD_MS", "0" if TESTING else "200")
+)
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "1" if DEBUG else "0") == "1"
+
 RATELIMIT_ENABLE = True
 RATELIMIT_USE_CACHE = "default"
 
@@ -0,0 +1,251 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import types
+import unittest
+import unittest.mock
+from datetime import date, datetime, timezone
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from accounts.presence import presence
+from chat.models import Message
+
+from . import eventbus, metrics, ratelimit
+from .renderers import FastJSONRenderer, orjson
+
+try:
+    import fakeredis
+except ImportError:  # optional, for the RedisBackend tests
+    fakeredis = None
+
+
+class FastJSONRendererTests(TestCase):
+    """
+    FastJSONRenderer must not change the wire format: byte for byte what
+    DRF's JSONRenderer would have sent.
+    """
+
+    def assertSameAsDRF(self, data):
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+    @unittest.skipIf(orjson is None, "orjson not installed")
+    def test_values(self):
+        self.assertSameAsDRF({
+            "utc": datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc),
+            "micro": datetime(2024, 5, 1, 12, 30, 0, 123456, tzinfo=timezone.utc),
+            "naive": datetime(2024, 5, 1, 12, 30),
+            "day": date(2024, 5, 1),
+            "text": "héllo 👋 \"quoted\"\n",
+            "nested": [{"n": 1, "f": 1.5, "none": None, "flag": True}],
+        })
+
+    def test_endpoints(self):
+        alice = User.objects.create_user("alice", password="x")
+        bob = User.objects.create_user("bob", password="x")
+        Message.objects.create(sender=alice, receiver=bob, content="hi")
+        presence.heartbeat(alice.id)
+
+        client = APIClient()
+        client.force_authenticate(bob)
+        for url in ("/api/users/", "/api/presence/"):
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, JSONRenderer().render(response.data), url)
+            self.assertNotIn(b"+00:00", response.content, url)
+
+
+class MetricsViewTests(TestCase):
+    @override_settings(METRICS_TOKEN="", DEBUG=False)
+    def test_denied_without_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+
+    @override_settings(METRICS_TOKEN="s3cret")
+    def test_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        response = self.client.get("/metrics", headers={"Authorization": "Bearer s3cret"})
+        self.assertEqual(response.status_code, 200)
+
+
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username="alice"))
+
+    @override_settings(SLOW_QUERY_THRESHOLD_MS=1e-6)
+    def test_slow_queries_name_the_view(self):
+        with self.assertLogs("coreBackend.slow_queries", "WARNING") as logs:
+            self.client.get("/api/users/")
+        self.assertTrue(logs.output)
+        self.assertEqual([line for line in logs.output if "[UserListView]" not in line], [])
+
+    @override_settings(SLOW_QUERY_THRESHOLD_MS=1e-6)
+    def test_query_before_view_is_resolved(self):
+        metrics.install()  # as InstrumentationMiddleware does
+        stats = metrics.RequestStats()
+        token = metrics.current_stats.set(stats)
+        try:
+            with self.assertNoLogs("coreBackend.slow_queries"):
+                User.objects.count()  # e.g. from a middleware
+        finally:
+            metrics.current_stats.reset(token)
+
+        stats.view = "UserListView"
+        with self.assertLogs("coreBackend.slow_queries", "WARNING") as logs:
+            metrics.observe_request(stats, "GET", 200, 0.1)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("[UserListView]", logs.output[0])
+
+    def test_server_timing_setting(self):
+        with override_settings(SERVER_TIMING=False):
+            self.assertNotIn("Server-Timing", self.client.get("/api/users/"))
+        with override_settings(SERVER_TIMING=True):
+            self.assertIn("db;dur=", self.client.get("/api/users/")["Server-Timing"])
+
+
+class EventBusStartTests(TestCase):
+    """
+    A process binds its listener on the first request it serves, not when
+    handlers are subscribed (app loading in management commands, or in a
+    preloading master before the fork).
+    """
+
+    def setUp(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        self.bus = eventbus.UnixSocketBackend(LOCATION=location)
+        patcher = unittest.mock.patch.object(eventbus, "_bus", self.bus)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        if self.bus._socket is not None:
+            self.bus._socket.close()  # ends the listener thread
+
+    def test_listens_from_first_request(self):
+        self.bus.subscribe("test.event", lambda event: None)
+        self.assertEqual(os.listdir(self.bus.location), [])
+
+        self.client.get("/metrics")
+        self.assertEqual(os.listdir(self.bus.location), [f"{os.getpid()}.sock"])
+
+
+class RateLimitBackendTests:
+    """
+    The same checks for every backend (make_backend). The clock is frozen
+    at the start of a window, in coreBackend.ratelimit only.
+    """
+
+    WINDOW = 60
+    LIMIT = 5
+
+    def setUp(self):
+        self.now = 100 * self.WINDOW
+        clock = types.SimpleNamespace(time=lambda: self.now, monotonic=time.monotonic)
+        patcher = unittest.mock.patch.object(ratelimit, "time", clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.backend = self.make_backend()
+
+    def hit(self, *keys, cost=1):
+        return self.backend.hit(list(keys), self.LIMIT, self.WINDOW, cost)
+
+    def test_limit(self):
+        self.assertEqual([self.hit("a") for _ in range(self.LIMIT + 1)], [True] * self.LIMIT + [False])
+        self.assertTrue(self.hit("b"))
+
+    def test_sliding_window(self):
+        for _ in range(self.LIMIT):
+            self.hit("a")
+
+        # Half way through the next window, half of the last one still counts
+        self.now += 1.5 * self.WINDOW
+        self.assertEqual([self.hit("a") for _ in range(4)], [True, True, True, False])
+
+        self.now += 2 * self.WINDOW
+        self.assertEqual([self.hit("a") for _ in range(self.LIMIT + 1)], [True] * self.LIMIT + [False])
+
+    def test_cost(self):
+        self.assertTrue(self.hit("a", cost=3))
+        self.assertFalse(self.hit("a", cost=3))
+        self.assertTrue(self.hit("a", cost=2))
+        self.assertFalse(self.hit("a"))
+
+    def test_all_keys_or_none(self):
+        for _ in range(self.LIMIT):
+            self.hit("a")
+        self.assertFalse(self.hit("a", "b"))
+        # "b" wasn't charged for the refused attempt
+        self.assertEqual([self.hit("b") for _ in range(self.LIMIT + 1)], [True] * self.LIMIT + [False])
+
+    def test_concurrent_hits(self):
+        limit, threads, attempts = 50, 8, 25
+        allowed = []
+        start = threading.Barrier(threads)
+
+        def attempt():
+            start.wait()
+            for _ in range(attempts):
+                allowed.append(self.backend.hit(["a", "b"], limit, self.WINDOW))
+
+        workers = [threading.Thread(target=attempt) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(allowed.count(True), limit)
+
+
+class LocMemBackendTests(RateLimitBackendTests, SimpleTestCase):
+    def make_backend(self):
+        return ratelimit.LocMemBackend()
+
+
+class FileBackendTests(RateLimitBackendTests, SimpleTestCase):
+    def make_backend(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        return ratelimit.FileBackend(LOCATION=location)
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis not installed")
+class RedisBackendTests(RateLimitBackendTests, SimpleTestCase):
+    def make_backend(self):
+        backend = ratelimit.RedisBackend(LOCATION="redis://localhost:6379/0")
+        backend.client = fakeredis.FakeRedis()
+        return backend
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        patcher = unittest.mock.patch.object(ratelimit, "_backend", ratelimit.LocMemBackend())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create(username="alice")
+
+    def attempt(self, ip, user=None):
+        request = RequestFactory().post("/", REMOTE_ADDR=ip)
+        request.user = user or AnonymousUser()
+        return ratelimit.rate_limit(request, action="test", limit=3)
+
+    def test_ip_refusal_keeps_user_quota(self):
+        for _ in range(3):
+            self.assertFalse(self.attempt("10.0.0.1"))
+        for _ in range(3):
+            self.assertTrue(self.attempt("10.0.0.1", self.user))
+
+        self.assertEqual(
+            [self.attempt("10.0.0.2", self.user) for _ in range(4)], [False, False, False, True]
+        )
+
+    def test_disabled(self):
+        with override_settings(RATE_LIMIT={**settings.RATE_LIMIT, "ENABLED": False}):
+            self.assertEqual([self.attempt("10.0.0.1") for _ in range(5)], [False] * 5)
+        self.assertTrue(all(self.attempt("10.0.0.1") is False for _ in range(3)))
+        self.assertTrue(self.attempt("10.0.0.1"))
@@ -0,0 +1,101 @@
+"""
+Per-process LRU caches kept consistent across workers by a version file.
+
+Whatever the cache holds changes rarely, so every change just bumps a
+shared version file (a few bytes under LOCAL_STATE_DIR). Each lookup
+re-reads that file, and if another process changed it the whole local
+cache is dropped. A warm lookup therefore costs no queries and is still
+correct across workers. Used by chat.blocks and accounts.authentication;
+read_version() / bump_version() alone serve as a cheap version token for
+ETags (accounts.views.UserListView).
+"""
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+def read_version(version_file):
+    try:
+        with open(version_file) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def bump_version(version_file):
+    """
+    Write a new random version (atomically) and return it.
+    """
+    version = uuid.uuid4().hex
+    os.makedirs(os.path.dirname(version_file), exist_ok=True)
+    tmp_file = f"{version_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        f.write(version)
+    os.replace(tmp_file, version_file)
+    return version
+
+
+class VersionedCache:
+    def __init__(self, version_file, max_entries, ttl=None):
+        self.version_file = version_file
+        self.max_entries = max_entries
+        self.ttl = ttl  # seconds, or None: entries live until evicted / invalidated
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, expires_at or None)
+        self._version = None
+
+    def get(self, key, load):
+        """
+        Cached value for `key`, or load() it and remember it.
+        """
+        version = self._check_version()
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                self._entries.move_to_end(key)
+                return entry[0]
+
+        value = load()
+
+        with self._lock:
+            # Don't store what we read if something changed while we were reading
+            if self._version != version:
+                return value
+            self._entries[key] = (value, now + self.ttl if self.ttl is not None else None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self):
+        """
+        Drop this process' cache and tell the other processes to drop theirs.
+        Call after the change is committed.
+        """
+        version = bump_version(self.version_file)
+
+        with self._lock:
+            self._entries.clear()
+            self._version = version
+
+    def clear(self):
+        """
+        Drop this process' cache only (another process already bumped
+        the version, e.g. on an event from the bus).
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def _check_version(self):
+        version = read_version(self.version_file)
+
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+        return version